@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Optional
+from urllib.parse import urlencode
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class HttpResult:
+    """
+    Response of a request of a virtual CM.
+    """
+
+    status: int
+    headers: dict[str, str]
+    body: bytes
+    size: int
+    duration: float
+
+    def __init__(
+        self,
+        p_status: int,
+        p_headers: dict[str, str],
+        p_body: bytes,
+        p_size: int,
+        p_duration: float,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_status: The HTTP status
+        :type p_status: int
+        :param p_headers: The response headers, with lower case names
+        :type p_headers: dict[str, str]
+        :param p_body: The body, empty if discarded
+        :type p_body: bytes
+        :param p_size: The size of the body
+        :type p_size: int
+        :param p_duration: The duration of the request in seconds
+        :type p_duration: float
+        """
+        self.status = p_status
+        self.headers = p_headers
+        self.body = p_body
+        self.size = p_size
+        self.duration = p_duration
+
+
+class VirtualCmFleet:
+    """
+    Load generator simulating a fleet of CMs, each running the HTTP
+    conversation of the provisioning script: /scriptexecute,
+    /scriptexecute/eeprom-version, /downloadimage, then
+    /scriptexecute/alldone or /scriptexecute/error.
+
+    The CMs arrive in a burst, at a uniform rate or as a Poisson process,
+    at most "concurrency" of them run at once, and every CM downloads the
+    image at most at its simulated link speed. The HTTP client is a minimal
+    HTTP/1.1 client on asyncio streams, so a single process simulates
+    hundreds of CMs without any dependency.
+
+    The report holds the p50/p95/p99 latency per endpoint, the aggregate
+    download throughput, and the result store write latency from the
+    /metrics of the server.
+    """
+
+    host: str
+    port: int
+    READ_SIZE = 64 * 1024
+    ENDPOINTS = (
+        "/scriptexecute",
+        "/scriptexecute/eeprom-version",
+        "/downloadimage",
+        "/scriptexecute/alldone",
+        "/scriptexecute/error",
+    )
+
+    def __init__(
+        self,
+        p_server: str,
+        p_cms: int,
+        p_concurrency: int,
+        p_arrival: str,
+        p_rate: float,
+        p_linkMbps: float,
+        p_failureRate: float,
+        p_storageSize: int,
+        p_serialPrefix: str,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_server: The server, as "<host>:<port>"
+        :type p_server: str
+        :param p_cms: The number of virtual CMs
+        :type p_cms: int
+        :param p_concurrency: The maximal number of CMs provisioned at once
+        :type p_concurrency: int
+        :param p_arrival: The arrival pattern, "burst", "uniform" or "poisson"
+        :type p_arrival: str
+        :param p_rate: The mean arrival rate in CMs per second
+        :type p_rate: float
+        :param p_linkMbps: The link speed of every CM in Mbit/s, 0 for no limit
+        :type p_linkMbps: float
+        :param p_failureRate: The ratio of CMs reporting an error
+        :type p_failureRate: float
+        :param p_storageSize: The storage size of the CMs in 512 bytes sectors
+        :type p_storageSize: int
+        :param p_serialPrefix: The prefix of the serial numbers of the CMs
+        :type p_serialPrefix: str
+        """
+        host, _, port = p_server.partition(":")
+        self.host = host
+        self.port = int(port or 80)
+        self.cms = p_cms
+        self.concurrency = p_concurrency
+        self.arrival = p_arrival
+        self.rate = p_rate
+        self.linkSpeed = p_linkMbps * 1000 * 1000 / 8
+        self.failureRate = p_failureRate
+        self.storageSize = p_storageSize
+        self.serialPrefix = p_serialPrefix
+        self.latencies: dict[str, list[float]] = {
+            endpoint: [] for endpoint in self.ENDPOINTS
+        }
+        self.errors: dict[str, int] = {}
+        self.downloaded = 0
+        self.queued = 0
+        self.completed = 0
+
+    async def _request(
+        self,
+        p_method: str,
+        p_path: str,
+        p_body: bytes = b"",
+        p_headers: Optional[dict[str, str]] = None,
+        p_discard: bool = False,
+    ) -> HttpResult:
+        """
+        Send a request on a new connection and read its response.
+
+        :param p_method: The HTTP method
+        :type p_method: str
+        :param p_path: The path with the query string
+        :type p_path: str
+        :param p_body: The request body
+        :type p_body: bytes
+        :param p_headers: Additional request headers
+        :type p_headers: dict[str, str]
+        :param p_discard: True to read the body at the link speed and discard it
+        :type p_discard: bool
+
+        :return: The response
+        :rtype: HttpResult
+        """
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            lines = [
+                f"{p_method} {p_path} HTTP/1.1",
+                f"Host: {self.host}:{self.port}",
+                "Connection: close",
+                f"Content-Length: {len(p_body)}",
+            ]
+            lines.extend(
+                f"{name}: {value}" for name, value in (p_headers or {}).items()
+            )
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + p_body)
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            chunks = []
+            size = 0
+            readStart = time.perf_counter()
+            remaining = int(headers.get("content-length", -1))
+            while remaining != 0:
+                chunk = await reader.read(
+                    self.READ_SIZE if remaining < 0 else min(self.READ_SIZE, remaining)
+                )
+                if not chunk:
+                    break
+                size += len(chunk)
+                remaining -= len(chunk) if remaining > 0 else 0
+                if p_discard:
+                    if self.linkSpeed > 0:
+                        delay = readStart + size / self.linkSpeed - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                else:
+                    chunks.append(chunk)
+        finally:
+            writer.close()
+
+        return HttpResult(
+            status, headers, b"".join(chunks), size, time.perf_counter() - start
+        )
+
+    def _record(self, p_endpoint: str, p_result: HttpResult) -> None:
+        """
+        Record the latency of a request, and count the failed requests.
+
+        :param p_endpoint: The endpoint
+        :type p_endpoint: str
+        :param p_result: The response
+        :type p_result: HttpResult
+        """
+        self.latencies[p_endpoint].append(p_result.duration)
+        if p_result.status >= 400:
+            key = f"{p_endpoint} {p_result.status}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    async def _provision(self, p_index: int) -> None:
+        """
+        Run the provisioning conversation of a virtual CM.
+
+        :param p_index: The index of the CM
+        :type p_index: int
+        """
+        serial = f"{self.serialPrefix}{p_index:08x}"
+        query = urlencode(
+            {
+                "serial": serial,
+                "model": "Raspberry Pi Compute Module 4 Rev 1.1",
+                "storagesize": self.storageSize,
+                "mac": ":".join(f"{random.randrange(256):02x}" for _ in range(6)),
+                "inversejumper": 0,
+                "memorysize": 4 * 1024 * 1024,
+                "temp": "45.0",
+                "cid": uuid.uuid4().hex,
+                "csd": uuid.uuid4().hex,
+                "bootmode": 1,
+            }
+        )
+        result = await self._request("GET", f"/scriptexecute?{query}")
+        self._record("/scriptexecute", result)
+        script = result.body.decode(errors="replace")
+        image = re.search(r'^export IMAGE="(.*)"$', script, re.M)
+        startTime = re.search(r'^export STARTTIME="(.*)"$', script, re.M)
+        if result.status != 200 or image is None or startTime is None:
+            return
+        start = startTime.group(1)
+
+        boundary = uuid.uuid4().hex
+        body = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="eeprom_version"; '
+            'filename="eeprom_version"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+            "2023/01/11 17:40:52\nversion 8ba17717fbcedd4c3b6d4bce7e50c7af4155cba9\n"
+            f"\r\n--{boundary}--\r\n"
+        ).encode()
+        eepromSha = hashlib.sha256(serial.encode()).hexdigest()
+        result = await self._request(
+            "POST",
+            f"/scriptexecute/eeprom-version?{urlencode({'serial': serial, 'eepromsha': eepromSha, 'start': start})}",
+            body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        self._record("/scriptexecute/eeprom-version", result)
+
+        # A queued download is retried after the Retry-After delay, like
+        # the provisioning script
+        while True:
+            result = await self._request(
+                "GET",
+                f"/downloadimage/{image.group(1)}?{urlencode({'encoding': 'xz', 'serial': serial})}",
+                p_discard=True,
+            )
+            if result.status != 503:
+                break
+            self.queued += 1
+            await asyncio.sleep(int(result.headers.get("retry-after", 5)))
+        self._record("/downloadimage", result)
+        if result.status < 300:
+            self.downloaded += result.size
+
+        if result.status >= 300 or random.random() < self.failureRate:
+            body = (
+                f"--{boundary}\r\n"
+                'Content-Disposition: form-data; name="log"; filename="dd.log"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+                "Simulated failure of a virtual CM\n"
+                f"\r\n--{boundary}--\r\n"
+            ).encode()
+            result = await self._request(
+                "POST",
+                f"/scriptexecute/error?{urlencode({'serial': serial, 'retcode': 1, 'phase': 'dd', 'start': start})}",
+                body,
+                {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            )
+            self._record("/scriptexecute/error", result)
+        else:
+            result = await self._request(
+                "GET",
+                f"/scriptexecute/alldone?{urlencode({'serial': serial, 'alldone': 1, 'temp': '45.0', 'verify': '', 'start': start})}",
+            )
+            self._record("/scriptexecute/alldone", result)
+        self.completed += 1
+
+    async def _scrapePersistence(self) -> dict[str, dict[str, float]]:
+        """
+        Read the result store write latency from the /metrics of the server.
+
+        :return: The sum of the durations and the count, per operation,
+            empty if the server has no metrics
+        :rtype: dict
+        """
+        persistence: dict[str, dict[str, float]] = {}
+        try:
+            result = await self._request("GET", "/metrics")
+        except OSError:
+            return persistence
+        if result.status != 200:
+            return persistence
+        pattern = re.compile(
+            r"^cmprovision_persistence_duration_seconds_(sum|count)\{(.*)\} (\S+)$"
+        )
+        for line in result.body.decode().splitlines():
+            match = pattern.match(line)
+            if match is None or 'store="result"' not in match.group(2):
+                continue
+            operation = re.search(r'operation="([^"]*)"', match.group(2))
+            if operation is not None:
+                persistence.setdefault(operation.group(1), {"sum": 0.0, "count": 0.0})[
+                    match.group(1)
+                ] += float(match.group(3))
+
+        return persistence
+
+    @staticmethod
+    def percentile(p_values: list[float], p_percentile: float) -> Optional[float]:
+        """
+        Get a percentile of a list of values, by nearest rank.
+
+        :param p_values: The values
+        :type p_values: list[float]
+        :param p_percentile: The percentile, between 0 and 100
+        :type p_percentile: float
+
+        :return: The percentile, None without value
+        :rtype: float
+        """
+        if not p_values:
+            return None
+        values = sorted(p_values)
+        rank = max(1, -(-len(values) * p_percentile // 100))
+
+        return round(values[int(rank) - 1], 6)
+
+    async def run(self) -> dict[str, Any]:
+        """
+        Provision the fleet of virtual CMs.
+
+        :return: The report
+        :rtype: dict
+        """
+        persistenceBefore = await self._scrapePersistence()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def provision(p_index: int) -> None:
+            async with semaphore:
+                try:
+                    await self._provision(p_index)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    key = f"{type(e).__name__}"
+                    self.errors[key] = self.errors.get(key, 0) + 1
+
+        start = time.perf_counter()
+        tasks = []
+        for index in range(self.cms):
+            tasks.append(asyncio.create_task(provision(index)))
+            if self.arrival == "uniform":
+                await asyncio.sleep(1 / self.rate)
+            elif self.arrival == "poisson":
+                await asyncio.sleep(random.expovariate(self.rate))
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - start
+        persistenceAfter = await self._scrapePersistence()
+
+        resultStore = {}
+        for operation, after in persistenceAfter.items():
+            before = persistenceBefore.get(operation, {"sum": 0.0, "count": 0.0})
+            count = after["count"] - before["count"]
+            if count > 0:
+                resultStore[operation] = {
+                    "count": int(count),
+                    "meanSeconds": round((after["sum"] - before["sum"]) / count, 6),
+                }
+
+        return {
+            "date": datetime.now().isoformat(),
+            "parameters": {
+                "server": f"{self.host}:{self.port}",
+                "cms": self.cms,
+                "concurrency": self.concurrency,
+                "arrival": self.arrival,
+                "rate": self.rate,
+                "linkMbps": self.linkSpeed * 8 / 1000 / 1000,
+                "failureRate": self.failureRate,
+            },
+            "durationSeconds": round(duration, 3),
+            "completed": self.completed,
+            "queuedDownloads": self.queued,
+            "errors": self.errors,
+            "endpoints": {
+                endpoint: {
+                    "count": len(values),
+                    "p50": self.percentile(values, 50),
+                    "p95": self.percentile(values, 95),
+                    "p99": self.percentile(values, 99),
+                }
+                for endpoint, values in self.latencies.items()
+                if values
+            },
+            "download": {
+                "bytes": self.downloaded,
+                "MBps": round(self.downloaded / duration / 1000 / 1000, 2),
+            },
+            "resultStore": resultStore,
+        }
+
+
+def compare(p_baseline: dict[str, Any], p_report: dict[str, Any]) -> None:
+    """
+    Log the changes of the latencies and of the throughput of a report from
+    a baseline report.
+
+    :param p_baseline: The baseline report
+    :type p_baseline: dict
+    :param p_report: The new report
+    :type p_report: dict
+    """
+    for endpoint, latencies in p_report["endpoints"].items():
+        baseline = p_baseline["endpoints"].get(endpoint)
+        if baseline is None:
+            continue
+        changes = []
+        for key in ("p50", "p95", "p99"):
+            if baseline[key]:
+                changes.append(
+                    f"{key} {(latencies[key] / baseline[key] - 1) * 100:+.1f}%"
+                )
+        logging.info(f"{endpoint}: {', '.join(changes)}")
+    if p_baseline["download"]["MBps"]:
+        change = p_report["download"]["MBps"] / p_baseline["download"]["MBps"] - 1
+        logging.info(f"Download throughput: {change * 100:+.1f}%")
+
+
+def main() -> None:
+    """
+    Run the load generator from the command line.
+    """
+    parser = argparse.ArgumentParser(description=VirtualCmFleet.__doc__)
+    parser.add_argument("--server", required=True, help="<host>:<port>")
+    parser.add_argument("--cms", type=int, default=50, help="Number of virtual CMs")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--arrival", choices=["burst", "uniform", "poisson"], default="burst"
+    )
+    parser.add_argument("--rate", type=float, default=1, help="CMs per second")
+    parser.add_argument("--link-mbps", type=float, default=100, help="0 for no limit")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument(
+        "--storage-size", type=int, default=15269888, help="In 512 bytes sectors"
+    )
+    parser.add_argument("--serial-prefix", default="f1ee7")
+    parser.add_argument("--output", help="JSON report file")
+    parser.add_argument("--compare", help="JSON report to compare with")
+    args = parser.parse_args()
+
+    fleet = VirtualCmFleet(
+        args.server,
+        args.cms,
+        args.concurrency,
+        args.arrival,
+        args.rate,
+        args.link_mbps,
+        args.failure_rate,
+        args.storage_size,
+        args.serial_prefix,
+    )
+    report = asyncio.run(fleet.run())
+    logging.info(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ImageDownloadBenchmark:
+    """
+    Throughput of the image downloads of a running server, with a number of
+    concurrent downloads.
+
+    Run it with the memory tier enabled and disabled in the configuration
+    to compare both. Without the tier, the page cache of the image can be
+    dropped before every round, so the downloads read the disk like on a
+    host short of memory.
+    """
+
+    host: str
+    port: int
+    image: str
+    encoding: str
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, p_server: str, p_image: str, p_encoding: str) -> None:
+        """
+        Constructor
+
+        :param p_server: The server, as "<host>:<port>"
+        :type p_server: str
+        :param p_image: The image file name
+        :type p_image: str
+        :param p_encoding: The encoding of the image
+        :type p_encoding: str
+        """
+        host, _, port = p_server.partition(":")
+        self.host = host
+        self.port = int(port or 80)
+        self.image = p_image
+        self.encoding = p_encoding
+
+    def _download(self, p_results: list[dict[str, Any]]) -> None:
+        """
+        Thread target downloading the image once.
+
+        :param p_results: The list the size and the duration are appended to
+        :type p_results: list[dict]
+        """
+        start = time.monotonic()
+        size = 0
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            connection.request(
+                "GET", f"/downloadimage/{self.image}?encoding={self.encoding}"
+            )
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            while chunk := response.read(self.READ_SIZE):
+                size += len(chunk)
+        finally:
+            connection.close()
+        p_results.append({"size": size, "duration": time.monotonic() - start})
+
+    def getMemoryTier(self) -> dict[str, Any]:
+        """
+        Get the content of the memory tier of the server.
+
+        :return: The status of the memory tier
+        :rtype: dict
+        """
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        try:
+            connection.request("GET", "/image/memory-tier")
+            return json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+    @staticmethod
+    def dropCache(p_path: str) -> None:
+        """
+        Drop the page cache of a file.
+
+        :param p_path: The file
+        :type p_path: str
+        """
+        fd = os.open(p_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def run(self, p_concurrency: int, p_coldCache: Optional[str]) -> dict[str, Any]:
+        """
+        Run a round of concurrent downloads.
+
+        :param p_concurrency: The number of downloads at once
+        :type p_concurrency: int
+        :param p_coldCache: A local path of the image to drop from the page
+            cache before the round
+        :type p_coldCache: str
+
+        :return: The number of downloads, the bytes and the throughput
+        :rtype: dict
+        """
+        if p_coldCache is not None:
+            self.dropCache(p_coldCache)
+        results: list[dict[str, Any]] = []
+        threads = [
+            threading.Thread(target=self._download, args=(results,))
+            for _ in range(p_concurrency)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+        size = sum(result["size"] for result in results)
+
+        return {
+            "concurrency": p_concurrency,
+            "completed": len(results),
+            "bytes": size,
+            "seconds": round(duration, 3),
+            "MBps": round(size / duration / 1000 / 1000, 1),
+            "slowestSeconds": (
+                round(max(result["duration"] for result in results), 3)
+                if results
+                else None
+            ),
+        }
+
+
+def main() -> None:
+    """
+    Run the benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description=ImageDownloadBenchmark.__doc__)
+    parser.add_argument("--server", required=True, help="<host>:<port>")
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--encoding", default="xz")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--cold-cache",
+        help="Local path of the image, dropped from the page cache before every round",
+    )
+    args = parser.parse_args()
+
+    benchmark = ImageDownloadBenchmark(args.server, args.image, args.encoding)
+    tier = benchmark.getMemoryTier()
+    served = args.image if args.encoding == "xz" else f"{args.image}.{args.encoding}"
+    inTier = any(file["file"] == served for file in tier["files"])
+    logging.info(f"Memory tier: {'serving' if inTier else 'not serving'} the image")
+    for concurrency in args.concurrency:
+        logging.info(json.dumps(benchmark.run(concurrency, args.cold_cache)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable
+import logging
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+)
+
+from projectManager import ProjectManager
+from resultManager import ResultManager
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ManagerBenchmark:
+    """
+    Latency and peak memory of the operations of ResultManager and
+    ProjectManager, on synthetic histories of results and of projects.
+
+    Every operation is repeated until it ran for a minimal time, and its
+    median, 95th percentile and minimum durations are kept. Its peak memory
+    is measured on one more call, traced by tracemalloc, as the tracing slows
+    the calls down. The managers work in a temporary directory, the
+    configuration of the server is not touched.
+    """
+
+    directory: str
+    minTime: float
+    maxRounds: int
+    RESULTS_PER_SERIAL = 4
+    RESULT_OPERATIONS = (
+        "addResult",
+        "modifyResult",
+        "getResult",
+        "getResultsBySerial",
+        "getResults",
+    )
+    PROJECT_OPERATIONS = ("getActiveProjectName", "createProject")
+
+    def __init__(self, p_directory: str, p_minTime: float, p_maxRounds: int) -> None:
+        """
+        Constructor
+
+        :param p_directory: The temporary directory of the result and project files
+        :type p_directory: str
+        :param p_minTime: The minimal time an operation is repeated for, in seconds
+        :type p_minTime: float
+        :param p_maxRounds: The maximal number of repetitions of an operation
+        :type p_maxRounds: int
+        """
+        self.directory = p_directory
+        self.minTime = p_minTime
+        self.maxRounds = p_maxRounds
+
+    @staticmethod
+    def provisionInfo(p_serial: str, p_index: int) -> dict[str, Any]:
+        """
+        Get a synthetic result, shaped like the ones of /scriptexecute.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_index: The index of the result of the serial number
+        :type p_index: int
+
+        :return: The result
+        :rtype: dict
+        """
+        return {
+            "cmInfo": {
+                "model": "CM4",
+                "storagesize": "15269888",
+                "mac": f"d8:3a:dd:{p_serial[-6:-4]}:{p_serial[-4:-2]}:{p_serial[-2:]}",
+                "inversejumper": "0",
+                "memorysize": "4096",
+                "temp": "45.2",
+                "cid": "1501004142544433520148a1ad3e6b00",
+                "csd": "400e00325b590000e8ff7f800a400000",
+                "bootmode": "0x1",
+                "eeprom": "",
+                "eeepromsha": "",
+            },
+            "cmProvisionInfo": {
+                "projectName": f"project{p_index % 10}",
+                "image": "image_8.wic.xz",
+                "eeprom": "",
+                "starTime": f"2024-01-{1 + p_index % 28:02d} 10:00:00.000000",
+                "endTime": f"2024-01-{1 + p_index % 28:02d} 10:05:00.000000",
+                "duration": "0:05:00",
+                "state": "completed",
+                "result": p_index % 20 != 0,
+                "errorLog": "",
+            },
+        }
+
+    @classmethod
+    def timestamp(cls, p_index: int) -> str:
+        """
+        Get the timestamp key of a result.
+
+        :param p_index: The index of the result of the serial number
+        :type p_index: int
+
+        :return: The timestamp, in the format of /scriptexecute
+        :rtype: str
+        """
+        return f"202401{1 + p_index % 28:02d}_10:{p_index // 60 % 60:02d}:{p_index % 60:02d}"
+
+    def generateResults(self, p_size: int) -> str:
+        """
+        Write a synthetic result file, serial by serial so the whole history
+        is never in memory.
+
+        :param p_size: The number of results
+        :type p_size: int
+
+        :return: The path of the result file
+        :rtype: str
+        """
+        path = os.path.join(self.directory, f"results-{p_size}", "downloadResult.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        serials = max(1, p_size // self.RESULTS_PER_SERIAL)
+        with open(path, "w") as file:
+            file.write("{")
+            for serialIndex in range(serials):
+                serial = f"{serialIndex:08x}"
+                count = self.RESULTS_PER_SERIAL
+                if serialIndex == serials - 1:
+                    count = p_size - serialIndex * self.RESULTS_PER_SERIAL
+                records = {
+                    self.timestamp(index): self.provisionInfo(serial, index)
+                    for index in range(count)
+                }
+                if serialIndex:
+                    file.write(",")
+                file.write(f"{json.dumps(serial)}: {json.dumps(records, indent=4)}")
+            file.write("}")
+
+        return path
+
+    def _measure(self, p_operation: Callable[[int], Any]) -> dict[str, float]:
+        """
+        Measure an operation.
+
+        :param p_operation: The operation, called with the index of the call
+        :type p_operation: Callable[[int], Any]
+
+        :return: The median, 95th percentile and minimum durations in
+            milliseconds, the number of rounds, and the peak memory in bytes
+        :rtype: dict
+        """
+        durations: list[float] = []
+        start = time.perf_counter()
+        while len(durations) < self.maxRounds and (
+            len(durations) < 3 or time.perf_counter() - start < self.minTime
+        ):
+            callStart = time.perf_counter()
+            p_operation(len(durations))
+            durations.append((time.perf_counter() - callStart) * 1000)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            p_operation(len(durations))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        durations.sort()
+        return {
+            "median": round(statistics.median(durations), 4),
+            "p95": round(
+                durations[min(len(durations) - 1, int(len(durations) * 0.95))], 4
+            ),
+            "min": round(durations[0], 4),
+            "rounds": len(durations),
+            "peakMemory": peak,
+        }
+
+    def runResults(self, p_mode: str, p_size: int, p_path: str) -> dict[str, Any]:
+        """
+        Measure the operations of ResultManager on a copy of a result file.
+
+        :param p_mode: The storage mode, "json", "journal" or "sqlite"
+        :type p_mode: str
+        :param p_size: The number of results
+        :type p_size: int
+        :param p_path: The synthetic result file
+        :type p_path: str
+
+        :return: The measures per operation
+        :rtype: dict
+        """
+        workPath = os.path.join(self.directory, "work", "downloadResult.json")
+        shutil.rmtree(os.path.dirname(workPath), ignore_errors=True)
+        os.makedirs(os.path.dirname(workPath))
+        shutil.copyfile(p_path, workPath)
+
+        ResultManager.resultPath = workPath
+        loadStart = time.perf_counter()
+        resultManager = ResultManager()
+        if p_mode != "json":
+            resultManager.setStorageMode(p_mode)
+        loadDuration = (time.perf_counter() - loadStart) * 1000
+
+        serials = max(1, p_size // self.RESULTS_PER_SERIAL)
+        existing = lambda index: f"{index * 7919 % serials:08x}"
+        operations: dict[str, Callable[[int], Any]] = {
+            "addResult": lambda index: resultManager.addResult(
+                f"new{index:08x}",
+                {self.timestamp(0): self.provisionInfo(f"{index:08x}", 0)},
+            ),
+            "modifyResult": lambda index: resultManager.modifyResult(
+                existing(index),
+                self.timestamp(0),
+                {"cmProvisionInfo": {"state": "completed", "result": True}},
+            ),
+            "getResult": lambda index: resultManager.getResult(
+                existing(index), self.timestamp(0)
+            ),
+            "getResultsBySerial": lambda index: resultManager.getResultsBySerial(
+                existing(index)
+            ),
+            "getResults": lambda index: resultManager.getResults(),
+        }
+        measures: dict[str, Any] = {"load": {"median": round(loadDuration, 4)}}
+        try:
+            for name in self.RESULT_OPERATIONS:
+                measures[name] = self._measure(operations[name])
+                logging.info(f"{p_mode} {p_size} {name}: {measures[name]}")
+        finally:
+            resultManager.close()
+        shutil.rmtree(os.path.dirname(workPath), ignore_errors=True)
+
+        return measures
+
+    def runProjects(self, p_projects: int) -> dict[str, Any]:
+        """
+        Measure the operations of ProjectManager on a synthetic project file,
+        with the active project last.
+
+        :param p_projects: The number of projects
+        :type p_projects: int
+
+        :return: The measures per operation
+        :rtype: dict
+        """
+        configPath = os.path.join(self.directory, f"projectConfig-{p_projects}.json")
+        with open(configPath, "w") as file:
+            json.dump(
+                {
+                    f"project{index}": {
+                        "active": index == p_projects - 1,
+                        "image8Gb": f"image{index}_8.wic.xz",
+                        "image16Gb": f"image{index}_16.wic.xz",
+                        "image32Gb": f"image{index}_32.wic.xz",
+                        "cmStatusLed": -1,
+                        "cmStatusLedOnOnsuccess": False,
+                        "eeprom": "",
+                    }
+                    for index in range(p_projects)
+                },
+                file,
+                indent=4,
+            )
+
+        # ProjectManager is a singleton, start from a new instance
+        ProjectManager._instance = None
+        ProjectManager.configPath = configPath
+        projectManager = ProjectManager()
+
+        operations: dict[str, Callable[[int], Any]] = {
+            "getActiveProjectName": lambda index: projectManager.getActiveProjectName(),
+            "createProject": lambda index: projectManager.createProject(
+                f"new{index}", False, "image_8.wic.xz"
+            ),
+        }
+        measures: dict[str, Any] = {}
+        for name in self.PROJECT_OPERATIONS:
+            measures[name] = self._measure(operations[name])
+            logging.info(f"{p_projects} projects {name}: {measures[name]}")
+        os.remove(configPath)
+
+        return measures
+
+    def run(
+        self, p_modes: list[str], p_sizes: list[int], p_projects: list[int]
+    ) -> dict[str, Any]:
+        """
+        Run the benchmark.
+
+        :param p_modes: The result storage modes
+        :type p_modes: list[str]
+        :param p_sizes: The numbers of results
+        :type p_sizes: list[int]
+        :param p_projects: The numbers of projects
+        :type p_projects: list[int]
+
+        :return: The report, the measures per mode and size, and per number
+            of projects
+        :rtype: dict
+        """
+        report: dict[str, Any] = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {},
+            "projects": {},
+        }
+        for size in p_sizes:
+            logging.info(f"Generating {size} results")
+            path = self.generateResults(size)
+            for mode in p_modes:
+                report["results"].setdefault(mode, {})[str(size)] = self.runResults(
+                    mode, size, path
+                )
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        for projects in p_projects:
+            report["projects"][str(projects)] = self.runProjects(projects)
+
+        return report
+
+    @staticmethod
+    def flatten(p_report: dict[str, Any]) -> dict[str, dict[str, float]]:
+        """
+        Index the measures of a report by "<mode>/<size>/<operation>" and
+        "projects/<number>/<operation>".
+
+        :param p_report: The report
+        :type p_report: dict
+
+        :return: The measures by key
+        :rtype: dict
+        """
+        measures = {}
+        for mode, sizes in p_report["results"].items():
+            for size, operations in sizes.items():
+                for name, measure in operations.items():
+                    measures[f"{mode}/{size}/{name}"] = measure
+        for projects, operations in p_report["projects"].items():
+            for name, measure in operations.items():
+                measures[f"projects/{projects}/{name}"] = measure
+
+        return measures
+
+    @classmethod
+    def gate(
+        cls,
+        p_baseline: dict[str, Any],
+        p_report: dict[str, Any],
+        p_threshold: float,
+        p_memoryThreshold: float,
+    ) -> list[str]:
+        """
+        Compare a report with a baseline report of the same machine.
+
+        :param p_baseline: The baseline report
+        :type p_baseline: dict
+        :param p_report: The new report
+        :type p_report: dict
+        :param p_threshold: The allowed increase of the median durations, 0.25 for 25%
+        :type p_threshold: float
+        :param p_memoryThreshold: The allowed increase of the peak memories
+        :type p_memoryThreshold: float
+
+        :return: The regressions, empty if the report passes
+        :rtype: list[str]
+        """
+        baseline = cls.flatten(p_baseline)
+        regressions = []
+        for key, measure in cls.flatten(p_report).items():
+            reference = baseline.get(key)
+            if reference is None:
+                continue
+            if reference["median"] > 0:
+                change = measure["median"] / reference["median"] - 1
+                if change > p_threshold:
+                    regressions.append(
+                        f"{key}: median {reference['median']} -> "
+                        f"{measure['median']} ms ({change * 100:+.1f}%)"
+                    )
+            if reference.get("peakMemory"):
+                change = measure["peakMemory"] / reference["peakMemory"] - 1
+                if change > p_memoryThreshold:
+                    regressions.append(
+                        f"{key}: peak memory {reference['peakMemory']} -> "
+                        f"{measure['peakMemory']} bytes ({change * 100:+.1f}%)"
+                    )
+
+        return regressions
+
+
+def main() -> None:
+    """
+    Run the benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description=ManagerBenchmark.__doc__)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["json", "journal", "sqlite"],
+        default=["json", "journal", "sqlite"],
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 100000],
+        help="Numbers of results",
+    )
+    parser.add_argument("--projects", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--min-time", type=float, default=1, help="In seconds")
+    parser.add_argument("--max-rounds", type=int, default=1000)
+    parser.add_argument("--directory", help="Temporary directory, on the disk to test")
+    parser.add_argument("--output", help="JSON report file")
+    parser.add_argument("--baseline", help="JSON report to gate against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25, help="Allowed slowdown, 0.25 for 25%%"
+    )
+    parser.add_argument(
+        "--memory-threshold", type=float, default=0.25, help="Allowed memory increase"
+    )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="cmprovision-benchmark-", dir=args.directory)
+    try:
+        benchmark = ManagerBenchmark(directory, args.min_time, args.max_rounds)
+        report = benchmark.run(args.modes, args.sizes, args.projects)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = ManagerBenchmark.gate(
+                json.load(file), report, args.threshold, args.memory_threshold
+            )
+        for regression in regressions:
+            logging.error(f"Regression {regression}")
+        if regressions:
+            sys.exit(1)
+        logging.info("No regression")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import lzma
+import os
+import queue
+import threading
+from typing import Any, Optional
+from fileCatalog import FileCatalog
+from fileLock import FileLock
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class BlockMapManager:
+    """
+    Block maps of the xz images, listing the ranges of the uncompressed image
+    holding data, with their SHA256 checksum.
+
+    The images are decompressed and analysed by a background thread after
+    their upload. The map of an image is stored next to it in
+    "<image>.bmap" and is only valid for the SHA256 checksum of the image it
+    was built from, a map of a replaced image is rebuilt.
+
+    Zero blocks separated by less than MIN_GAP bytes are kept in the ranges,
+    so the provisioning script does not spend more time starting a write
+    than it saves by skipping them.
+    """
+
+    catalog: FileCatalog
+    maps: dict[str, dict[str, Any]]
+    BLOCK_SIZE = 4096
+    MIN_GAP = 1024 * 1024
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, p_catalog: FileCatalog) -> None:
+        """
+        Constructor
+
+        :param p_catalog: The catalog of the images
+        :type p_catalog: FileCatalog
+        """
+        self.catalog = p_catalog
+        self.maps = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[Optional[str]] = queue.Queue()
+        self._pending: set[str] = set()
+        self._invalid: dict[str, str] = {}
+        self._stopEvent = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def mapPath(p_imagePath: str) -> str:
+        """
+        Get the path of the block map of an image.
+
+        :param p_imagePath: The image file
+        :type p_imagePath: str
+
+        :return: The block map file
+        :rtype: str
+        """
+        return f"{p_imagePath}.bmap"
+
+    @staticmethod
+    def lockPath(p_imagePath: str) -> str:
+        """
+        Get the lock file held while the block map of an image is built.
+
+        :param p_imagePath: The image file
+        :type p_imagePath: str
+
+        :return: The lock file, hidden from the catalog
+        :rtype: str
+        """
+        return os.path.join(
+            os.path.dirname(p_imagePath), f".{os.path.basename(p_imagePath)}.bmap.lock"
+        )
+
+    @classmethod
+    def analyse(
+        cls, p_path: str, p_stopEvent: Optional[threading.Event] = None
+    ) -> Optional[dict[str, Any]]:
+        """
+        Decompress a xz image and list the ranges of blocks holding data.
+
+        :param p_path: The xz image file
+        :type p_path: str
+        :param p_stopEvent: An event interrupting the analysis when set
+        :type p_stopEvent: threading.Event
+
+        :return: The block size, the image size, the mapped size and the
+            [first block, block count, SHA256 checksum] ranges, None if
+            interrupted
+        :rtype: dict
+
+        :raises lzma.LZMAError: If the image is not a valid xz file
+        """
+        blockSize = cls.BLOCK_SIZE
+        minGapBlocks = cls.MIN_GAP // blockSize
+        zeroBlock = bytes(blockSize)
+        zeroRead = bytes(cls.READ_SIZE)
+        ranges: list[list[Any]] = []
+        state: dict[str, Any] = {
+            "block": 0,
+            "start": None,
+            "hash": hashlib.sha256(),
+            "zeroRun": 0,
+        }
+
+        def closeRange() -> None:
+            ranges.append(
+                [
+                    state["start"],
+                    state["block"] - state["zeroRun"] - state["start"],
+                    state["hash"].hexdigest(),
+                ]
+            )
+
+        def addBlock(p_chunk: bytes) -> None:
+            if p_chunk.count(0) == len(p_chunk):
+                state["zeroRun"] += 1
+            else:
+                if state["start"] is None:
+                    state["start"] = state["block"]
+                elif state["zeroRun"] >= minGapBlocks:
+                    closeRange()
+                    state["start"] = state["block"]
+                    state["hash"] = hashlib.sha256()
+                else:
+                    # Short gaps are written, so they are part of the range
+                    state["hash"].update(zeroBlock * state["zeroRun"])
+                state["zeroRun"] = 0
+                state["hash"].update(p_chunk)
+            state["block"] += 1
+
+        imageSize = 0
+        with lzma.open(p_path, "rb") as file:
+            pending = b""
+            while data := file.read(cls.READ_SIZE):
+                if p_stopEvent is not None and p_stopEvent.is_set():
+                    return None
+                imageSize += len(data)
+                if data == zeroRead and not pending:
+                    state["zeroRun"] += len(data) // blockSize
+                    state["block"] += len(data) // blockSize
+                    continue
+                data = pending + data
+                end = len(data) - len(data) % blockSize
+                pending = data[end:]
+                for offset in range(0, end, blockSize):
+                    addBlock(data[offset : offset + blockSize])
+            # The last block of the image may be partial
+            if pending:
+                addBlock(pending)
+
+        if state["start"] is not None:
+            closeRange()
+
+        mappedSize = sum(count for _, count, _ in ranges) * blockSize
+        return {
+            "blockSize": blockSize,
+            "imageSize": imageSize,
+            "mappedSize": min(mappedSize, imageSize),
+            "ranges": ranges,
+        }
+
+    def _loadMap(self, p_entry: dict[str, Any]) -> Optional[dict[str, Any]]:
+        """
+        Read the stored block map of an image.
+
+        :param p_entry: The catalog entry of the image
+        :type p_entry: dict
+
+        :return: The block map, None if missing or built for another image
+        :rtype: dict
+        """
+        try:
+            with open(self.mapPath(p_entry["path"]), "r") as file:
+                blockMap = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if blockMap.get("sha256sum") != p_entry["sha256sum"]:
+            return None
+
+        return blockMap
+
+    def _analyseImage(
+        self, p_name: str, p_entry: dict[str, Any]
+    ) -> Optional[dict[str, Any]]:
+        """
+        Build and store the block map of an image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_entry: The catalog entry of the image
+        :type p_entry: dict
+
+        :return: The block map, None if interrupted
+        :rtype: dict
+        """
+        logging.info(f"Building the block map of {p_name}")
+        try:
+            blockMap = self.analyse(p_entry["path"], self._stopEvent)
+        except (lzma.LZMAError, EOFError):
+            # Not rebuilt until the image changes
+            with self._lock:
+                self._invalid[p_name] = p_entry["sha256sum"]
+            raise
+        if blockMap is None:
+            return None
+        blockMap["sha256sum"] = p_entry["sha256sum"]
+        mapPath = self.mapPath(p_entry["path"])
+        tmpPath = os.path.join(
+            os.path.dirname(mapPath), f".{os.path.basename(mapPath)}.tmp"
+        )
+        with open(tmpPath, "w") as file:
+            json.dump(blockMap, file)
+        os.replace(tmpPath, mapPath)
+        logging.info(
+            f"Block map of {p_name}: {blockMap['mappedSize']} of "
+            f"{blockMap['imageSize']} bytes mapped in "
+            f"{len(blockMap['ranges'])} ranges"
+        )
+
+        return blockMap
+
+    def _build(self, p_name: str) -> None:
+        """
+        Build and store the block map of an image, if not up to date.
+
+        :param p_name: The image file name
+        :type p_name: str
+        """
+        entry = self.catalog.get(p_name)
+        if entry is None or entry["sha256sum"] is None:
+            return
+        blockMap = self._loadMap(entry)
+        if blockMap is None:
+            # Built by one of the worker processes, loaded by the others
+            with FileLock(self.lockPath(entry["path"]), self._stopEvent):
+                blockMap = self._loadMap(entry) or self._analyseImage(p_name, entry)
+            if blockMap is None:
+                return
+
+        with self._lock:
+            self.maps[p_name] = blockMap
+
+    def _run(self) -> None:
+        """
+        Thread target building the scheduled block maps.
+        """
+        while True:
+            name = self._queue.get()
+            if name is None or self._stopEvent.is_set():
+                return
+            try:
+                self._build(name)
+            except InterruptedError:
+                # Stopped while another process was building it
+                pass
+            except Exception as e:
+                logging.error(f"Error building the block map of {name}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(name)
+
+    def schedule(self, p_name: str) -> None:
+        """
+        Schedule the build of the block map of a xz image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        """
+        if not p_name.endswith(".xz"):
+            return
+        with self._lock:
+            if p_name in self._pending:
+                return
+            self._pending.add(p_name)
+        self._queue.put(p_name)
+
+    def get(self, p_name: str) -> Optional[dict[str, Any]]:
+        """
+        Get the block map of an image. A missing or outdated map is scheduled
+        to be built.
+
+        :param p_name: The image file name
+        :type p_name: str
+
+        :return: The block map, None if not available yet
+        :rtype: dict
+        """
+        entry = self.catalog.get(p_name)
+        if entry is None:
+            return None
+        blockMap = self.maps.get(p_name)
+        if blockMap is not None and blockMap["sha256sum"] == entry["sha256sum"]:
+            return blockMap
+        if self._invalid.get(p_name) != entry["sha256sum"]:
+            self.schedule(p_name)
+
+        return None
+
+    def remove(self, p_name: str, p_imagePath: str) -> None:
+        """
+        Remove the block map of a deleted image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_imagePath: The image file
+        :type p_imagePath: str
+        """
+        with self._lock:
+            self.maps.pop(p_name, None)
+            self._invalid.pop(p_name, None)
+        if os.path.exists(self.mapPath(p_imagePath)):
+            os.remove(self.mapPath(p_imagePath))
+
+    @staticmethod
+    def render(p_blockMap: dict[str, Any]) -> str:
+        """
+        Render a block map for the provisioning script: a
+        "<block size> <image size>" line, then one
+        "<first block> <block count> <SHA256 checksum>" line per range.
+
+        :param p_blockMap: The block map
+        :type p_blockMap: dict
+
+        :return: The rendered block map
+        :rtype: str
+        """
+        lines = [f"{p_blockMap['blockSize']} {p_blockMap['imageSize']}"]
+        lines.extend(
+            f"{start} {count} {sha256sum}"
+            for start, count, sha256sum in p_blockMap["ranges"]
+        )
+
+        return "\n".join(lines) + "\n"
+
+    def start(self) -> None:
+        """
+        Start the build thread, and schedule the images without a block map.
+        """
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        for name in self.catalog.list():
+            self.schedule(name)
+
+    def stop(self) -> None:
+        """
+        Stop the build thread, interrupting the map being built.
+        """
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
+import os
 import yaml
 import signal
 import uvicorn
 from multiprocessing import Process
+from fastapi import FastAPI
 from dnmasq import Dnsmasq
 from hosInterface import HosInterface
 from httpServer import HttpServer
+from workerHub import WorkerHub
 import logging
 
 logging.basicConfig(
@@ -34,6 +37,19 @@ class CmProvisionServer:
         self.serverIp = ""
         self.dhcpRange = ""
         self.port = 0
+        self.resultStorage: dict = {}
+        self.resultRetention: dict = {}
+        self.catalogReconcileInterval = 30.0
+        self.sparseWrite = False
+        self.imageEncoding: dict = {}
+        self.multicast: dict = {}
+        self.downloadScheduling: dict = {}
+        self.memoryTier: dict = {}
+        self.telemetryInterval = 10
+        self.websocket: dict = {}
+        self.ioWorkers = 4
+        self.loopWatchdogThreshold = 0.1
+        self.httpWorkers = 1
         self.httpServer: HttpServer = HttpServer()
         self._loadConfig()
 
@@ -48,18 +64,178 @@ class CmProvisionServer:
         self.serverIp = config["cmProvisionServer"]["serverIp"]
         self.dhcpRange = config["cmProvisionServer"]["dhcpRange"]
         self.port = config["cmProvisionServer"]["restApiPort"]
+        self.resultStorage = config["cmProvisionServer"].get("resultStorage", {})
+        self.resultRetention = config["cmProvisionServer"].get("resultRetention", {})
+        self.catalogReconcileInterval = float(
+            config["cmProvisionServer"].get("catalogReconcileInterval", 30)
+        )
+        self.sparseWrite = bool(config["cmProvisionServer"].get("sparseWrite", False))
+        self.imageEncoding = config["cmProvisionServer"].get("imageEncoding", {})
+        self.multicast = config["cmProvisionServer"].get("multicast", {})
+        self.downloadScheduling = config["cmProvisionServer"].get(
+            "downloadScheduling", {}
+        )
+        self.memoryTier = config["cmProvisionServer"].get("memoryTier", {})
+        self.telemetryInterval = int(
+            config["cmProvisionServer"].get("telemetryInterval", 10)
+        )
+        self.websocket = config["cmProvisionServer"].get("websocket", {})
+        self.ioWorkers = int(config["cmProvisionServer"].get("ioWorkers", 4))
+        self.loopWatchdogThreshold = float(
+            config["cmProvisionServer"].get("loopWatchdogThreshold", 0.1)
+        )
+        self.httpWorkers = int(config["cmProvisionServer"].get("httpWorkers", 1))
 
-    def startHttpServer(self):
+    def getWorkerCount(self) -> int:
         """
-        Starts the FastAPI HTTP server in a separate process.
+        Get the number of HTTP worker processes.
+
+        :return: The number of workers
+        :rtype: int
+        """
+        if self.httpWorkers > 1 and self.multicast.get("enabled", False):
+            # The multicast sessions are not shared between the workers
+            logging.warning("Multicast needs a single HTTP worker, 1 worker is used")
+            return 1
+        maxTransfers = int(self.downloadScheduling.get("maxTransfers", 0))
+        if 0 < maxTransfers < self.httpWorkers:
+            # Every worker admits at least one download
+            logging.warning(
+                f"maxTransfers {maxTransfers} is lower than httpWorkers, {maxTransfers} workers are used"
+            )
+            return maxTransfers
+
+        return max(1, self.httpWorkers)
+
+    def getResultStorageMode(self, p_workers: int) -> str:
+        """
+        Get the result storage mode.
+
+        :param p_workers: The number of HTTP worker processes
+        :type p_workers: int
+
+        :return: The storage mode
+        :rtype: str
+        """
+        mode = self.resultStorage.get("mode", "json")
+        if p_workers > 1 and mode != "sqlite":
+            # The journal results are only in the memory of one process, and
+            # every worker would parse the whole json file on each change
+            logging.warning(
+                f"The {mode} mode needs a single HTTP worker, sqlite is used"
+            )
+            return "sqlite"
+
+        return mode
+
+    def configureHttpServer(self, p_workers: int) -> None:
+        """
+        Configure the HTTP server of a worker process.
+
+        :param p_workers: The number of HTTP worker processes
+        :type p_workers: int
         """
         self.httpServer.setServerIp(self.serverIp.split("/")[0])
         self.httpServer.setServerPort(self.port)
+        self.httpServer.setResultStorage(
+            self.getResultStorageMode(p_workers),
+            float(self.resultStorage.get("journalFsyncInterval", 0.05)),
+            int(self.resultStorage.get("journalCompactThreshold", 10000)),
+        )
+        self.httpServer.setResultBatching(
+            float(self.resultStorage.get("batchWindow", 0.05)),
+            int(self.resultStorage.get("batchMaxEvents", 256)),
+        )
+        self.httpServer.setIoWorkers(self.ioWorkers)
+        self.httpServer.setLoopWatchdog(self.loopWatchdogThreshold)
+        self.httpServer.setCatalogReconcileInterval(self.catalogReconcileInterval)
+        self.httpServer.setSparseWrite(self.sparseWrite)
+        self.httpServer.setImageEncodings(
+            list(self.imageEncoding.get("encodings", [])),
+            int(self.imageEncoding.get("workers", 2)),
+        )
+        self.httpServer.setTelemetryInterval(self.telemetryInterval)
+        self.httpServer.setWebsocketBroadcast(
+            int(self.websocket.get("maxQueue", 256)),
+            float(self.websocket.get("sendTimeout", 10)),
+            int(self.websocket.get("history", 1000)),
+        )
+        self.httpServer.setMemoryTier(
+            self.memoryTier.get("directory", "/dev/shm/cmprovision"),
+            int(self.memoryTier.get("budgetMb", 0)),
+        )
+        if self.multicast.get("enabled", False):
+            self.httpServer.setMulticast(
+                self.multicast.get("group", "239.255.42.1"),
+                int(self.multicast.get("port", 5400)),
+                float(self.multicast.get("rateMbps", 200)),
+                float(self.multicast.get("waitTime", 10)),
+                int(self.multicast.get("packetSize", 1400)),
+                int(self.multicast.get("fecGroup", 16)),
+                self.multicast.get("interface"),
+            )
+        # Every worker admits and queues its own downloads, the limits are
+        # rounded down so the workers never exceed them together
+        self.httpServer.setDownloadScheduling(
+            int(self.downloadScheduling.get("maxTransfers", 0)) // p_workers,
+            float(self.downloadScheduling.get("bandwidthMbps", 0)) / p_workers,
+            int(self.downloadScheduling.get("retryAfter", 5)),
+            float(self.downloadScheduling.get("queueTimeout", 30)),
+            bool(self.downloadScheduling.get("priorityRework", True)),
+            int(self.downloadScheduling.get("maxQueueWait", 3600)),
+        )
+        self.httpServer.setResultRetention(
+            float(self.resultRetention.get("maxAgeDays", 0)),
+            int(self.resultRetention.get("maxRecords", 0)),
+            float(self.resultRetention.get("checkInterval", 3600)),
+        )
+
+    def startHttpServer(self):
+        """
+        Starts the FastAPI HTTP server in a separate process. With several
+        workers, this process supervises the worker processes and relays
+        their messages with a WorkerHub.
+        """
+        workers = self.getWorkerCount()
+        if workers == 1:
+            self.configureHttpServer(1)
+            logging.info(
+                f"Starting HTTP server, API docs http://{self.httpServer.serverIp}:{self.httpServer.serverPort}/docs"
+            )
+            uvicorn.run(
+                self.httpServer.app,
+                host="0.0.0.0",
+                port=self.port,
+                log_level="info",
+                ws_per_message_deflate=bool(
+                    self.websocket.get("perMessageDeflate", True)
+                ),
+            )
+            self.httpServer.resultManager.close()
+            return
+
+        # Convert the stored results once, before the workers open them
+        self.httpServer.setResultStorage(
+            self.getResultStorageMode(workers),
+            float(self.resultStorage.get("journalFsyncInterval", 0.05)),
+            int(self.resultStorage.get("journalCompactThreshold", 10000)),
+        )
+        self.httpServer.resultManager.close()
+        hub = WorkerHub(f"/tmp/cmprovision-hub-{os.getpid()}.sock")
+        hub.start()
+        os.environ["CMPROVISION_CONFIG"] = self.configFile
+        os.environ["CMPROVISION_HUB"] = hub.socketPath
         logging.info(
-            f"Starting HTTP server, API docs http://{self.httpServer.serverIp}:{self.httpServer.serverPort}/docs"
+            f"Starting HTTP server with {workers} workers, API docs http://{self.serverIp.split('/')[0]}:{self.port}/docs"
         )
         uvicorn.run(
-            self.httpServer.app, host="0.0.0.0", port=self.port, log_level="info"
+            "cmprovisionServer:createWorkerApp",
+            factory=True,
+            workers=workers,
+            host="0.0.0.0",
+            port=self.port,
+            log_level="info",
+            ws_per_message_deflate=bool(self.websocket.get("perMessageDeflate", True)),
         )
 
     def run(self):
@@ -92,6 +268,21 @@ class CmProvisionServer:
             self.httpServerProcess.terminate()
 
 
+def createWorkerApp() -> FastAPI:
+    """
+    Build the application of an HTTP worker process, called by uvicorn in
+    every worker.
+
+    :return: The application
+    :rtype: FastAPI
+    """
+    server = CmProvisionServer(os.environ["CMPROVISION_CONFIG"])
+    server.configureHttpServer(server.getWorkerCount())
+    server.httpServer.setWorkerHub(os.environ["CMPROVISION_HUB"])
+
+    return server.httpServer.app
+
+
 if __name__ == "__main__":
     # Run the cmprovision server
     configFile: str = ""
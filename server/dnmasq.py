@@ -1,6 +1,5 @@
 import subprocess
 import threading
-import time
 import logging
 
 logging.basicConfig(
@@ -9,7 +8,7 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()],
 )
 
-from projectManager import ProjectManager
+from projectManager import ProjectManager, ProjectSnapshot
 
 
 class Dnsmasq:
@@ -28,6 +27,8 @@ class Dnsmasq:
         Constructor
         """
         self.projectManager = ProjectManager()
+        # Set while a project is active
+        self._activeProjectEvent = threading.Event()
 
     def setHostInterface(self, hostInterface: str) -> None:
         self.hostInterface = hostInterface
@@ -104,17 +105,28 @@ no-ping
         with open("/tftpboot/cmdline.txt", "w") as file:
             file.write(cmdline)
 
+    def _onProjectsChanged(self, p_snapshot: ProjectSnapshot) -> None:
+        """
+        Follow the active project, notified by the ProjectManager.
+
+        :param p_snapshot: The project configuration
+        :type p_snapshot: ProjectSnapshot
+        """
+        if p_snapshot.activeProjectName:
+            self._activeProjectEvent.set()
+        else:
+            self._activeProjectEvent.clear()
+
     def _RunInThread(self) -> None:
         """
         Thread target to run the dnsmasq process.
         """
 
         while not self._stopEvent.is_set():
-            projectName = ""
-            # Until the project name is "" and the project status is False, wait
-            while projectName == "":
-                time.sleep(0.5)
-                _, projectName = self.projectManager.getActiveProjectName()
+            # Wait for an active project
+            self._activeProjectEvent.wait()
+            if self._stopEvent.is_set():
+                break
             self._run()
 
     def start(self) -> None:
@@ -125,6 +137,8 @@ no-ping
         self._setConfig()
 
         self._stopEvent.clear()
+        self.projectManager.subscribe(self._onProjectsChanged)
+        self._onProjectsChanged(self.projectManager.getSnapshot())
         self._thread = threading.Thread(target=self._RunInThread, daemon=True)
         self._thread.start()
 
@@ -134,6 +148,9 @@ no-ping
         """
         try:
             self._stopEvent.set()
+            self.projectManager.unsubscribe(self._onProjectsChanged)
+            # Wake the thread waiting for an active project
+            self._activeProjectEvent.set()
             subprocess.run(["killall", "dnsmasq"], check=True)
             if self._thread:
                 self._thread.join()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+from starlette.responses import Response
+from starlette.types import Message, Receive, Scope, Send
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class DownloadScheduler:
+    """
+    Admission control and pacing of the image downloads of the CMs.
+
+    At most maxTransfers downloads run at once. A CM over the limit is put
+    in a FIFO queue and answered 503 with a Retry-After header, it keeps its
+    position as long as it retries within queueTimeout seconds. The rework
+    CMs, already provisioned before, are queued in a priority lane served
+    first.
+
+    The body chunks of all the running downloads are paced in a single FIFO
+    against the total bandwidth budget, so every download gets an equal
+    share of it.
+
+    The scheduler runs on the event loop, it is not thread safe.
+    """
+
+    maxTransfers: int
+    bandwidth: float
+    retryAfter: int
+    queueTimeout: float
+    active: dict[int, dict[str, Any]]
+    queue: "OrderedDict[str, dict[str, Any]]"
+
+    def __init__(
+        self,
+        p_maxTransfers: int = 0,
+        p_bandwidthMbps: float = 0,
+        p_retryAfter: int = 5,
+        p_queueTimeout: float = 30,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_maxTransfers: The maximal number of downloads at once, 0 for
+            no limit
+        :type p_maxTransfers: int
+        :param p_bandwidthMbps: The total bandwidth in Mbit/s, 0 for no limit
+        :type p_bandwidthMbps: float
+        :param p_retryAfter: The retry delay given to the queued CMs, in seconds
+        :type p_retryAfter: int
+        :param p_queueTimeout: The time after which a CM not retrying leaves the
+            queue, in seconds
+        :type p_queueTimeout: float
+        """
+        self.maxTransfers = p_maxTransfers
+        self.bandwidth = p_bandwidthMbps * 1000 * 1000 / 8
+        self.retryAfter = p_retryAfter
+        self.queueTimeout = p_queueTimeout
+        self.active = {}
+        self.queue = OrderedDict()
+        self.onChange: Optional[Callable[[dict[str, Any]], Awaitable[None]]] = None
+        self._ids = itertools.count()
+        self._nextSendTime = 0.0
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def _order(self) -> list[str]:
+        """
+        Get the queued serial numbers in order of admission.
+
+        :return: The serial numbers, priority lane first
+        :rtype: list[str]
+        """
+        priority = []
+        normal = []
+        for serial, entry in self.queue.items():
+            (priority if entry["priority"] else normal).append(serial)
+
+        return priority + normal
+
+    def _expire(self) -> None:
+        """
+        Remove the CMs which stopped retrying from the queue.
+        """
+        now = time.monotonic()
+        for serial in [
+            serial
+            for serial, entry in self.queue.items()
+            if now - entry["lastSeen"] > self.queueTimeout
+        ]:
+            logging.info(f"Download of {serial} left the queue")
+            del self.queue[serial]
+
+    def request(
+        self, p_serial: str, p_filename: str, p_priority: bool
+    ) -> tuple[Optional[dict[str, Any]], int]:
+        """
+        Request a download slot.
+
+        :param p_serial: The serial number of the CM
+        :type p_serial: str
+        :param p_filename: The downloaded file
+        :type p_filename: str
+        :param p_priority: True to queue the CM in the priority lane
+        :type p_priority: bool
+
+        :return: The transfer if admitted, otherwise None and the 1-based
+            position in the queue
+        :rtype: tuple[dict, int]
+        """
+        self._expire()
+        entry = self.queue.get(p_serial)
+        queued = entry is None
+        if entry is None:
+            entry = {"priority": p_priority, "since": datetime.now().isoformat()}
+            self.queue[p_serial] = entry
+        entry["lastSeen"] = time.monotonic()
+
+        position = self._order().index(p_serial) + 1
+        if self.maxTransfers > 0 and position > self.maxTransfers - len(self.active):
+            if queued:
+                self._notify()
+            return None, position
+
+        del self.queue[p_serial]
+        transfer = {
+            "id": next(self._ids),
+            "serial": p_serial,
+            "filename": p_filename,
+            "start": datetime.now().isoformat(),
+            "sent": 0,
+        }
+        self.active[transfer["id"]] = transfer
+        self._notify()
+
+        return transfer, 0
+
+    def release(self, p_transfer: dict[str, Any]) -> None:
+        """
+        Release the slot of a finished or interrupted download.
+
+        :param p_transfer: The transfer
+        :type p_transfer: dict
+        """
+        if self.active.pop(p_transfer["id"], None) is not None:
+            self._notify()
+
+    async def pace(self, p_transfer: dict[str, Any], p_size: int) -> None:
+        """
+        Wait for the turn of a body chunk in the bandwidth budget.
+
+        :param p_transfer: The transfer
+        :type p_transfer: dict
+        :param p_size: The chunk size in bytes
+        :type p_size: int
+        """
+        p_transfer["sent"] += p_size
+        if self.bandwidth <= 0:
+            return
+        now = time.monotonic()
+        sendTime = max(now, self._nextSendTime)
+        self._nextSendTime = sendTime + p_size / self.bandwidth
+        if sendTime > now:
+            await asyncio.sleep(sendTime - now)
+
+    def getStatus(self) -> dict[str, Any]:
+        """
+        Get the running and queued downloads.
+
+        :return: The limits, the running downloads and the queue in order
+        :rtype: dict
+        """
+        self._expire()
+        return {
+            "maxTransfers": self.maxTransfers,
+            "bandwidthMbps": self.bandwidth * 8 / (1000 * 1000),
+            "active": [
+                {
+                    "serial": transfer["serial"],
+                    "filename": transfer["filename"],
+                    "start": transfer["start"],
+                    "sent": transfer["sent"],
+                }
+                for transfer in self.active.values()
+            ],
+            "queue": [
+                {
+                    "serial": serial,
+                    "position": position,
+                    "priority": self.queue[serial]["priority"],
+                    "since": self.queue[serial]["since"],
+                }
+                for position, serial in enumerate(self._order(), start=1)
+            ],
+        }
+
+    def _notify(self) -> None:
+        """
+        Publish the status of the downloads to the change callback.
+        """
+        if self.onChange is not None:
+            task = asyncio.get_running_loop().create_task(
+                self.onChange(self.getStatus())
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+class ScheduledResponse(Response):
+    """
+    Response holding a download slot while a wrapped response is sent, with
+    its body chunks paced by the scheduler.
+    """
+
+    def __init__(
+        self,
+        p_response: Response,
+        p_scheduler: DownloadScheduler,
+        p_transfer: dict[str, Any],
+    ) -> None:
+        """
+        Constructor
+
+        :param p_response: The wrapped response
+        :type p_response: Response
+        :param p_scheduler: The scheduler
+        :type p_scheduler: DownloadScheduler
+        :param p_transfer: The admitted transfer
+        :type p_transfer: dict
+        """
+        self.response = p_response
+        self.scheduler = p_scheduler
+        self.transfer = p_transfer
+        self.status_code = p_response.status_code
+        self.raw_headers = p_response.raw_headers
+        self.background = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        async def pacedSend(message: Message) -> None:
+            if message["type"] == "http.response.body":
+                await self.scheduler.pace(self.transfer, len(message.get("body", b"")))
+            await send(message)
+
+        # Only the wrapped response may send the file itself
+        scope = dict(scope)
+        scope["extensions"] = {
+            key: value
+            for key, value in scope.get("extensions", {}).items()
+            if key != "http.response.pathsend"
+        }
+        try:
+            await self.response(scope, receive, pacedSend)
+        finally:
+            self.scheduler.release(self.transfer)
+            if self.background is not None:
+                await self.background()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import threading
+from datetime import datetime
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class FileCatalog:
+    """
+    In-process catalog of the files of a directory (images or EEPROMs) with
+    their size, SHA256 checksum, modification time and, for xz files, their
+    uncompressed size.
+
+    The catalog is built once, updated by the upload and delete routes, and
+    reconciled periodically with the directory by comparing the file stats,
+    so the files changed out of band are taken into account. The entries are
+    replaced as a whole, the readers never see a partial update.
+    """
+
+    directory: str
+    entries: dict[str, dict[str, Any]]
+
+    def __init__(self, p_directory: str) -> None:
+        """
+        Constructor
+
+        :param p_directory: The directory of the files
+        :type p_directory: str
+        """
+        self.directory = p_directory
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _readMultibyteInt(p_buffer: bytes, p_offset: int) -> tuple[int, int]:
+        """
+        Decode a variable length integer of the xz format.
+
+        :param p_buffer: The buffer
+        :type p_buffer: bytes
+        :param p_offset: The offset of the integer
+        :type p_offset: int
+
+        :return: The integer and the offset following it
+        :rtype: tuple[int, int]
+        """
+        value = 0
+        shift = 0
+        while True:
+            byte = p_buffer[p_offset]
+            p_offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, p_offset
+            shift += 7
+            if shift > 63:
+                raise ValueError("Invalid xz multibyte integer")
+
+    @staticmethod
+    def xzUncompressedSize(p_path: str) -> Optional[int]:
+        """
+        Get the uncompressed size of a xz file from its indexes, without
+        decompressing it.
+
+        :param p_path: The xz file
+        :type p_path: str
+
+        :return: The uncompressed size, None if not a valid xz file
+        :rtype: int
+        """
+        try:
+            with open(p_path, "rb") as file:
+                end = file.seek(0, os.SEEK_END)
+                total = 0
+                while end > 0:
+                    # Skip the stream padding
+                    file.seek(end - 4)
+                    while end >= 4 and file.read(4) == b"\x00\x00\x00\x00":
+                        end -= 4
+                        file.seek(end - 4)
+                    if end < 12:
+                        break
+                    file.seek(end - 12)
+                    footer = file.read(12)
+                    if footer[10:12] != b"YZ":
+                        return None
+                    backwardSize = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+                    file.seek(end - 12 - backwardSize)
+                    index = file.read(backwardSize)
+                    if index[0] != 0x00:
+                        return None
+                    count, offset = FileCatalog._readMultibyteInt(index, 1)
+                    streamSize = 0
+                    for _ in range(count):
+                        unpaddedSize, offset = FileCatalog._readMultibyteInt(
+                            index, offset
+                        )
+                        uncompressedSize, offset = FileCatalog._readMultibyteInt(
+                            index, offset
+                        )
+                        total += uncompressedSize
+                        streamSize += (unpaddedSize + 3) & ~3
+                    # Stream header + blocks + index + stream footer
+                    end -= 12 + streamSize + backwardSize + 12
+                return total
+        except (OSError, IndexError, ValueError, struct.error):
+            return None
+
+    def _isCatalogued(self, p_file: str) -> bool:
+        """
+        Check if a directory entry is a catalogued file.
+
+        :param p_file: The file name
+        :type p_file: str
+
+        :return: True if the file belongs to the catalog
+        :rtype: bool
+        """
+        return not p_file.startswith(".") and not p_file.endswith(
+            (".sha256sum", ".bmap")
+        )
+
+    def _buildEntry(
+        self, p_name: str, p_previous: Optional[dict[str, Any]] = None
+    ) -> Optional[dict[str, Any]]:
+        """
+        Build the entry of a file, reusing the previous entry if unchanged.
+
+        :param p_name: The file name
+        :type p_name: str
+        :param p_previous: The previous entry of the file
+        :type p_previous: dict
+
+        :return: The entry, None if the file does not exist
+        :rtype: dict
+        """
+        path = os.path.join(self.directory, p_name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        try:
+            sha256Stat = os.stat(f"{path}.sha256sum")
+            sha256Signature: Optional[tuple[int, int]] = (
+                sha256Stat.st_mtime_ns,
+                sha256Stat.st_size,
+            )
+        except FileNotFoundError:
+            sha256Stat = None
+            sha256Signature = None
+
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns, sha256Signature)
+        if p_previous is not None and p_previous["_signature"] == signature:
+            return p_previous
+
+        sha256sum = None
+        upload = None
+        if sha256Stat is not None:
+            with open(f"{path}.sha256sum", "r") as file:
+                sha256sum = file.read().strip()
+            upload = datetime.fromtimestamp(sha256Stat.st_mtime).strftime(
+                "%Y-%m-%d_%H:%M:%S"
+            )
+
+        return {
+            "name": p_name,
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256sum": sha256sum,
+            "upload": upload,
+            "uncompressedSize": (
+                self.xzUncompressedSize(path) if p_name.endswith(".xz") else None
+            ),
+            "_signature": signature,
+        }
+
+    def scan(self) -> None:
+        """
+        Reconcile the catalog with the directory.
+        """
+        try:
+            files = [
+                file for file in os.listdir(self.directory) if self._isCatalogued(file)
+            ]
+        except FileNotFoundError:
+            files = []
+
+        with self._lock:
+            previous = self.entries
+            entries = {}
+            for file in files:
+                entry = self._buildEntry(file, previous.get(file))
+                if entry is not None:
+                    entries[file] = entry
+            if entries.keys() != previous.keys():
+                logging.info(f"Catalog of {self.directory}: {len(entries)} files")
+            self.entries = entries
+
+    def refresh(self, p_name: str) -> Optional[dict[str, Any]]:
+        """
+        Update the entry of a file, after an upload or a deletion.
+
+        :param p_name: The file name
+        :type p_name: str
+
+        :return: The entry, None if the file does not exist
+        :rtype: dict
+        """
+        if not self._isCatalogued(p_name) or os.path.basename(p_name) != p_name:
+            return None
+        with self._lock:
+            entry = self._buildEntry(p_name, self.entries.get(p_name))
+            entries = dict(self.entries)
+            if entry is None:
+                entries.pop(p_name, None)
+            else:
+                entries[p_name] = entry
+            self.entries = entries
+
+        return entry
+
+    def get(self, p_name: str) -> Optional[dict[str, Any]]:
+        """
+        Get the entry of a file. A file missing from the catalog is looked up
+        on disk, in case it was added since the last reconciliation.
+
+        :param p_name: The file name
+        :type p_name: str
+
+        :return: The entry, None if the file does not exist
+        :rtype: dict
+        """
+        entry = self.entries.get(p_name)
+        if entry is None:
+            entry = self.refresh(p_name)
+
+        return entry
+
+    def exists(self, p_name: str) -> bool:
+        """
+        Check if a file exists.
+
+        :param p_name: The file name
+        :type p_name: str
+
+        :return: True if the file exists
+        :rtype: bool
+        """
+        return self.get(p_name) is not None
+
+    def list(self) -> dict[str, dict[str, Any]]:
+        """
+        List the files with a SHA256 checksum.
+
+        :return: The public fields of the entries, by file name
+        :rtype: dict
+        """
+        return {
+            name: {
+                "upload": entry["upload"],
+                "sha256sum": entry["sha256sum"],
+                "size": entry["size"],
+                "uncompressedSize": entry["uncompressedSize"],
+            }
+            for name, entry in self.entries.items()
+            if entry["sha256sum"] is not None
+        }
+
+    def _runReconcile(self, p_interval: float) -> None:
+        """
+        Thread target reconciling the catalog periodically.
+
+        :param p_interval: The period in seconds
+        :type p_interval: float
+        """
+        while not self._stopEvent.wait(p_interval):
+            try:
+                self.scan()
+            except Exception as e:
+                logging.error(f"Error reconciling the catalog of {self.directory}: {e}")
+
+    def start(self, p_interval: float) -> None:
+        """
+        Build the catalog and start its periodic reconciliation.
+
+        :param p_interval: The period of the reconciliation in seconds
+        :type p_interval: float
+        """
+        self.scan()
+        self._stopEvent.clear()
+        self._thread = threading.Thread(
+            target=self._runReconcile, args=(p_interval,), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the periodic reconciliation.
+        """
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
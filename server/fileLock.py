@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import fcntl
+import os
+import threading
+from types import TracebackType
+from typing import IO, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class FileLock:
+    """
+    Exclusive lock shared by the processes of the server, held on a lock file
+    while the file it protects is built or rewritten.
+
+    Used as a context manager. With a stop event, the lock is polled so a
+    thread waiting for another process can be stopped.
+    """
+
+    path: str
+    POLL_INTERVAL = 0.5
+
+    def __init__(
+        self, p_path: str, p_stopEvent: Optional[threading.Event] = None
+    ) -> None:
+        """
+        Constructor
+
+        :param p_path: The lock file, created if missing
+        :type p_path: str
+        :param p_stopEvent: Interrupts the wait for the lock when set
+        :type p_stopEvent: threading.Event
+        """
+        self.path = p_path
+        self.stopEvent = p_stopEvent
+        self._file: Optional[IO[str]] = None
+
+    def __enter__(self) -> "FileLock":
+        """
+        Wait for the lock.
+
+        :raises InterruptedError: If the stop event is set while waiting
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a")
+        try:
+            if self.stopEvent is None:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+                return self
+            while True:
+                try:
+                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return self
+                except BlockingIOError:
+                    if self.stopEvent.wait(self.POLL_INTERVAL):
+                        raise InterruptedError(f"Stopped waiting for {self.path}")
+        except BaseException:
+            self._file.close()
+            self._file = None
+            raise
+
+    def __exit__(
+        self,
+        p_type: Optional[type[BaseException]],
+        p_value: Optional[BaseException],
+        p_traceback: Optional[TracebackType],
+    ) -> None:
+        """
+        Release the lock.
+        """
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
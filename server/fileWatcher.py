@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from typing import Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class FileWatcher:
+    """
+    Notification of the changes of a file, written in place or replaced by
+    another file, by any process.
+
+    The directory of the file is watched with inotify. Where inotify is not
+    available, every wait reports a possible change after the timeout, so
+    the caller checks the file periodically instead.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    path: str
+    inotify: bool
+
+    def __init__(self, p_path: str, p_stopEvent: threading.Event) -> None:
+        """
+        Constructor
+
+        :param p_path: The watched file
+        :type p_path: str
+        :param p_stopEvent: Interrupts the wait for a change when set
+        :type p_stopEvent: threading.Event
+        """
+        self.path = p_path
+        self.stopEvent = p_stopEvent
+        self.inotify = False
+        self._fd: Optional[int] = None
+        # Wakes the wait for the inotify events when stopping
+        self._wakeRead, self._wakeWrite = os.pipe()
+
+    def open(self) -> None:
+        """
+        Start watching the file.
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = (
+                self.IN_CLOSE_WRITE
+                | self.IN_MOVED_FROM
+                | self.IN_MOVED_TO
+                | self.IN_CREATE
+                | self.IN_DELETE
+            )
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, f"inotify_add_watch of {directory} failed")
+        except (AttributeError, OSError, TypeError) as e:
+            logging.warning(f"inotify not available, {self.path} is polled: {e}")
+            return
+        self._fd = fd
+        self.inotify = True
+
+    def wait(self, p_timeout: float) -> bool:
+        """
+        Wait for a change of the file.
+
+        :param p_timeout: The maximal waiting time in seconds
+        :type p_timeout: float
+
+        :return: True if the file may have changed, False on timeout or stop
+        :rtype: bool
+        """
+        if self._fd is None:
+            return not self.stopEvent.wait(p_timeout)
+        readable, _, _ = select.select([self._fd, self._wakeRead], [], [], p_timeout)
+        if self._fd not in readable or self.stopEvent.is_set():
+            return False
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+        name = os.path.basename(self.path)
+        changed = False
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            eventName = (
+                data[offset : offset + length].rstrip(b"\0").decode(errors="replace")
+            )
+            offset += length
+            if eventName == name or mask & self.IN_Q_OVERFLOW:
+                changed = True
+
+        return changed
+
+    def wake(self) -> None:
+        """
+        Interrupt the current wait, after the stop event is set.
+        """
+        os.write(self._wakeWrite, b"\0")
+
+    def close(self) -> None:
+        """
+        Stop watching the file.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.close(self._wakeRead)
+        os.close(self._wakeWrite)
+        self.inotify = False
@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 
 from fastapi import FastAPI, UploadFile, Form, HTTPException, Query, File
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import PlainTextResponse
-from starlette.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import PlainTextResponse, Response
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
 import hashlib
+import itertools
+import json
 import os
+import time
+import uuid
 import asyncio
 from collections import defaultdict
-from datetime import datetime
-from projectManager import ProjectManager
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from projectManager import ProjectManager, ProjectSnapshot
 from resultManager import ResultManager
-from typing import Optional
+from fileCatalog import FileCatalog
+from blockMapManager import BlockMapManager
+from imageEncoder import ImageEncoder
+from multicastDistribution import MulticastSender
+from downloadScheduler import DownloadScheduler, ScheduledResponse
+from imageMemoryTier import ImageMemoryTier
+from ioExecutor import IoExecutor
+from loopWatchdog import LoopWatchdog
+from phaseTelemetry import PhaseTelemetry
+from provisioningEventBus import ProvisioningEvent, ProvisioningEventBus
+from provisioningPlan import ProvisioningPlan, ProvisioningPlanCache
+from serverMetrics import MetricsMiddleware, ServerMetrics
+from resultQuery import ResultQuery
+from uploadSessionManager import UploadSessionManager
+from websocketBroadcaster import WebsocketBroadcaster
+from workerHub import WorkerHubClient
+from typing import Any, AsyncIterator, BinaryIO, Iterator, Optional
 import logging
 
 logging.basicConfig(
@@ -24,11 +45,19 @@ logging.basicConfig(
 class HttpServer:
     serverIp: str
     serverPort: int
-    imageName: str
-    eeprom: str
-    cmStatusLed: str
-    cmStatusLedOnOnsuccess: str
-    activeWebsockets: list
+    websocketBroadcaster: WebsocketBroadcaster
+    hub: Optional[WorkerHubClient]
+    retentionInterval: float
+    catalogReconcileInterval: float
+    sparseWrite: bool
+    imageEncodingWorkers: int
+    priorityRework: bool
+    maxQueueWait: int
+    telemetryInterval: int
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    # The results streamed are read and written by pages
+    RESULT_PAGE_SIZE = 100
+    WEBSOCKET_SNAPSHOT_HOURS = 24
 
     def __init__(
         self,
@@ -37,17 +66,106 @@ class HttpServer:
         Initialize the FastAPI application.
         """
         self.serverIp = ""
-        self.cmStatusLed = "NONE"
-        self.cmStatusLedOnOnsuccess = "0"
-        self.app = FastAPI(title="CM Provision Server", version="1.0.0")
+        self.serverPort = 0
+        self.app = FastAPI(
+            title="CM Provision Server", version="1.0.0", lifespan=self._lifespan
+        )
+        self.app.add_middleware(MetricsMiddleware)
         self.projectManager = ProjectManager()
+        self.provisioningPlans = ProvisioningPlanCache(
+            self.projectManager, self._renderScriptTemplate
+        )
         self.resultManager = ResultManager()
-        self.imageName = ""
-        self.eeprom = ""
-        self.activeWebsockets = []
+        self.io = IoExecutor()
+        self.loopWatchdog = LoopWatchdog()
+        self.imageUploadSessions = UploadSessionManager("/uploads")
+        self.imageCatalog = FileCatalog("/uploads")
+        self.eepromCatalog = FileCatalog("/eeproms")
+        self.imageBlockMaps = BlockMapManager(self.imageCatalog)
+        self.imageEncoder = ImageEncoder("/uploads", self.imageCatalog, [])
+        self.imageEncodingWorkers = 2
+        self.imageMemoryTier = ImageMemoryTier("/dev/shm/cmprovision")
+        self.multicastSender: Optional[MulticastSender] = None
+        self.downloadScheduler = DownloadScheduler()
+        self.downloadScheduler.onChange = self._publishDownloadQueue
+        self.priorityRework = True
+        self.maxQueueWait = 3600
+        self.telemetryInterval = 10
+        self.catalogReconcileInterval = 30.0
+        self.sparseWrite = False
+        self.websocketBroadcaster = WebsocketBroadcaster()
+        self.provisioningEvents = ProvisioningEventBus(
+            self.resultManager, self.io, self._publishEvent
+        )
+        self.retentionInterval = 0
+        self.hub = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._primaryTasks: list[asyncio.Task[None]] = []
+        self._hubTasks: set[asyncio.Task[None]] = set()
 
         self.setupRoutes()
 
+    @asynccontextmanager
+    async def _lifespan(self, p_app: FastAPI) -> AsyncIterator[None]:
+        """
+        Start the background tasks of the application, and stop them on shutdown.
+
+        :param p_app: The FastAPI application
+        :type p_app: FastAPI
+        """
+        self.io.start()
+        self.loopWatchdog.start()
+        self._loop = asyncio.get_running_loop()
+        self.provisioningPlans.start()
+        self.projectManager.subscribe(self._onProjectsChanged)
+        primary = True
+        if self.hub is not None:
+            await self.hub.connect(self._onHubMessage, self._becomePrimary)
+            primary = self.hub.primary
+            if primary:
+                logging.info(f"HTTP worker {os.getpid()} is the primary worker")
+            # The events are numbered by the hub, the same in all the workers
+            self.websocketBroadcaster.stream = self.hub.stream
+            self.websocketBroadcaster.sequence = self.hub.sequence
+            self.provisioningEvents.forward = self._forwardEvent
+        self.imageMemoryTier.owner = primary
+        self.imageCatalog.start(self.catalogReconcileInterval)
+        self.eepromCatalog.start(self.catalogReconcileInterval)
+        if self.sparseWrite:
+            self.imageBlockMaps.start()
+        self.imageEncoder.start(self.imageEncodingWorkers)
+        self.imageMemoryTier.start()
+        self._preloadActiveProject()
+        if primary:
+            self._startPrimaryTasks()
+        tasks: list[asyncio.Task[None]] = [
+            asyncio.create_task(ServerMetrics.monitorEventLoop())
+        ]
+        try:
+            yield
+        finally:
+            tasks.extend(self._primaryTasks)
+            tasks.extend(self._hubTasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.hub is not None:
+                await self.hub.close()
+            self.projectManager.unsubscribe(self._onProjectsChanged)
+            self.provisioningPlans.stop()
+            await self.provisioningEvents.stop()
+            await self.websocketBroadcaster.stop()
+            await self.loopWatchdog.stop()
+            self.imageBlockMaps.stop()
+            self.imageEncoder.stop()
+            self.imageMemoryTier.stop()
+            if self.multicastSender is not None:
+                self.multicastSender.stop()
+            self.imageCatalog.stop()
+            self.eepromCatalog.stop()
+            self.io.stop()
+            ServerMetrics.markProcessDead()
+
     def setupRoutes(self):
         """
         Define the routes for the FastAPI application.
@@ -74,15 +192,13 @@ class HttpServer:
             The script is generated based on the request parameters.
             The script is sent to the Raspberry CM
             """
-            # Get the active image name
-            self._getImageActiveNameAndCmStatusLed(storagesize)
+            # Get the plan of the active project for the storage size
+            plan = self.provisioningPlans.get(storagesize)
 
             # Create a provision info dictionary
             startTime = datetime.now()
             startTimeStr = str(startTime.strftime("%Y%m%d_%H:%M:%S"))
-            _, activeProjectName = self.projectManager.getActiveProjectName()
-            provisionInfo = {}
-            provisionInfo[startTimeStr] = {
+            provisionInfo = {
                 "cmInfo": {
                     "model": model,
                     "storagesize": storagesize,
@@ -97,9 +213,9 @@ class HttpServer:
                     "eeepromsha": "",
                 },
                 "cmProvisionInfo": {
-                    "projectName": activeProjectName,
-                    "image": self.imageName,
-                    "eeprom": self.eeprom,
+                    "projectName": plan.projectName,
+                    "image": plan.imageName,
+                    "eeprom": plan.eeprom,
                     "starTime": str(startTime),
                     "endTime": "",
                     "duration": "",
@@ -109,16 +225,20 @@ class HttpServer:
                 },
             }
 
-            # Live update the WebSocket clients
-            wsDict = defaultdict(dict)
-            wsDict[serial] = provisionInfo
-            await self._publishToWebsockets(wsDict)
-
-            # store
-            self.resultManager.addResult(serial, provisionInfo)
+            # Stored and sent to the WebSocket clients in the background
+            self.provisioningEvents.emit(
+                ProvisioningEvent(
+                    ProvisioningEvent.STARTED,
+                    serial,
+                    startTimeStr,
+                    {"result": provisionInfo},
+                )
+            )
 
             # Generate a response script based on the request parameters
-            script = self._generateCm4Script(serial, startTimeStr)
+            script = self._generateCm4Script(
+                plan, serial, startTimeStr, model, memorysize
+            )
 
             return PlainTextResponse(content=script, media_type="text/plain")
 
@@ -140,7 +260,7 @@ class HttpServer:
             """
             # Ensure the directory for logs exists
             log_dir = "/logs/eeprom_versions"
-            os.makedirs(log_dir, exist_ok=True)
+            await self.io.makedirs(log_dir)
 
             # Save the uploaded EEPROM version file
             file_path = os.path.join(log_dir, f"{serial}_eeprom_version.txt")
@@ -151,22 +271,19 @@ class HttpServer:
                 decoded_content = file_content.decode("utf-8")
 
                 # Save the content to a file
-                with open(file_path, "w") as f:
-                    f.write(decoded_content)
-
-                currentProvision = self.resultManager.getResult(serial, start)
-                if currentProvision:
-                    currentProvision["cmInfo"]["eeprom"] = str(decoded_content).replace(
-                        "\n", ","
+                await self.io.writeFile(file_path, decoded_content)
+
+                self.provisioningEvents.emit(
+                    ProvisioningEvent(
+                        ProvisioningEvent.EEPROM,
+                        serial,
+                        start,
+                        {
+                            "eeprom": str(decoded_content).replace("\n", ","),
+                            "eepromsha": eepromsha,
+                        },
                     )
-                    currentProvision["cmInfo"]["eeepromsha"] = eepromsha
-                    # Save the modified result
-                    self.resultManager.modifyResult(serial, start, currentProvision)
-
-                    # Live update the WebSocket clients
-                    wsDict = defaultdict(dict)
-                    wsDict[serial][start] = currentProvision
-                    await self._publishToWebsockets(wsDict)
+                )
 
             except UnicodeDecodeError:
                 raise HTTPException(
@@ -203,38 +320,21 @@ class HttpServer:
             """
             # Construct the path to save the log file
             log_dir = "/logs"
-            os.makedirs(log_dir, exist_ok=True)  # Ensure the logs directory exists
+            await self.io.makedirs(log_dir)  # Ensure the logs directory exists
             log_path = os.path.join(log_dir, f"{serial}_{phase}.log")
 
             # Save the uploaded log file
-            with open(log_path, "wb") as f:
-                file_content = await log.read()
-                f.write(file_content)
-
-                currentTime = datetime.now()
-                currentProvision = self.resultManager.getResult(serial, start)
-                if currentProvision:
-                    # Parse `starTime` from ISO 8601-like string to datetime
-                    start_time_str = currentProvision["cmProvisionInfo"]["starTime"]
-                    start_time = datetime.fromisoformat(start_time_str)
-
-                    # Calculate duration
-                    currentProvision["cmProvisionInfo"][
-                        "endTime"
-                    ] = currentTime.isoformat()
-                    currentProvision["cmProvisionInfo"]["duration"] = str(
-                        currentTime - start_time
-                    )
-                    currentProvision["cmProvisionInfo"]["state"] = "completed"
-                    currentProvision["cmProvisionInfo"]["errorLog"] = str(file_content)
-
-                    # Save the modified result
-                    self.resultManager.modifyResult(serial, start, currentProvision)
-
-                    # Live update the WebSocket clients
-                    wsDict = defaultdict(dict)
-                    wsDict[serial][start] = currentProvision
-                    await self._publishToWebsockets(wsDict)
+            file_content = await log.read()
+            await self.io.writeFile(log_path, file_content)
+
+            self.provisioningEvents.emit(
+                ProvisioningEvent(
+                    ProvisioningEvent.FAILED,
+                    serial,
+                    start,
+                    {"phase": phase, "errorLog": str(file_content)},
+                )
+            )
 
             # Return a success response
             return JSONResponse(
@@ -247,6 +347,41 @@ class HttpServer:
                 }
             )
 
+        @self.app.post("/scriptexecute/telemetry", tags=["CM Request"])
+        async def cm_request_upload_telemetry(
+            request: Request,
+            serial: str = Query(..., description="Device serial number"),
+            start: str = Query(..., description="Start time"),
+            final: int = Query(0, description="1 for the report of the last phase"),
+            cpus: int = Query(1, ge=1, description="Number of cores of the CM"),
+        ):
+            """
+            Handle the phase timings reported by the provisioning script,
+            periodically while the image is written and at the end. The final
+            report is stored with the result, the periodic ones are only sent
+            to the WebSocket clients.
+
+            :param serial: The device serial number
+            :param start: The start time of the operation
+            :param final: 1 for the final report
+            :param cpus: The number of cores of the CM
+            """
+            report = (await request.body()).decode("utf-8", errors="replace")
+            telemetry = {
+                "final": bool(final),
+                "phases": PhaseTelemetry.parse(report, cpus),
+            }
+
+            self.provisioningEvents.emit(
+                ProvisioningEvent(
+                    ProvisioningEvent.TELEMETRY, serial, start, {"telemetry": telemetry}
+                )
+            )
+
+            return JSONResponse(
+                content={"message": "Telemetry received", "serial": serial}
+            )
+
         @self.app.get("/scriptexecute/alldone", tags=["CM Request"])
         async def cm_request_provisioning_done(
             serial: str,
@@ -264,27 +399,9 @@ class HttpServer:
             :param verify: The verification status
             :param start: The start time of the operation
             """
-            currentTime = datetime.now()
-            currentProvision = self.resultManager.getResult(serial, start)
-            if currentProvision:
-                # Parse `starTime` from ISO 8601-like string to datetime
-                start_time_str = currentProvision["cmProvisionInfo"]["starTime"]
-                start_time = datetime.fromisoformat(start_time_str)
-
-                # Calculate duration
-                currentProvision["cmProvisionInfo"]["endTime"] = currentTime.isoformat()
-                currentProvision["cmProvisionInfo"]["duration"] = str(
-                    currentTime - start_time
-                )
-                currentProvision["cmProvisionInfo"]["state"] = "completed"
-                currentProvision["cmProvisionInfo"]["result"] = True
-                # Save the modified result
-                self.resultManager.modifyResult(serial, start, currentProvision)
-
-                # Live update the WebSocket clients
-                wsDict = defaultdict(dict)
-                wsDict[serial][start] = currentProvision
-                await self._publishToWebsockets(wsDict)
+            self.provisioningEvents.emit(
+                ProvisioningEvent(ProvisioningEvent.COMPLETED, serial, start)
+            )
 
             return {
                 "message": "All done request handled successfully",
@@ -294,25 +411,139 @@ class HttpServer:
                 "verify": verify,
             }
 
-        @self.app.get("/downloadimage/{filename}", tags=["CM Request"])
-        async def cm_request_server_the_image(filename: str):
+        @self.app.api_route(
+            "/downloadimage/{filename}", methods=["GET", "HEAD"], tags=["CM Request"]
+        )
+        async def cm_request_server_the_image(
+            filename: str,
+            request: Request,
+            encoding: str = Query("xz", description="xz, zstd, lz4 or raw"),
+            serial: Optional[str] = Query(None, description="Device serial number"),
+        ):
             """
-            Serve the requested image file.
+            Serve the requested image file. Byte ranges and If-Range are
+            supported, the strong ETag is the SHA256 checksum of the image.
+            A request with an If-Match header not matching the ETag is
+            rejected with 412, so a resumed download never mixes two images.
+
+            The downloads of the CMs, identified by their serial number, go
+            through the download scheduler. A CM over the limit of downloads
+            at once gets a 503 response with its queue position and a
+            Retry-After header.
 
             :param filename: The name of the file to serve.
+            :param encoding: The encoding of the image, xz is the uploaded file.
+            :param serial: The serial number of the downloading CM.
             """
-            # Construct the full path to the file
-            file_path = f"/uploads/{filename}"
-
             # Check if the file exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.imageCatalog, filename)
+            if entry is not None and encoding != "xz":
+                entry = self.imageEncoder.get(filename, encoding)
+            if entry is None:
                 raise HTTPException(status_code=404, detail="File not found")
 
-            # Return the file using FileResponse
-            return FileResponse(
-                file_path,
+            headers = {}
+            if entry["sha256sum"]:
+                etag = f'"{entry["sha256sum"]}"'
+                headers["ETag"] = etag
+                ifMatch = request.headers.get("if-match")
+                if ifMatch is not None and ifMatch.strip() != "*":
+                    if etag not in [tag.strip() for tag in ifMatch.split(",")]:
+                        raise HTTPException(
+                            status_code=412, detail="The image has changed"
+                        )
+
+            # Serve the copy in RAM if the image is in the memory tier
+            path = self.imageMemoryTier.resolve(filename, entry) or entry["path"]
+
+            # Return the file using FileResponse, which handles the Range and
+            # If-Range headers against the ETag
+            response = FileResponse(
+                path,
                 media_type="application/octet-stream",
                 filename=filename,
+                headers=headers,
+            )
+            if serial is None or request.method == "HEAD":
+                return response
+
+            scheduler = self.downloadScheduler
+            priority = (
+                self.priorityRework
+                and scheduler.maxTransfers > 0
+                and serial not in scheduler.queue
+                and await self.io.runResults(self._isRework, serial)
+            )
+            transfer, position = scheduler.request(serial, filename, priority)
+            if transfer is None:
+                return JSONResponse(
+                    status_code=503,
+                    content={"detail": "Download queued", "position": position},
+                    headers={"Retry-After": str(scheduler.retryAfter)},
+                )
+
+            return ScheduledResponse(response, scheduler, transfer)
+
+        @self.app.get("/multicast/join", tags=["CM Request"])
+        async def cm_request_join_multicast(
+            image: str = Query(...),
+            encoding: str = Query("xz", description="xz, zstd, lz4 or raw"),
+        ):
+            """
+            Join the next multicast session of an image. The response holds the
+            multicast group, the session identifier and the parameters needed
+            to receive the image and repair it with /downloadimage.
+
+            :param image: The name of the image.
+            :param encoding: The encoding of the image, xz is the uploaded file.
+            """
+            if self.multicastSender is None:
+                raise HTTPException(status_code=404, detail="Multicast is disabled")
+            entry = await self._getCatalogEntry(self.imageCatalog, image)
+            if entry is not None and encoding != "xz":
+                entry = self.imageEncoder.get(image, encoding)
+            if entry is None or not entry["sha256sum"]:
+                raise HTTPException(status_code=404, detail="File not found")
+
+            return JSONResponse(
+                content=self.multicastSender.join(
+                    f"{image}?encoding={encoding}",
+                    entry["path"],
+                    entry["size"],
+                    entry["sha256sum"],
+                )
+            )
+
+        @self.app.get("/downloadmulticastreceiver", tags=["CM Request"])
+        async def cm_request_server_the_multicast_receiver():
+            """
+            Serve the multicast receiver, run on the CM with python3.
+            """
+            return FileResponse(
+                os.path.join(os.path.dirname(__file__), "multicastDistribution.py"),
+                media_type="text/x-python",
+                filename="multicastDistribution.py",
+            )
+
+        @self.app.get(
+            "/downloadbmap/{filename}",
+            response_class=PlainTextResponse,
+            tags=["CM Request"],
+        )
+        async def cm_request_server_the_block_map(filename: str):
+            """
+            Serve the block map of an image: a "<block size> <image size>"
+            line, then one "<first block> <block count> <SHA256 checksum>"
+            line per range of the uncompressed image holding data.
+
+            :param filename: The name of the image.
+            """
+            blockMap = self.imageBlockMaps.get(filename)
+            if blockMap is None:
+                raise HTTPException(status_code=404, detail="Block map not found")
+
+            return PlainTextResponse(
+                content=BlockMapManager.render(blockMap), media_type="text/plain"
             )
 
         @self.app.get("/downloadeeprom/{filename}", tags=["CM Request"])
@@ -322,16 +553,14 @@ class HttpServer:
 
             :param filename: The name of the file to serve.
             """
-            # Construct the full path to the file
-            file_path = f"/eeproms/{filename}"
-
             # Check if the file exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.eepromCatalog, filename)
+            if entry is None:
                 raise HTTPException(status_code=404, detail="File not found")
 
             # Return the file using FileResponse
             return FileResponse(
-                file_path,
+                entry["path"],
                 media_type="application/octet-stream",
                 filename=filename,
             )
@@ -345,57 +574,185 @@ class HttpServer:
             :param sha256sum: The expected SHA256 checksum of the file
             """
             # Check if imaage already exists
-            if os.path.exists(f"/uploads/{image.filename}"):
+            if (
+                await self._getCatalogEntry(self.imageCatalog, image.filename or "")
+                is not None
+            ):
                 raise HTTPException(
                     status_code=400, detail=f"Image '{image.filename}' already exists"
                 )
-            # Read the file's content
-            fileContent = await image.read()
+            # Stream the file to disk, verifying its checksum
+            computedSha256sum = await self._saveUpload(image, "/uploads", sha256sum)
+            await self._fileChanged("images", os.path.basename(image.filename or ""))
+
+            return JSONResponse(
+                content={
+                    "filename": image.filename,
+                    "sha256sum": computedSha256sum,
+                    "message": "File uploaded and verified successfully",
+                }
+            )
+
+        @self.app.post("/image/upload-session", tags=["Image Management"])
+        async def create_image_upload_session(
+            filename: str = Form(...),
+            size: int = Form(..., description="File size in bytes"),
+            sha256sum: str = Form(...),
+            chunk_size: int = Form(8 * 1024 * 1024, description="Chunk size in bytes"),
+        ):
+            """
+            Create a resumable upload session for an image. The chunks are then
+            sent with PUT /image/upload-session/{upload_id}/chunk/{index}, in any
+            order and in parallel, and the upload is completed with
+            POST /image/upload-session/{upload_id}/finalize.
+
+            :param filename: The image file name
+            :param size: The image size in bytes
+            :param sha256sum: The expected SHA256 checksum of the image
+            :param chunk_size: The chunk size in bytes, from 1 MB to 64 MB
+            """
+            try:
+                status = await self.io.run(
+                    self.imageUploadSessions.createSession,
+                    filename,
+                    size,
+                    sha256sum,
+                    chunk_size,
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            return JSONResponse(content=status)
+
+        @self.app.get("/image/upload-session/{upload_id}", tags=["Image Management"])
+        async def get_image_upload_session(upload_id: str):
+            """
+            Get the status of an upload session, with the missing chunks.
+
+            :param upload_id: The upload session identifier
+            """
+            try:
+                status = await self.io.run(
+                    self.imageUploadSessions.getStatus, upload_id
+                )
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=str(e.args[0]))
+
+            return JSONResponse(content=status)
+
+        @self.app.put(
+            "/image/upload-session/{upload_id}/chunk/{index}",
+            tags=["Image Management"],
+        )
+        async def upload_image_chunk(
+            upload_id: str,
+            index: int,
+            request: Request,
+            chunk_sha256sum: Optional[str] = Query(
+                None, description="SHA256 checksum of the chunk"
+            ),
+        ):
+            """
+            Upload a chunk of an image, the request body is the raw chunk content.
 
-            # Compute the SHA256 checksum of the uploaded file
-            computedSha256sum = hashlib.sha256(fileContent).hexdigest()
+            :param upload_id: The upload session identifier
+            :param index: The chunk index, from 0
+            :param chunk_sha256sum: The expected SHA256 checksum of the chunk
+            """
+            data = bytearray()
+            async for part in request.stream():
+                data.extend(part)
+                if len(data) > UploadSessionManager.MAX_CHUNK_SIZE:
+                    raise HTTPException(status_code=413, detail="Chunk too large")
+            try:
+                await self.io.run(
+                    self.imageUploadSessions.writeChunk,
+                    upload_id,
+                    index,
+                    bytes(data),
+                    chunk_sha256sum,
+                )
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=str(e.args[0]))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
 
-            # Verify the checksum
-            if computedSha256sum != sha256sum:
-                raise HTTPException(status_code=400, detail="SHA256 checksum mismatch")
+            return JSONResponse(content={"uploadId": upload_id, "index": index})
 
-            # save the checksum
-            with open(f"/uploads/{image.filename}.sha256sum", "w") as f:
-                f.write(sha256sum)
+        @self.app.post(
+            "/image/upload-session/{upload_id}/finalize", tags=["Image Management"]
+        )
+        async def finalize_image_upload_session(upload_id: str):
+            """
+            Verify the SHA256 checksum of the uploaded image and store it.
 
-            # Save the file (optional, update the path as needed)
-            with open(f"/uploads/{image.filename}", "wb") as f:
-                f.write(fileContent)
+            :param upload_id: The upload session identifier
+            """
+            try:
+                result = await self.io.run(self.imageUploadSessions.finalize, upload_id)
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=str(e.args[0]))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            await self._fileChanged("images", result["filename"])
 
             return JSONResponse(
                 content={
-                    "filename": image.filename,
-                    "sha256sum": computedSha256sum,
+                    "filename": result["filename"],
+                    "sha256sum": result["sha256sum"],
                     "message": "File uploaded and verified successfully",
                 }
             )
 
+        @self.app.delete("/image/upload-session/{upload_id}", tags=["Image Management"])
+        async def abort_image_upload_session(upload_id: str):
+            """
+            Abort an upload session and remove its data.
+
+            :param upload_id: The upload session identifier
+            """
+            try:
+                await self.io.run(self.imageUploadSessions.abort, upload_id)
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=str(e.args[0]))
+
+            return JSONResponse(
+                content={"message": f"Upload session '{upload_id}' aborted"}
+            )
+
+        @self.app.get("/image/multicast-sessions", tags=["Image Management"])
+        async def list_multicast_sessions():
+            """
+            List the multicast sessions waiting for receivers or being sent.
+            """
+            if self.multicastSender is None:
+                return JSONResponse(content={"sessions": []})
+            return JSONResponse(content={"sessions": self.multicastSender.getStatus()})
+
+        @self.app.get("/image/memory-tier", tags=["Image Management"])
+        async def get_memory_tier():
+            """
+            Get the images of the active project kept in RAM, with the memory
+            used and the number of downloads served from each copy.
+            """
+            return JSONResponse(content=self.imageMemoryTier.getStatus())
+
+        @self.app.get("/image/download-queue", tags=["Image Management"])
+        async def get_download_queue():
+            """
+            Get the running image downloads and the queued CMs, in order, with
+            their position. The same status is sent to the WebSocket clients
+            as {"downloadQueue": ...} on every change. With several workers,
+            each one has its own queue, this is the one of the worker answering.
+            """
+            return JSONResponse(content=self.downloadScheduler.getStatus())
+
         @self.app.get("/image/list-images", tags=["Image Management"])
         async def list_all_images():
             """
             List all uploaded images.
             """
-            # List all files in the uploads directory
-            files = os.listdir("/uploads")
-            imageList = {}
-            for file in files:
-                # Read the SHA256 checksum of the file
-                if file.endswith(".sha256sum"):
-                    with open(f"/uploads/{file}", "r") as f:
-                        sha256sum = f.read()
-                        imageList[file.replace(".sha256sum", "")] = {
-                            "upload": datetime.fromtimestamp(
-                                os.path.getmtime(f"/uploads/{file}")
-                            ).strftime("%Y-%m-%d_%H:%M:%S"),
-                            "sha256sum": sha256sum,
-                        }
-
-            return JSONResponse(content={"images": imageList})
+            return JSONResponse(content={"images": self.imageCatalog.list()})
 
         @self.app.get("/image/download-image", tags=["Image Management"])
         async def download_image(image: str):
@@ -404,18 +761,16 @@ class HttpServer:
 
             :param image: The name of the image file to download.
             """
-            # Construct the full file path
-            file_path = f"/uploads/{image}"
-
             # Check if the image exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.imageCatalog, image)
+            if entry is None:
                 raise HTTPException(
                     status_code=404, detail=f"Image '{image}' not found"
                 )
 
             # Return the file using FileResponse
             return FileResponse(
-                file_path, media_type="application/octet-stream", filename=image
+                entry["path"], media_type="application/octet-stream", filename=image
             )
 
         @self.app.delete("/image/delete-image", tags=["Image Management"])
@@ -425,18 +780,17 @@ class HttpServer:
 
             :param image: The name of the image file to delete.
             """
-            # Construct the full file path
-            file_path = f"/uploads/{image}"
-
             # Check if the image exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.imageCatalog, image)
+            if entry is None:
                 raise HTTPException(
                     status_code=404, detail=f"Image '{image}' not found"
                 )
 
             # Delete the file
-            os.remove(file_path)
-            os.remove(f"{file_path}.sha256sum")
+            await self.io.remove(entry["path"])
+            await self.io.remove(f"{entry['path']}.sha256sum", True)
+            await self._fileChanged("images", image, True)
 
             return JSONResponse(
                 content={"message": f"Image '{image}' deleted successfully"}
@@ -451,27 +805,16 @@ class HttpServer:
             :param sha256sum: The expected SHA256 checksum of the file
             """
             # Check if eeprom already exists
-            if os.path.exists(f"/eeproms/{eeprom.filename}"):
+            if (
+                await self._getCatalogEntry(self.eepromCatalog, eeprom.filename or "")
+                is not None
+            ):
                 raise HTTPException(
                     status_code=400, detail=f"Eeprom '{eeprom.filename}' already exists"
                 )
-            # Read the file's content
-            fileContent = await eeprom.read()
-
-            # Compute the SHA256 checksum of the uploaded file
-            computedSha256sum = hashlib.sha256(fileContent).hexdigest()
-
-            # Verify the checksum
-            if computedSha256sum != sha256sum:
-                raise HTTPException(status_code=400, detail="SHA256 checksum mismatch")
-
-            # save the checksum
-            with open(f"/eeproms/{eeprom.filename}.sha256sum", "w") as f:
-                f.write(sha256sum)
-
-            # Save the file (optional, update the path as needed)
-            with open(f"/eeproms/{eeprom.filename}", "wb") as f:
-                f.write(fileContent)
+            # Stream the file to disk, verifying its checksum
+            computedSha256sum = await self._saveUpload(eeprom, "/eeproms", sha256sum)
+            await self._fileChanged("eeproms", os.path.basename(eeprom.filename or ""))
 
             return JSONResponse(
                 content={
@@ -486,22 +829,7 @@ class HttpServer:
             """
             List all uploaded EEPROMs.
             """
-            # List all files in the eeproms/eeprom directory
-            files = os.listdir("/eeproms")
-            eepromList = {}
-            for file in files:
-                # Read the SHA256 checksum of the file
-                if file.endswith(".sha256sum"):
-                    with open(f"/eeproms/{file}", "r") as f:
-                        sha256sum = f.read()
-                        eepromList[file.replace(".sha256sum", "")] = {
-                            "upload": datetime.fromtimestamp(
-                                os.path.getmtime(f"/eeproms/{file}")
-                            ).strftime("%Y-%m-%d_%H:%M:%S"),
-                            "sha256sum": sha256sum,
-                        }
-
-            return JSONResponse(content={"eeproms": eepromList})
+            return JSONResponse(content={"eeproms": self.eepromCatalog.list()})
 
         @self.app.get("/eeprom/download-eeprom", tags=["Eeprom Management"])
         async def download_eeprom(eeprom: str):
@@ -510,18 +838,16 @@ class HttpServer:
 
             :param eeprom: The name of the EEPROM file to download.
             """
-            # Construct the full file path
-            file_path = f"/eeproms/{eeprom}"
-
             # Check if the eeprom exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.eepromCatalog, eeprom)
+            if entry is None:
                 raise HTTPException(
                     status_code=404, detail=f"EEPROM '{eeprom}' not found"
                 )
 
             # Return the file using FileResponse
             return FileResponse(
-                file_path, media_type="application/octet-stream", filename=eeprom
+                entry["path"], media_type="application/octet-stream", filename=eeprom
             )
 
         @self.app.delete("/eeprom/delete-eeprom", tags=["Eeprom Management"])
@@ -531,18 +857,17 @@ class HttpServer:
 
             :param eeprom: The name of the EEPROM file to delete.
             """
-            # Construct the full file path
-            file_path = f"/eeproms/{eeprom}"
-
             # Check if the eeprom exists
-            if not os.path.exists(file_path):
+            entry = await self._getCatalogEntry(self.eepromCatalog, eeprom)
+            if entry is None:
                 raise HTTPException(
                     status_code=404, detail=f"EEPROM '{eeprom}' not found"
                 )
 
             # Delete the file
-            os.remove(file_path)
-            os.remove(f"{file_path}.sha256sum")
+            await self.io.remove(entry["path"])
+            await self.io.remove(f"{entry['path']}.sha256sum", True)
+            await self._fileChanged("eeproms", eeprom, True)
 
             return JSONResponse(
                 content={"message": f"EEPROM '{eeprom}' deleted successfully"}
@@ -576,7 +901,7 @@ class HttpServer:
             if cm_status_led_on_onsuccess is None:
                 statusLedOnOnsuccess = False
             # check if image exists
-            if not os.path.exists(f"/uploads/{image8Gb}"):
+            if not self.imageCatalog.exists(image8Gb):
                 raise HTTPException(
                     status_code=404, detail=f"Image '{image8Gb}' not found"
                 )
@@ -723,7 +1048,7 @@ class HttpServer:
                 )
 
         @self.app.get("/result/getresult", tags=["Result Management"])
-        def get_result_by_serial_and_timestamp(
+        async def get_result_by_serial_and_timestamp(
             serial: str = Query(...), timestamp: str = Query(...)
         ):
             """
@@ -732,9 +1057,13 @@ class HttpServer:
             :param serial: The serial number
             :param timestamp: The timestamp
             """
-            result = self.resultManager.getResult(serial, timestamp)
-            if result:
-                return JSONResponse(content=result)
+            response = await self.io.runResults(
+                lambda: self._resultResponse(
+                    self.resultManager.getResult(serial, timestamp)
+                )
+            )
+            if response is not None:
+                return response
             else:
                 raise HTTPException(
                     status_code=404,
@@ -742,31 +1071,231 @@ class HttpServer:
                 )
 
         @self.app.get("/result/getresultsbyserial", tags=["Result Management"])
-        def get_results_by_serial(serial: str = Query(...)):
+        async def get_results_by_serial(
+            serial: str = Query(...),
+            limit: Optional[int] = Query(
+                None, ge=1, description="Keep only the most recent results"
+            ),
+        ):
             """
             Get all results for a serial number.
 
             :param serial: The serial number
+            :param limit: The maximal number of results, the most recent ones are kept
             """
-            results = self.resultManager.getResultsBySerial(serial)
-            if results:
-                return JSONResponse(content=results)
+            response = await self.io.runResults(
+                lambda: self._resultResponse(
+                    self.resultManager.getResultsBySerial(serial, limit)
+                )
+            )
+            if response is not None:
+                return response
             else:
                 raise HTTPException(
                     status_code=404, detail=f"Results not found for serial '{serial}'"
                 )
 
         @self.app.get("/result/getresults", tags=["Result Management"])
-        def get_all_results():
+        async def get_all_results():
             """
             Get all results.
             """
-            results = self.resultManager.getResults()
-            if results:
-                return JSONResponse(content=results)
+            response = await self.io.runResults(
+                lambda: self._resultResponse(self.resultManager.getResults())
+            )
+            if response is not None:
+                return response
             else:
                 raise HTTPException(status_code=404, detail="Results not found")
 
+        @self.app.get("/result/getresults/stream", tags=["Result Management"])
+        async def stream_results(
+            format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+            since: Optional[str] = Query(None, description="ISO 8601 start time"),
+            until: Optional[str] = Query(None, description="ISO 8601 end time"),
+            project: Optional[str] = Query(None),
+            state: Optional[str] = Query(None),
+            result: Optional[bool] = Query(None),
+            limit: Optional[int] = Query(None, ge=1),
+            cursor: Optional[str] = Query(None, description="Cursor of the next page"),
+        ):
+            """
+            Stream the results, ordered by start time. The response is generated
+            incrementally, so the whole history is never held in memory.
+
+            - "ndjson": one {"serial", "timestamp", "result"} object per line,
+              followed by a {"nextCursor"} line when the limit is reached
+            - "json": {"results": [...], "nextCursor": ...} as /result/query
+
+            :param format: The output format, "ndjson" or "json"
+            :param since: The minimal start time (included)
+            :param until: The maximal start time (excluded)
+            :param project: The project name
+            :param state: The provisioning state
+            :param result: The provisioning result
+            :param limit: The maximal number of results, all if not set
+            :param cursor: The "nextCursor" of the previous page
+            """
+            try:
+                query = ResultQuery(
+                    p_projectName=project,
+                    p_state=state,
+                    p_result=result,
+                    p_since=since,
+                    p_until=until,
+                    p_limit=limit,
+                    p_cursor=cursor,
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            if format == "ndjson":
+                mediaType = "application/x-ndjson"
+            else:
+                mediaType = "application/json"
+
+            return StreamingResponse(
+                self._streamResults(query, format == "ndjson"),
+                media_type=mediaType,
+                headers=await self.io.runResults(self._resultHeaders),
+            )
+
+        @self.app.get("/result/query", tags=["Result Management"])
+        async def query_results(
+            serial: Optional[str] = Query(None),
+            mac: Optional[str] = Query(None),
+            cid: Optional[str] = Query(None),
+            project: Optional[str] = Query(None),
+            state: Optional[str] = Query(None),
+            result: Optional[bool] = Query(None),
+            since: Optional[str] = Query(None, description="ISO 8601 start time"),
+            until: Optional[str] = Query(None, description="ISO 8601 end time"),
+            limit: int = Query(100, ge=1, le=1000),
+            cursor: Optional[str] = Query(None, description="Cursor of the next page"),
+        ):
+            """
+            Query the results, ordered by start time.
+
+            :param serial: The serial number
+            :param mac: The MAC address
+            :param cid: The storage CID
+            :param project: The project name
+            :param state: The provisioning state
+            :param result: The provisioning result
+            :param since: The minimal start time (included)
+            :param until: The maximal start time (excluded)
+            :param limit: The maximal number of results
+            :param cursor: The "nextCursor" of the previous page
+            """
+            try:
+                query = ResultQuery(
+                    serial,
+                    mac,
+                    cid,
+                    project,
+                    state,
+                    result,
+                    since,
+                    until,
+                    limit,
+                    cursor,
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            def read() -> JSONResponse:
+                results = []
+                lastFields = None
+                for fields, record in self.resultManager.queryResults(query):
+                    results.append(
+                        {
+                            "serial": fields["serial"],
+                            "timestamp": fields["timestamp"],
+                            "result": record,
+                        }
+                    )
+                    lastFields = fields
+                nextCursor = None
+                if lastFields is not None and len(results) == limit:
+                    nextCursor = ResultQuery.encodeCursor(
+                        ResultQuery.sortKey(lastFields)
+                    )
+
+                return JSONResponse(
+                    content={"results": results, "nextCursor": nextCursor},
+                    headers=self._resultHeaders(),
+                )
+
+            return await self.io.runResults(read)
+
+        @self.app.get("/result/query/count", tags=["Result Management"])
+        async def count_results(
+            serial: Optional[str] = Query(None),
+            mac: Optional[str] = Query(None),
+            cid: Optional[str] = Query(None),
+            project: Optional[str] = Query(None),
+            state: Optional[str] = Query(None),
+            result: Optional[bool] = Query(None),
+            since: Optional[str] = Query(None, description="ISO 8601 start time"),
+            until: Optional[str] = Query(None, description="ISO 8601 end time"),
+        ):
+            """
+            Count the results matching the filters of /result/query.
+            """
+            try:
+                query = ResultQuery(
+                    serial, mac, cid, project, state, result, since, until
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            return await self.io.runResults(
+                lambda: JSONResponse(
+                    content={"count": self.resultManager.countResults(query)},
+                    headers=self._resultHeaders(),
+                )
+            )
+
+        @self.app.get("/result/telemetry", tags=["Result Management"])
+        async def get_telemetry(
+            project: Optional[str] = Query(None),
+            model: Optional[str] = Query(None),
+            since: Optional[str] = Query(None, description="ISO 8601 start time"),
+            until: Optional[str] = Query(None, description="ISO 8601 end time"),
+        ):
+            """
+            Aggregate the phase timings of the results per project and CM
+            model: the mean, median and 95th percentile of the duration, the
+            throughput and the busy cores of every phase, and the bottleneck
+            phase.
+
+            :param project: The project name
+            :param model: The CM model
+            :param since: The minimal start time (included)
+            :param until: The maximal start time (excluded)
+            """
+            try:
+                query = ResultQuery(p_projectName=project, p_since=since, p_until=until)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            return await self.io.runResults(
+                lambda: JSONResponse(
+                    content=PhaseTelemetry.aggregate(
+                        self.resultManager.queryResults(query), model
+                    ),
+                    headers=self._resultHeaders(),
+                )
+            )
+
+        @self.app.get("/metrics", tags=["Monitoring"])
+        def get_metrics():
+            """
+            Get the metrics of the server in the Prometheus text format.
+            """
+            content, mediaType = ServerMetrics.render()
+            return Response(content=content, media_type=mediaType)
+
         # WebSocket routes
         @self.app.websocket("/")
         async def websocket_endpoint(websocket: WebSocket):
@@ -774,13 +1303,17 @@ class HttpServer:
             Handle WebSocket connections.
             """
             await websocket.accept()
-            self.activeWebsockets.append(websocket)
+            self.websocketBroadcaster.register(websocket)
             try:
                 while True:
                     # Keep the connection alive by receiving messages
-                    await websocket.receive_text()
-            except WebSocketDisconnect:
-                self.activeWebsockets.remove(websocket)
+                    message = await websocket.receive_text()
+                    await self._handleWebsocketMessage(websocket, message)
+            except (WebSocketDisconnect, RuntimeError):
+                # RuntimeError: closed by the broadcaster, the client was too slow
+                pass
+            finally:
+                self.websocketBroadcaster.unregister(websocket)
 
     def setServerIp(self, p_ip: str) -> None:
         """
@@ -790,6 +1323,7 @@ class HttpServer:
         :type p_ip: str
         """
         self.serverIp = p_ip
+        self.provisioningPlans.invalidate()
 
     def setServerPort(self, p_port: int) -> None:
         """
@@ -799,34 +1333,651 @@ class HttpServer:
         :type p_port: int
         """
         self.serverPort = p_port
+        self.provisioningPlans.invalidate()
+
+    def setResultStorage(
+        self, p_mode: str, p_fsyncInterval: float, p_compactThreshold: int
+    ) -> None:
+        """
+        Set the result storage mode.
+
+        :param p_mode: The storage mode, "json", "journal" or "sqlite"
+        :type p_mode: str
+        :param p_fsyncInterval: The journal group commit window in seconds
+        :type p_fsyncInterval: float
+        :param p_compactThreshold: The number of journal records triggering a compaction
+        :type p_compactThreshold: int
+        """
+        self.resultManager.setStorageMode(p_mode, p_fsyncInterval, p_compactThreshold)
+
+    def setCatalogReconcileInterval(self, p_interval: float) -> None:
+        """
+        Set the period of the reconciliation of the image and EEPROM catalogs
+        with their directories.
+
+        :param p_interval: The period in seconds
+        :type p_interval: float
+        """
+        self.catalogReconcileInterval = p_interval
+
+    def setSparseWrite(self, p_enabled: bool) -> None:
+        """
+        Enable the block maps of the images, so the CMs only write the
+        ranges of the image holding data.
+
+        :param p_enabled: True to build the block maps and use them
+        :type p_enabled: bool
+        """
+        self.sparseWrite = p_enabled
+
+    def setImageEncodings(self, p_encodings: list[str], p_workers: int) -> None:
+        """
+        Set the encodings built for every uploaded xz image.
+
+        :param p_encodings: The encodings, among "zstd", "lz4" and "raw", in
+            order of preference
+        :type p_encodings: list[str]
+        :param p_workers: The number of images encoded at once
+        :type p_workers: int
+        """
+        self.imageEncoder.setEncodings(p_encodings)
+        self.imageEncodingWorkers = p_workers
+
+    def setTelemetryInterval(self, p_interval: int) -> None:
+        """
+        Set the period of the telemetry reports of the CMs while the image is
+        written.
+
+        :param p_interval: The period in seconds, 0 for the final report only
+        :type p_interval: int
+        """
+        self.telemetryInterval = p_interval
+        self.provisioningPlans.invalidate()
+
+    def setResultBatching(self, p_window: float, p_maxEvents: int) -> None:
+        """
+        Set the batching of the provisioning events stored in the results.
+
+        :param p_window: The time in seconds the events are gathered for
+            before being stored, 0 to store them as soon as possible
+        :type p_window: float
+        :param p_maxEvents: The maximal number of events stored at once
+        :type p_maxEvents: int
+        """
+        self.provisioningEvents.batchWindow = max(0.0, p_window)
+        self.provisioningEvents.maxBatch = max(1, p_maxEvents)
+
+    def setWorkerHub(self, p_socketPath: Optional[str]) -> None:
+        """
+        Set the WorkerHub of the process supervising several HTTP worker
+        processes. The events of the WebSocket clients, the provisioning
+        events and the changes of the files and the projects are then shared
+        with the other workers.
+
+        :param p_socketPath: The Unix socket of the hub, None for a single worker
+        :type p_socketPath: str
+        """
+        self.hub = WorkerHubClient(p_socketPath) if p_socketPath else None
+
+    def setIoWorkers(self, p_workers: int) -> None:
+        """
+        Set the number of threads running the blocking disk work of the
+        request handlers.
+
+        :param p_workers: The number of threads
+        :type p_workers: int
+        """
+        self.io.workers = max(1, p_workers)
+
+    def setLoopWatchdog(self, p_threshold: float) -> None:
+        """
+        Set the blocking time of the event loop logged with the stack of the
+        blocking callback.
+
+        :param p_threshold: The time in seconds, 0 to disable the watchdog
+        :type p_threshold: float
+        """
+        self.loopWatchdog.threshold = max(0.0, p_threshold)
+
+    def setWebsocketBroadcast(
+        self, p_maxQueue: int, p_sendTimeout: float, p_history: int
+    ) -> None:
+        """
+        Set the limits of the WebSocket clients.
+
+        :param p_maxQueue: The maximal number of messages waiting for a client
+            before it is disconnected
+        :type p_maxQueue: int
+        :param p_sendTimeout: The time in seconds a client has to accept a
+            message before it is disconnected
+        :type p_sendTimeout: float
+        :param p_history: The number of events kept for the reconnecting clients
+        :type p_history: int
+        """
+        self.websocketBroadcaster = WebsocketBroadcaster(
+            max(1, p_maxQueue), p_sendTimeout, max(0, p_history)
+        )
+
+    def setMemoryTier(self, p_directory: str, p_budgetMb: int) -> None:
+        """
+        Set the RAM tier keeping the images of the active project.
+
+        :param p_directory: The tmpfs directory of the copies
+        :type p_directory: str
+        :param p_budgetMb: The memory budget in MiB, 0 to disable the tier
+        :type p_budgetMb: int
+        """
+        self.imageMemoryTier = ImageMemoryTier(p_directory, p_budgetMb * 1024 * 1024)
+
+    def setMulticast(
+        self,
+        p_group: str,
+        p_port: int,
+        p_rateMbps: float,
+        p_waitTime: float,
+        p_packetSize: int,
+        p_fecGroup: int,
+        p_interface: Optional[str] = None,
+    ) -> None:
+        """
+        Enable the multicast distribution of the images.
+
+        :param p_group: The multicast group address
+        :type p_group: str
+        :param p_port: The UDP port
+        :type p_port: int
+        :param p_rateMbps: The sending rate in Mbit/s
+        :type p_rateMbps: float
+        :param p_waitTime: The time waited for receivers before sending, in seconds
+        :type p_waitTime: float
+        :param p_packetSize: The payload size of the packets
+        :type p_packetSize: int
+        :param p_fecGroup: The number of data packets protected by a parity packet
+        :type p_fecGroup: int
+        :param p_interface: The address of the sending interface, the server IP
+            address if not set
+        :type p_interface: str
+        """
+        self.multicastSender = MulticastSender(
+            p_group,
+            p_port,
+            p_interface or self.serverIp,
+            p_rateMbps,
+            p_waitTime,
+            p_packetSize,
+            p_fecGroup,
+        )
+        self.provisioningPlans.invalidate()
+
+    def setDownloadScheduling(
+        self,
+        p_maxTransfers: int,
+        p_bandwidthMbps: float,
+        p_retryAfter: int,
+        p_queueTimeout: float,
+        p_priorityRework: bool,
+        p_maxQueueWait: int,
+    ) -> None:
+        """
+        Set the limits of the image downloads of the CMs.
+
+        :param p_maxTransfers: The maximal number of downloads at once, 0 for
+            no limit
+        :type p_maxTransfers: int
+        :param p_bandwidthMbps: The total bandwidth in Mbit/s, 0 for no limit
+        :type p_bandwidthMbps: float
+        :param p_retryAfter: The retry delay given to the queued CMs, in seconds
+        :type p_retryAfter: int
+        :param p_queueTimeout: The time after which a CM not retrying leaves the
+            queue, in seconds
+        :type p_queueTimeout: float
+        :param p_priorityRework: Queue the CMs already provisioned before in the
+            priority lane
+        :type p_priorityRework: bool
+        :param p_maxQueueWait: The total time a CM waits in the queue before
+            its provisioning fails, in seconds, 0 for no limit
+        :type p_maxQueueWait: int
+        """
+        self.downloadScheduler = DownloadScheduler(
+            p_maxTransfers, p_bandwidthMbps, p_retryAfter, p_queueTimeout
+        )
+        self.downloadScheduler.onChange = self._publishDownloadQueue
+        self.priorityRework = p_priorityRework
+        self.maxQueueWait = p_maxQueueWait
+        self.provisioningPlans.invalidate()
+
+    def setResultRetention(
+        self, p_maxAgeDays: float, p_maxRecords: int, p_checkInterval: float
+    ) -> None:
+        """
+        Set the retention policy of the results.
+
+        :param p_maxAgeDays: The maximal age of the results in days, 0 to disable
+        :type p_maxAgeDays: float
+        :param p_maxRecords: The maximal number of results, 0 to disable
+        :type p_maxRecords: int
+        :param p_checkInterval: The period of the retention check in seconds
+        :type p_checkInterval: float
+        """
+        if p_maxAgeDays <= 0 and p_maxRecords <= 0:
+            return
+        self.resultManager.setRetention(p_maxAgeDays, p_maxRecords)
+        self.retentionInterval = p_checkInterval
+
+    def _startPrimaryTasks(self) -> None:
+        """
+        Start the tasks run by a single worker process: applying the
+        provisioning events and the result retention.
+        """
+        self.provisioningEvents.start()
+        if self.resultManager.archive is not None and self.retentionInterval > 0:
+            self._primaryTasks.append(asyncio.create_task(self._runRetention()))
+
+    async def _becomePrimary(self) -> None:
+        """
+        Take over the tasks of the primary worker process, after it left.
+        """
+        logging.info(f"HTTP worker {os.getpid()} is now the primary worker")
+        self.imageMemoryTier.owner = True
+        await self.io.run(self.imageMemoryTier.start)
+        self._preloadActiveProject()
+        self._startPrimaryTasks()
+
+    def _forwardEvent(self, p_event: ProvisioningEvent) -> None:
+        """
+        Forward a provisioning event to the primary worker process.
+
+        :param p_event: The event
+        :type p_event: ProvisioningEvent
+        """
+        if self.hub is not None:
+            self.hub.publish("provisioning", p_event.toDict())
+
+    def _onHubMessage(
+        self, p_topic: str, p_data: Any, p_sequence: Optional[int]
+    ) -> None:
+        """
+        Handle a message relayed by the WorkerHub.
+
+        :param p_topic: The topic: "websocket", "provisioning" or "files"
+        :type p_topic: str
+        :param p_data: The message
+        :type p_data: Any
+        :param p_sequence: The sequence number of a WebSocket event
+        :type p_sequence: int
+        """
+        if p_topic == "websocket":
+            self.websocketBroadcaster.publish(p_data, p_sequence)
+        elif p_topic == "provisioning":
+            self.provisioningEvents.deliver(ProvisioningEvent.fromDict(p_data))
+        elif p_data.get("worker") == os.getpid():
+            # Already applied by this worker
+            return
+        elif p_topic == "files":
+            task = asyncio.create_task(self._applyFileChange(p_data))
+            self._hubTasks.add(task)
+            task.add_done_callback(self._hubTasks.discard)
+
+    async def _applyFileChange(self, p_change: dict[str, Any]) -> None:
+        """
+        Update the catalogs and the derived files after an upload or a
+        deletion.
+
+        :param p_change: The change, {"catalog": "images" or "eeproms",
+            "name": <file name>, "removed": <bool>}
+        :type p_change: dict
+        """
+        name = p_change["name"]
+        if p_change["catalog"] == "eeproms":
+            await self.io.run(self.eepromCatalog.refresh, name)
+            return
+        if p_change["removed"]:
+            path = os.path.join(self.imageCatalog.directory, name)
+            await self.io.run(self.imageBlockMaps.remove, name, path)
+            await self.io.run(self.imageEncoder.remove, name)
+            await self.io.run(self.imageMemoryTier.remove, name)
+        await self.io.run(self.imageCatalog.refresh, name)
+        if not p_change["removed"]:
+            if self.sparseWrite:
+                self.imageBlockMaps.schedule(name)
+            self.imageEncoder.schedule(name)
+
+    async def _fileChanged(
+        self, p_catalog: str, p_name: str, p_removed: bool = False
+    ) -> None:
+        """
+        Apply an upload or a deletion, in all the worker processes.
+
+        :param p_catalog: "images" or "eeproms"
+        :type p_catalog: str
+        :param p_name: The file name
+        :type p_name: str
+        :param p_removed: True if the file was deleted
+        :type p_removed: bool
+        """
+        change = {
+            "catalog": p_catalog,
+            "name": p_name,
+            "removed": p_removed,
+            "worker": os.getpid(),
+        }
+        await self._applyFileChange(change)
+        if self.hub is not None:
+            self.hub.publish("files", change)
+
+    def _onProjectsChanged(self, p_snapshot: ProjectSnapshot) -> None:
+        """
+        Preload the images of the active project after the projects changed,
+        in this worker process or another one.
+
+        :param p_snapshot: The project configuration
+        :type p_snapshot: ProjectSnapshot
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._preloadActiveProject)
+
+    async def _runRetention(self) -> None:
+        """
+        Periodically move the expired results to the archive. The segments
+        are written in a thread, the results are only deleted once archived.
+        """
+        while True:
+            try:
+                expired = await self.io.runResults(
+                    self.resultManager.collectExpiredResults
+                )
+                if expired and self.resultManager.archive is not None:
+                    await self.io.run(self.resultManager.archive.archive, expired)
+                    await self.io.runResults(
+                        self.resultManager.deleteResults,
+                        [
+                            (fields["serial"], fields["timestamp"])
+                            for fields, _ in expired
+                        ],
+                    )
+            except Exception as e:
+                logging.error(f"Error applying the result retention: {e}")
+            await asyncio.sleep(self.retentionInterval)
+
+    async def _saveUpload(
+        self, p_upload: UploadFile, p_directory: str, p_sha256sum: str
+    ) -> str:
+        """
+        Save an uploaded file, only if its SHA256 checksum matches. The file
+        is copied by chunks in a thread, so neither the memory nor the event
+        loop are held by the size of the file.
+
+        :param p_upload: The uploaded file
+        :type p_upload: UploadFile
+        :param p_directory: The destination directory
+        :type p_directory: str
+        :param p_sha256sum: The expected SHA256 checksum of the file
+        :type p_sha256sum: str
+
+        :return: The computed SHA256 checksum
+        :rtype: str
+
+        :raises HTTPException: If the checksum does not match or the file already exists
+        """
+        filename = os.path.basename(p_upload.filename or "")
+        computedSha256sum, saved = await self.io.run(
+            self._writeUpload,
+            p_upload.file,
+            p_upload.size,
+            p_directory,
+            filename,
+            p_sha256sum,
+        )
+        if computedSha256sum != p_sha256sum:
+            raise HTTPException(status_code=400, detail="SHA256 checksum mismatch")
+        if not saved:
+            raise HTTPException(
+                status_code=400, detail=f"File '{filename}' already exists"
+            )
+
+        return computedSha256sum
 
-    def _generateCm4Script(self, p_serial: str, p_startTime: str) -> str:
+    def _writeUpload(
+        self,
+        p_source: BinaryIO,
+        p_size: Optional[int],
+        p_directory: str,
+        p_filename: str,
+        p_sha256sum: str,
+    ) -> tuple[str, bool]:
+        """
+        Copy an uploaded file to a temporary file of the destination directory
+        while computing its SHA256 checksum, then move it into place if the
+        checksum matches.
+
+        :param p_source: The uploaded file content
+        :type p_source: BinaryIO
+        :param p_size: The size of the file, if known, to preallocate it
+        :type p_size: int
+        :param p_directory: The destination directory
+        :type p_directory: str
+        :param p_filename: The file name
+        :type p_filename: str
+        :param p_sha256sum: The expected SHA256 checksum of the file
+        :type p_sha256sum: str
+
+        :return: The computed SHA256 checksum, and True if the file was saved
+        :rtype: tuple[str, bool]
+        """
+        filePath = os.path.join(p_directory, p_filename)
+        tmpPath = os.path.join(p_directory, f".{p_filename}.{uuid.uuid4().hex}.part")
+        sha256 = hashlib.sha256()
+        try:
+            with open(tmpPath, "wb") as file:
+                if p_size:
+                    try:
+                        os.posix_fallocate(file.fileno(), 0, p_size)
+                    except OSError:
+                        pass
+                while chunk := p_source.read(self.UPLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    file.write(chunk)
+                file.truncate()
+                file.flush()
+                os.fsync(file.fileno())
+
+            computedSha256sum = sha256.hexdigest()
+            if computedSha256sum != p_sha256sum:
+                return computedSha256sum, False
+
+            # Never replace a file uploaded concurrently under the same name
+            if not UploadSessionManager.installFile(tmpPath, filePath, p_sha256sum):
+                return computedSha256sum, False
+
+            return computedSha256sum, True
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def _resultHeaders(self) -> dict[str, str]:
+        """
+        Get the headers of the result responses.
+
+        :return: The headers, with the version of the results
+        :rtype: dict
+        """
+        return {"X-Result-Version": str(self.resultManager.getVersion())}
+
+    def _resultResponse(self, p_content: dict[Any, Any]) -> Optional[JSONResponse]:
+        """
+        Serialize results into a response, on the result store thread, so
+        they are not modified meanwhile.
+
+        :param p_content: The results
+        :type p_content: dict
+
+        :return: The response, None if there is no result
+        :rtype: JSONResponse
+        """
+        if not p_content:
+            return None
+
+        return JSONResponse(content=p_content, headers=self._resultHeaders())
+
+    def _readResultPage(
+        self, p_results: Iterator[tuple[dict[str, Any], dict[Any, Any]]]
+    ) -> list[tuple[dict[str, Any], str]]:
+        """
+        Read and serialize the next page of the results of a query, on the
+        result store thread.
+
+        :param p_results: The (indexed fields, result) pairs of the query
+        :type p_results: Iterator[tuple[dict, dict]]
+
+        :return: The indexed fields and the JSON item of every result, empty
+            after the last one
+        :rtype: list[tuple[dict, str]]
+        """
+        return [
+            (
+                fields,
+                json.dumps(
+                    {
+                        "serial": fields["serial"],
+                        "timestamp": fields["timestamp"],
+                        "result": record,
+                    }
+                ),
+            )
+            for fields, record in itertools.islice(p_results, self.RESULT_PAGE_SIZE)
+        ]
+
+    async def _streamResults(
+        self, p_query: ResultQuery, p_ndjson: bool
+    ) -> AsyncIterator[str]:
+        """
+        Serialize the results of a query incrementally, reading every page on
+        the result store thread.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+        :param p_ndjson: Generate NDJSON instead of a JSON object
+        :type p_ndjson: bool
+
+        :return: The chunks of the response
+        :rtype: AsyncIterator[str]
+        """
+        count = 0
+        lastFields: Optional[dict[str, Any]] = None
+        if not p_ndjson:
+            yield '{"results":['
+        results = await self.io.runResults(self.resultManager.queryResults, p_query)
+        while page := await self.io.runResults(self._readResultPage, results):
+            # One write per page
+            chunk: list[str] = []
+            for fields, item in page:
+                if p_ndjson:
+                    chunk.append(f"{item}\n")
+                else:
+                    chunk.append(f",{item}" if count else item)
+                count += 1
+                lastFields = fields
+            yield "".join(chunk)
+
+        nextCursor = None
+        if lastFields is not None and count == p_query.limit:
+            nextCursor = ResultQuery.encodeCursor(ResultQuery.sortKey(lastFields))
+        if p_ndjson:
+            if nextCursor is not None:
+                yield json.dumps({"nextCursor": nextCursor}) + "\n"
+        else:
+            yield f'],"nextCursor":{json.dumps(nextCursor)}}}'
+
+    def _generateCm4Script(
+        self,
+        p_plan: ProvisioningPlan,
+        p_serial: str,
+        p_startTime: str,
+        p_model: str = "",
+        p_memorySize: int = 0,
+    ) -> str:
         """
-        Generate the CM4 script.
+        Generate the CM4 script, from the template of its provisioning plan.
 
+        :param p_plan: The provisioning plan of the CM
+        :type p_plan: ProvisioningPlan
         :param p_serial: The serial number
         :type p_serial: str
         :param p_startTime: The start time
         :type p_startTime: str
+        :param p_model: The model of the CM, to choose the image encoding
+        :type p_model: str
+        :param p_memorySize: The memory size of the CM in kB
+        :type p_memorySize: int
 
         :return: The generated script
         :rtype: str
         """
+        # The block map and the encodings become ready after the plan is built
+        blockMap = ""
+        if self.sparseWrite and self.imageBlockMaps.get(p_plan.imageName) is not None:
+            blockMap = "1"
+
+        # Use the first encoding with a decompressor on the CM, xz otherwise
+        encodingChoice = ""
+        for encoding in self.imageEncoder.negotiate(
+            p_plan.imageName, p_model, p_memorySize
+        ):
+            options = ImageEncoder.ENCODINGS[encoding]
+            encodingChoice += (
+                f'{"elif" if encodingChoice else "if"} '
+                f"command -v {options['tool']} >/dev/null 2>&1; then\n"
+                f'    ENCODING="{encoding}"\n'
+                f'    DECOMPRESS="{options["decode"]}"\n'
+            )
+        if encodingChoice:
+            encodingChoice += "fi\n"
+
+        return p_plan.render(
+            {
+                "serial": p_serial,
+                "startTime": p_startTime,
+                "blockMap": blockMap,
+                "encodingChoice": encodingChoice,
+            }
+        )
+
+    def _renderScriptTemplate(self, p_plan: ProvisioningPlan) -> str:
+        """
+        Render the CM4 script of a provisioning plan, with the placeholders
+        of the values of each CM.
+
+        :param p_plan: The provisioning plan
+        :type p_plan: ProvisioningPlan
+
+        :return: The script template
+        :rtype: str
+        """
+        serial = ProvisioningPlan.field("serial")
+        startTime = ProvisioningPlan.field("startTime")
+        blockMap = ProvisioningPlan.field("blockMap")
+        encodingChoice = ProvisioningPlan.field("encodingChoice")
+        multicast = "1" if self.multicastSender is not None else ""
+
         script = f"""#!/bin/sh
 #!/bin/sh
 set -o pipefail
 
-export SERIAL="{p_serial}"
+export SERIAL="{serial}"
 export SERVER="{self.serverIp}:{self.serverPort}"
-export IMAGE="{self.imageName}"
-export EEPROM="{self.eeprom}"
-export STATUS_LED="{self.cmStatusLed}"
-export STATUS_LED_ON_ONSUCCESS="{self.cmStatusLedOnOnsuccess}"
-export STARTTIME="{p_startTime}"
+export IMAGE="{p_plan.imageName}"
+export EEPROM="{p_plan.eeprom}"
+export BMAP="{blockMap}"
+export MULTICAST="{multicast}"
+export STATUS_LED="{p_plan.cmStatusLed}"
+export STATUS_LED_ON_ONSUCCESS="{p_plan.cmStatusLedOnOnsuccess}"
+export STARTTIME="{startTime}"
 export STORAGE="/dev/mmcblk0"
 export PART1="/dev/mmcblk0p1"
 export PART2="/dev/mmcblk0p2"
 export ALLDONE="0"
+export TELEMETRY_INTERVAL="{self.telemetryInterval}"
+export MAX_QUEUE_WAIT="{self.maxQueueWait}"
 
 if [ "$STATUS_LED_ON_ONSUCCESS" = "1" ]; then
     export LED_SUCCESS_STATE="1"
@@ -869,12 +2020,70 @@ if [ "$STATUS_LED" != "NONE" ]; then
     echo "Run 'kill $BLINK_PID' to stop blinking."
 fi
 
+# Phase telemetry: the uptime, the bytes received on the network, the bytes
+# written to the storage and the CPU jiffies, read at the start and at the
+# end of each phase
+telemetry_counters() {{
+    read T_NOW _ </proc/uptime
+    T_RX=0
+    for T_FILE in /sys/class/net/*/statistics/rx_bytes; do
+        case $T_FILE in
+            */lo/*) ;;
+            *) T_VALUE=$(cat $T_FILE 2>/dev/null); T_RX=$((T_RX + ${{T_VALUE:-0}})) ;;
+        esac
+    done
+    T_SECTORS=0
+    if [ -r /sys/block/${{STORAGE##*/}}/stat ]; then
+        read _ _ _ _ _ _ T_SECTORS _ </sys/block/${{STORAGE##*/}}/stat
+    fi
+    T_WRITTEN=$((T_SECTORS * 512))
+    read _ T_USER T_NICE T_SYSTEM T_IDLE T_IOWAIT T_IRQ T_SOFTIRQ _ </proc/stat
+    T_BUSY=$((T_USER + T_NICE + T_SYSTEM + T_IRQ + T_SOFTIRQ))
+    T_TOTAL=$((T_BUSY + T_IDLE + T_IOWAIT))
+}}
+
+phase_start() {{
+    telemetry_counters
+    PHASE="$1"
+    PHASE_START=$T_NOW
+    PHASE_RX=$T_RX
+    PHASE_WRITTEN=$T_WRITTEN
+    PHASE_BUSY=$T_BUSY
+    PHASE_TOTAL=$T_TOTAL
+}}
+
+phase_line() {{
+    telemetry_counters
+    echo "$PHASE $1 $PHASE_START $T_NOW $((T_RX - PHASE_RX)) $((T_WRITTEN - PHASE_WRITTEN)) $((T_BUSY - PHASE_BUSY)) $((T_TOTAL - PHASE_TOTAL))"
+}}
+
+phase_end() {{
+    phase_line done >>/tmp/telemetry
+}}
+
+send_telemetry() {{
+    curl -sS -m 5 -g --data-binary @$2 "http://${{SERVER}}/scriptexecute/telemetry?serial=${{SERIAL}}&start=${{STARTTIME}}&final=$1&cpus=$CPUS" >/dev/null 2>&1 || true
+}}
+
+# Report the finished phases and the progress of the current one
+report_telemetry() {{
+    while sleep $TELEMETRY_INTERVAL; do
+        {{ cat /tmp/telemetry; phase_line running; }} >/tmp/telemetry.progress
+        send_telemetry 0 /tmp/telemetry.progress
+    done
+}}
+
+: >/tmp/telemetry
+CPUS=$(grep -c ^processor /proc/cpuinfo)
+
 # Make sure we have random entropy
 echo "OM7WfoL5UW24E1cO2B66wuMvZVVAn2yoiZI2bX1ydJqEhPXibBBhZuRFtJWrRKuR" >/dev/urandom
 
 echo Querying and registering EEPROM version
+phase_start eeprom_read
 vcgencmd bootloader_version >/tmp/eeprom_version || true
 flashrom -p "linux_spi:dev=/dev/spidev0.0,spispeed=16000" -r "/tmp/pieeprom.bin" || true
+phase_end
 EEPROMSHA=$(sha256sum /tmp/pieeprom.bin | awk '{{print $1}}')
 if [ -n "$EEPROMSHA" ]; then
     echo
@@ -887,18 +2096,152 @@ if [ -f /tmp/eeprom_version ]; then
 fi
 
 if [ -n "$EEPROM" ]; then
+    phase_start eeprom_write
     curl -o /tmp/pendingeeprom.bin "http://${{SERVER}}/downloadeeprom/${{EEPROM}}"
     flashrom -p "linux_spi:dev=/dev/spidev0.0,spispeed=16000" -w "/tmp/pendingeeprom.bin" || true
+    phase_end
 fi
 
 echo Sending BLKDISCARD to $STORAGE
-blkdiscard -v $STORAGE || true
+phase_start blkdiscard
+SPARSE="0"
+if blkdiscard -v $STORAGE && [ -n "$BMAP" ]; then
+    # Only skip the empty ranges if the discarded blocks read as zeros
+    NONZERO=$(dd if=$STORAGE bs=1M count=1 2>/dev/null | tr -d '\\000' | wc -c)
+    if [ "$NONZERO" = "0" ] && curl --retry 10 -sS -f -g -o /tmp/image.bmap "http://${{SERVER}}/downloadbmap/${{IMAGE}}"; then
+        SPARSE="1"
+    fi
+fi
+phase_end
+
+# Write the compressed image to stdout. An interrupted transfer is resumed
+# with a range request from the last byte written to the pipe, so the
+# decompressor and dd keep running. If-Match makes the server refuse the
+# resume if the image changed in between.
+download_image() {{
+    OFFSET=0
+    SIZE=""
+    ETAG=""
+    TRY=0
+    QUEUED=0
+    while true; do
+        rm -f /tmp/image.headers
+        if [ -n "$ETAG" ]; then
+            curl -sS -f -g --connect-timeout 10 -y 30 -Y 1 -D /tmp/image.headers \
+             -H "If-Match: $ETAG" -r "$OFFSET-" "http://${{SERVER}}/downloadimage/${{IMAGE}}?encoding=${{ENCODING}}&serial=${{SERIAL}}" \
+             | dd bs=1M 2>/tmp/image.dd
+        else
+            curl -sS -f -g --connect-timeout 10 -y 30 -Y 1 -D /tmp/image.headers \
+             -r "$OFFSET-" "http://${{SERVER}}/downloadimage/${{IMAGE}}?encoding=${{ENCODING}}&serial=${{SERIAL}}" \
+             | dd bs=1M 2>/tmp/image.dd
+        fi
+        STATUS=$?
+        touch /tmp/image.headers
+        WRITTEN=$(sed -n 's/^\\([0-9][0-9]*\\) bytes.*/\\1/p' /tmp/image.dd)
+        OFFSET=$((OFFSET + ${{WRITTEN:-0}}))
+        if [ -z "$ETAG" ]; then
+            ETAG=$(sed -n 's/^[Ee][Tt][Aa][Gg]: *//p' /tmp/image.headers | tr -d '\\r')
+        fi
+        if [ -z "$SIZE" ]; then
+            SIZE=$(sed -n 's/^[Cc]ontent-[Rr]ange: *bytes [0-9]*-[0-9]*\\/\\([0-9]*\\).*/\\1/p' /tmp/image.headers | tr -d '\\r')
+        fi
+        if [ $STATUS -eq 0 ] || {{ [ -n "$SIZE" ] && [ $OFFSET -ge $SIZE ]; }}; then
+            return 0
+        fi
+        if grep -q "^HTTP/[0-9.]* 412" /tmp/image.headers; then
+            echo "Image changed on the server, cannot resume" >&2
+            return 1
+        fi
+        # Queued by the server, retry without counting a failure until the
+        # maximal queue wait
+        if grep -q "^HTTP/[0-9.]* 503" /tmp/image.headers; then
+            RETRY_AFTER=$(sed -n 's/^[Rr]etry-[Aa]fter: *\\([0-9]*\\).*/\\1/p' /tmp/image.headers)
+            RETRY_AFTER=${{RETRY_AFTER:-5}}
+            if [ "$MAX_QUEUE_WAIT" != "0" ] && [ $((QUEUED + RETRY_AFTER)) -gt $MAX_QUEUE_WAIT ]; then
+                echo "Image download still queued after $QUEUED seconds" >&2
+                return 1
+            fi
+            echo "Image download queued by the server" >&2
+            sleep $RETRY_AFTER
+            QUEUED=$((QUEUED + RETRY_AFTER))
+            continue
+        fi
+        TRY=$((TRY + 1))
+        if [ $TRY -ge 10 ]; then
+            echo "Image download failed at byte $OFFSET" >&2
+            return 1
+        fi
+        echo "Image download interrupted at byte $OFFSET, resuming" >&2
+        sleep 1
+    done
+}}
+
+# Write the decompressed image from stdin to the ranges of the block map,
+# skipping the empty ones. Each range is checked against its SHA256
+# checksum while it is written.
+write_sparse() {{
+    exec 3</tmp/image.bmap
+    read BLOCK_SIZE IMAGE_SIZE <&3
+    rm -f /tmp/bmap.fifo
+    mkfifo /tmp/bmap.fifo
+    POS=0
+    WRITTEN_BLOCKS=0
+    while read START COUNT RANGE_SHA <&3; do
+        if [ $START -gt $POS ]; then
+            dd of=/dev/null bs=$BLOCK_SIZE count=$((START - POS)) iflag=fullblock 2>/dev/null || return 1
+        fi
+        dd of=$STORAGE bs=$BLOCK_SIZE seek=$START conv=notrunc </tmp/bmap.fifo 2>/dev/null &
+        WRITER_PID=$!
+        SHA=$(dd bs=$BLOCK_SIZE count=$COUNT iflag=fullblock 2>/dev/null | tee /tmp/bmap.fifo | sha256sum | awk '{{print $1}}')
+        wait $WRITER_PID || return 1
+        if [ "$SHA" != "$RANGE_SHA" ]; then
+            echo "Checksum mismatch of blocks $START to $((START + COUNT - 1))"
+            return 1
+        fi
+        POS=$((START + COUNT))
+        WRITTEN_BLOCKS=$((WRITTEN_BLOCKS + COUNT))
+    done
+    exec 3<&-
+    # Consume the trailing empty blocks
+    cat >/dev/null
+    sync
+    echo "Wrote $((WRITTEN_BLOCKS * BLOCK_SIZE)) of $IMAGE_SIZE bytes"
+}}
+
+ENCODING="xz"
+DECOMPRESS="xz -dc"
+{encodingChoice}
+# Receive the image by multicast if python3 is available, missing blocks
+# are fetched with range requests
+FETCH="download_image"
+if [ -n "$MULTICAST" ] && command -v python3 >/dev/null 2>&1 \
+ && curl --retry 10 -sS -f -g -o /tmp/multicastDistribution.py "http://${{SERVER}}/downloadmulticastreceiver"; then
+    echo Joining the multicast session of the image
+    FETCH="python3 /tmp/multicastDistribution.py --server ${{SERVER}} --image ${{IMAGE}} --encoding ${{ENCODING}}"
+fi
 
-echo Writing image from http://${{SERVER}}/downloadimage/${{IMAGE}} to $STORAGE
-curl --retry 10 -g "http://${{SERVER}}/downloadimage/${{IMAGE}}" \
- | xz -dc  \
- | dd of=$STORAGE conv=fsync obs=1M >/tmp/dd.log 2>&1
+echo Writing $ENCODING image from http://${{SERVER}}/downloadimage/${{IMAGE}} to $STORAGE
+phase_start image
+TELEMETRY_PID=""
+if [ "$TELEMETRY_INTERVAL" != "0" ]; then
+    report_telemetry &
+    TELEMETRY_PID=$!
+fi
+if [ "$SPARSE" = "1" ]; then
+    echo Writing the mapped ranges only
+    $FETCH 2>/tmp/download.log \
+     | $DECOMPRESS \
+     | write_sparse >/tmp/dd.log 2>&1
+else
+    $FETCH 2>/tmp/download.log \
+     | $DECOMPRESS \
+     | dd of=$STORAGE conv=fsync obs=1M >/tmp/dd.log 2>&1
+fi
 RETCODE=$?
+if [ -n "$TELEMETRY_PID" ]; then
+    kill $TELEMETRY_PID
+fi
+phase_end
 if [ $RETCODE -eq 0 ]; then
     echo Original image written successfully
     ALLDONE="1"
@@ -908,16 +2251,21 @@ if [ $RETCODE -eq 0 ]; then
     fi
 else
     echo Writing image failed.
+    cat /tmp/download.log >>/tmp/dd.log
     if [ "$STATUS_LED" != "NONE" ]; then
         kill $BLINK_PID
         echo ${{LED_FAILURE_STATE}} > /sys/class/gpio/gpio$STATUS_LED/value
     fi
+    send_telemetry 1 /tmp/telemetry
     curl --retry 10 -g -F 'log=@/tmp/dd.log' "http://${{SERVER}}/scriptexecute/error?serial=${{SERIAL}}&retcode=$RETCODE&phase=dd&start=${{STARTTIME}}"
     exit 1
 fi
 
+phase_start partprobe
 partprobe $STORAGE
 sleep 0.1
+phase_end
+send_telemetry 1 /tmp/telemetry
 
 TEMP=vcgencmd measure_temp
 curl --retry 10 -g "http://${{SERVER}}/scriptexecute/alldone?serial=${{SERIAL}}&alldone=${{ALLDONE}}&temp=${{TEMP}}&verify=&start=${{STARTTIME}}"
@@ -928,65 +2276,195 @@ echo "Provisioning completed successfully!"
 """
         return script
 
-    def _getImageActiveNameAndCmStatusLed(
-        self, p_targetFlashSize: Optional[int] = None
+    def _preloadActiveProject(self) -> None:
+        """
+        Load the images of the active project, and their ready encodings, in
+        the memory tier.
+        """
+        status, project = self.projectManager.getActiveProject()
+        if not status:
+            return
+        names = list(
+            dict.fromkeys(
+                project[key]
+                for key in ("image8Gb", "image16Gb", "image32Gb")
+                if project.get(key)
+            )
+        )
+        entries = []
+        for name in names:
+            entry = self.imageCatalog.get(name)
+            if entry is None:
+                continue
+            entries.append(entry)
+            for encoding in self.imageEncoder.encodings:
+                variant = self.imageEncoder.get(name, encoding)
+                if variant is not None:
+                    entries.append(variant)
+        self.imageMemoryTier.preload(names, entries)
+
+    async def _getCatalogEntry(
+        self, p_catalog: FileCatalog, p_name: str
+    ) -> Optional[dict[str, Any]]:
+        """
+        Get the entry of a file. A file missing from the catalog is looked up
+        on disk in an I/O thread, the event loop never reads the disk.
+
+        :param p_catalog: The catalog of the file
+        :type p_catalog: FileCatalog
+        :param p_name: The file name
+        :type p_name: str
+
+        :return: The entry, None if the file does not exist
+        :rtype: dict
+        """
+        entry = p_catalog.entries.get(p_name)
+        if entry is None:
+            entry = await self.io.run(p_catalog.refresh, p_name)
+
+        return entry
+
+    def _isRework(self, p_serial: str) -> bool:
+        """
+        Check if a CM was already provisioned before its current provisioning.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+
+        :return: True if the serial number has more than one result
+        :rtype: bool
+        """
+        results = self.resultManager.getResultsBySerial(p_serial, 2)
+        return "error" not in results and len(results) >= 2
+
+    async def _publishDownloadQueue(self, p_status: dict[str, Any]) -> None:
+        """
+        Publish the status of the image downloads to the WebSocket clients.
+
+        :param p_status: The status of the download scheduler
+        :type p_status: dict
+        """
+        if self.hub is not None:
+            # Every worker process has its own download queue
+            p_status = {**p_status, "worker": os.getpid()}
+        await self._publishToWebsockets({"downloadQueue": p_status})
+
+    async def _handleWebsocketMessage(
+        self, p_websocket: WebSocket, p_message: str
     ) -> None:
         """
-        Get the image name of the active project.
+        Handle a message of a WebSocket client. {"subscribe": {...}} sets the
+        filters of the client, the other messages only keep it alive.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        :param p_message: The message
+        :type p_message: str
         """
-        targetFlashSize = 7
-        if p_targetFlashSize is not None:
-            targetFlashSize: float = float(p_targetFlashSize)
-            targetFlashSize = (targetFlashSize * 512) / (1024 * 1024 * 1024)
+        try:
+            request = json.loads(p_message)
+        except ValueError:
+            return
+        if not isinstance(request, dict) or "subscribe" not in request:
+            return
+        try:
+            filters = request["subscribe"]
+            if not isinstance(filters, dict):
+                raise ValueError("'subscribe' must be an object")
+            subscription = self.websocketBroadcaster.parseSubscription(filters)
+            since = filters.get("since")
+            if since is not None and not isinstance(since, int):
+                raise ValueError("'since' must be an integer")
+        except ValueError as e:
+            self.websocketBroadcaster.send(p_websocket, {"error": str(e)})
+            return
+        await self.websocketBroadcaster.subscribe(
+            p_websocket,
+            subscription,
+            filters.get("stream"),
+            since,
+            self._websocketSnapshot,
+        )
 
-        self.imageName = ""
-        status, name = self.projectManager.getActiveProjectName()
-        if status:
-            status, imageName8Gb, imageName16Gb, imageName32Gb = (
-                self.projectManager.getImagesFromProject(name)
-            )
-            if status:
-                if targetFlashSize <= 8:
-                    logging.info(f"8Gb selected, image: {imageName8Gb}")
-                    self.imageName = imageName8Gb
-                elif targetFlashSize >= 8 and targetFlashSize <= 16:
-                    logging.info("16Gb selected, image: {imageName16Gb}")
-                    self.imageName = imageName16Gb
-                else:
-                    logging.info(f"32Gb selected, image: {imageName32Gb}")
-                    self.imageName = imageName32Gb
+    async def _websocketSnapshot(
+        self, p_subscription: dict[str, Any]
+    ) -> dict[Any, Any]:
+        """
+        Get the in-progress provisionings matching a WebSocket subscription,
+        read on the result store thread.
 
-            status, project = self.projectManager.getProject(name)
-            if status:
-                if int(project["cmStatusLed"]) != -1:
-                    self.cmStatusLed = str((project["cmStatusLed"]))
-                if project["cmStatusLedOnOnsuccess"]:
-                    self.cmStatusLedOnOnsuccess = "1"
-                else:
-                    self.cmStatusLedOnOnsuccess = "0"
-                if project["eeprom"] != "":
-                    self.eeprom = project["eeprom"]
+        :param p_subscription: The subscription
+        :type p_subscription: dict
 
-    async def _publishToWebsockets(self, data: dict):
+        :return: The results, as {serial: {timestamp: result}}
+        :rtype: dict
         """
-        Publish data to all connected WebSocket clients.
+        return await self.io.runResults(self._readWebsocketSnapshot, p_subscription)
 
-        :param data: The data to send
-        :type data: dict
+    def _readWebsocketSnapshot(self, p_subscription: dict[str, Any]) -> dict[Any, Any]:
         """
+        Get the in-progress provisionings matching a WebSocket subscription,
+        started in the last WEBSOCKET_SNAPSHOT_HOURS hours.
 
-        async def send_to_websocket(websocket):
-            try:
-                await websocket.send_json(data)  # Await the coroutine
-            except Exception as e:
-                logging.error(f"Error sending data to WebSocket client: {e}")
-                self.activeWebsockets.remove(websocket)
+        :param p_subscription: The subscription
+        :type p_subscription: dict
+
+        :return: The results, as {serial: {timestamp: result}}
+        :rtype: dict
+        """
+        snapshot: dict[str, dict[str, Any]] = defaultdict(dict)
+        if (
+            p_subscription["state"] is not None
+            and "started" not in p_subscription["state"]
+        ):
+            return snapshot
+        # The filters with a single value are passed to the query
+        single = {
+            field: next(iter(p_subscription[field]))
+            for field in ("project", "serial")
+            if p_subscription[field] is not None and len(p_subscription[field]) == 1
+        }
+        query = ResultQuery(
+            p_serial=single.get("serial"),
+            p_projectName=single.get("project"),
+            p_state="started",
+            p_since=(
+                datetime.now() - timedelta(hours=self.WEBSOCKET_SNAPSHOT_HOURS)
+            ).isoformat(),
+        )
+        for fields, record in self.resultManager.queryResults(query):
+            eventFields = {
+                "project": fields["projectName"],
+                "serial": fields["serial"],
+                "state": fields["state"],
+            }
+            if self.websocketBroadcaster.matches(p_subscription, eventFields):
+                snapshot[fields["serial"]][fields["timestamp"]] = record
+
+        return snapshot
+
+    def _publishEvent(self, p_data: dict[str, Any]) -> None:
+        """
+        Publish a provisioning event to the WebSocket clients, of all the
+        workers with several worker processes.
+
+        :param p_data: The event
+        :type p_data: dict
+        """
+        if self.hub is not None:
+            self.hub.publish("websocket", p_data)
+        else:
+            self.websocketBroadcaster.publish(p_data)
 
-        # Create a list of coroutines for all active websockets
-        tasks = [send_to_websocket(ws) for ws in self.activeWebsockets]
+    async def _publishToWebsockets(self, data: dict):
+        """
+        Publish data to all connected WebSocket clients. The data is queued
+        for every client, see WebsocketBroadcaster, it is not awaited to be sent.
 
-        # Run all tasks concurrently
-        await asyncio.gather(*tasks)  # Await the gathered tasks directly
+        :param data: The data to send
+        :type data: dict
+        """
+        self._publishEvent(data)
 
 
 # Create an instance of the HttpServer class for use
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from fileCatalog import FileCatalog
+from fileLock import FileLock
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ImageEncoder:
+    """
+    Additional encodings of the xz images, faster to decompress on the CMs.
+
+    After its upload, every xz image is transcoded by a pool of worker
+    threads, with the xz, zstd and lz4 command line tools, into
+    "<directory>/.encodings/<image>.<encoding>" with a
+    "<image>.<encoding>.json" file holding the SHA256 checksum of the image
+    it was built from, and the size and SHA256 checksum of the variant.
+
+    The CMs get the ready encodings allowed for their model and memory size,
+    in order of preference, and download the first one they can decompress.
+    xz, the original image, is always the last choice.
+    """
+
+    directory: str
+    catalog: FileCatalog
+    encodings: list[str]
+    variants: dict[str, dict[str, dict[str, Any]]]
+    READ_SIZE = 1024 * 1024
+    # "minMemory" is the minimal MemTotal of the CM in kB, "models" the
+    # models allowed to use the encoding, all if not set
+    ENCODINGS: dict[str, dict[str, Any]] = {
+        "zstd": {
+            "encode": ["zstd", "-q", "-c", "-T0", "-10", "--long=27"],
+            "tool": "zstd",
+            "decode": "zstd -dc --long=27",
+            "minMemory": 512 * 1024,
+        },
+        "lz4": {
+            "encode": ["lz4", "-q", "-c", "-9"],
+            "tool": "lz4",
+            "decode": "lz4 -dc",
+        },
+        "raw": {
+            "encode": None,
+            "tool": "cat",
+            "decode": "cat",
+            # Only worth it with a gigabit link
+            "models": ["Compute Module 4"],
+        },
+    }
+
+    def __init__(
+        self, p_directory: str, p_catalog: FileCatalog, p_encodings: list[str]
+    ) -> None:
+        """
+        Constructor
+
+        :param p_directory: The directory of the images
+        :type p_directory: str
+        :param p_catalog: The catalog of the images
+        :type p_catalog: FileCatalog
+        :param p_encodings: The encodings to build, in order of preference
+        :type p_encodings: list[str]
+        """
+        self.directory = p_directory
+        self.catalog = p_catalog
+        self.encodings = []
+        self.variants = {}
+        self._lock = threading.Lock()
+        self._pending: set[tuple[str, str]] = set()
+        self._invalid: dict[tuple[str, str], str] = {}
+        self._stopEvent = threading.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.setEncodings(p_encodings)
+
+    def setEncodings(self, p_encodings: list[str]) -> None:
+        """
+        Set the encodings to build, in order of preference.
+
+        :param p_encodings: The encodings, among "zstd", "lz4" and "raw"
+        :type p_encodings: list[str]
+
+        :raises ValueError: If an encoding is unknown
+        """
+        for encoding in p_encodings:
+            if encoding not in self.ENCODINGS:
+                raise ValueError(f"Unknown image encoding '{encoding}'")
+        self.encodings = list(p_encodings)
+
+    def variantPath(self, p_name: str, p_encoding: str) -> str:
+        """
+        Get the path of an encoding of an image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+
+        :return: The variant file
+        :rtype: str
+        """
+        return os.path.join(self.directory, ".encodings", f"{p_name}.{p_encoding}")
+
+    def lockPath(self, p_name: str, p_encoding: str) -> str:
+        """
+        Get the lock file held while an encoding of an image is built.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+
+        :return: The lock file
+        :rtype: str
+        """
+        return os.path.join(
+            self.directory, ".encodings", f".{p_name}.{p_encoding}.lock"
+        )
+
+    def _loadVariant(
+        self, p_entry: dict[str, Any], p_encoding: str
+    ) -> Optional[dict[str, Any]]:
+        """
+        Read the metadata of a stored variant.
+
+        :param p_entry: The catalog entry of the image
+        :type p_entry: dict
+        :param p_encoding: The encoding
+        :type p_encoding: str
+
+        :return: The variant, None if missing or built from another image
+        :rtype: dict
+        """
+        path = self.variantPath(p_entry["name"], p_encoding)
+        try:
+            with open(f"{path}.json", "r") as file:
+                variant = json.load(file)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+        if variant.get("source") != p_entry["sha256sum"] or variant["size"] != size:
+            return None
+        variant["path"] = path
+
+        return variant
+
+    def _encode(
+        self, p_sourcePath: str, p_encoding: str, p_path: str
+    ) -> Optional[tuple[int, str]]:
+        """
+        Transcode a xz image, hashing the variant while it is written.
+
+        :param p_sourcePath: The xz image file
+        :type p_sourcePath: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+        :param p_path: The variant file
+        :type p_path: str
+
+        :return: The size and SHA256 checksum of the variant, None if interrupted
+        :rtype: tuple[int, str]
+
+        :raises RuntimeError: If a tool fails
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        decoder = subprocess.Popen(
+            ["xz", "-dc", p_sourcePath],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        processes = [decoder]
+        output = decoder.stdout
+        command = self.ENCODINGS[p_encoding]["encode"]
+        if command is not None:
+            encoder = subprocess.Popen(
+                command,
+                stdin=decoder.stdout,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            # Only the encoder reads the output of the decoder
+            decoder.stdout.close()
+            processes.append(encoder)
+            output = encoder.stdout
+        try:
+            with open(p_path, "wb") as file:
+                while chunk := output.read(self.READ_SIZE):
+                    if self._stopEvent.is_set():
+                        return None
+                    sha256.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
+            output.close()
+            for process in processes:
+                if self._stopEvent.is_set():
+                    process.kill()
+                process.wait()
+        for process in processes:
+            with process.stderr:
+                if process.returncode != 0:
+                    error = process.stderr.read().decode(errors="replace").strip()
+                    raise RuntimeError(f"{process.args[0]} failed: {error}")
+
+        return size, sha256.hexdigest()
+
+    def _encodeImage(
+        self, p_name: str, p_entry: dict[str, Any], p_encoding: str
+    ) -> Optional[dict[str, Any]]:
+        """
+        Build and store an encoding of an image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_entry: The catalog entry of the image
+        :type p_entry: dict
+        :param p_encoding: The encoding
+        :type p_encoding: str
+
+        :return: The variant, None if interrupted
+        :rtype: dict
+        """
+        logging.info(f"Encoding {p_name} with {p_encoding}")
+        path = self.variantPath(p_name, p_encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        try:
+            encoded = self._encode(p_entry["path"], p_encoding, tmpPath)
+            if encoded is None:
+                return None
+            os.replace(tmpPath, path)
+        except Exception:
+            # Not rebuilt until the image changes
+            with self._lock:
+                self._invalid[(p_name, p_encoding)] = p_entry["sha256sum"]
+            raise
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        variant = {
+            "source": p_entry["sha256sum"],
+            "size": encoded[0],
+            "sha256sum": encoded[1],
+        }
+        with open(f"{path}.json", "w") as file:
+            json.dump(variant, file)
+        variant["path"] = path
+        logging.info(
+            f"Encoded {p_name} with {p_encoding}: {variant['size']} bytes, "
+            f"{p_entry['size']} with xz"
+        )
+
+        return variant
+
+    def _build(self, p_name: str, p_encoding: str) -> None:
+        """
+        Build and store an encoding of an image, if not up to date.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+        """
+        entry = self.catalog.get(p_name)
+        if entry is None or entry["sha256sum"] is None:
+            return
+        variant = self._loadVariant(entry, p_encoding)
+        if variant is None:
+            # Built by one of the worker processes, loaded by the others
+            with FileLock(self.lockPath(p_name, p_encoding), self._stopEvent):
+                variant = self._loadVariant(entry, p_encoding) or self._encodeImage(
+                    p_name, entry, p_encoding
+                )
+            if variant is None:
+                return
+
+        with self._lock:
+            self.variants.setdefault(p_name, {})[p_encoding] = variant
+
+    def _run(self, p_name: str, p_encoding: str) -> None:
+        """
+        Worker target building an encoding of an image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+        """
+        try:
+            if not self._stopEvent.is_set():
+                self._build(p_name, p_encoding)
+        except InterruptedError:
+            # Stopped while another process was building it
+            pass
+        except Exception as e:
+            logging.error(f"Error encoding {p_name} with {p_encoding}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard((p_name, p_encoding))
+
+    def schedule(self, p_name: str) -> None:
+        """
+        Schedule the build of the encodings of a xz image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        """
+        if not p_name.endswith(".xz") or self._executor is None:
+            return
+        for encoding in self.encodings:
+            with self._lock:
+                if (p_name, encoding) in self._pending:
+                    continue
+                self._pending.add((p_name, encoding))
+            self._executor.submit(self._run, p_name, encoding)
+
+    def get(self, p_name: str, p_encoding: str) -> Optional[dict[str, Any]]:
+        """
+        Get an encoding of an image. A missing or outdated encoding is
+        scheduled to be built.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_encoding: The encoding
+        :type p_encoding: str
+
+        :return: The path, size and SHA256 checksum of the variant, None if
+            not available
+        :rtype: dict
+        """
+        entry = self.catalog.get(p_name)
+        if entry is None or p_encoding not in self.encodings:
+            return None
+        variant = self.variants.get(p_name, {}).get(p_encoding)
+        if variant is not None and variant["source"] == entry["sha256sum"]:
+            return variant
+        if self._invalid.get((p_name, p_encoding)) != entry["sha256sum"]:
+            self.schedule(p_name)
+
+        return None
+
+    def negotiate(self, p_name: str, p_model: str, p_memorySize: int) -> list[str]:
+        """
+        Get the ready encodings of an image a CM may use, in order of
+        preference.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_model: The model of the CM
+        :type p_model: str
+        :param p_memorySize: The memory size of the CM in kB
+        :type p_memorySize: int
+
+        :return: The encodings
+        :rtype: list[str]
+        """
+        encodings = []
+        for encoding in self.encodings:
+            options = self.ENCODINGS[encoding]
+            if p_memorySize < options.get("minMemory", 0):
+                continue
+            models = options.get("models")
+            if models is not None and not any(model in p_model for model in models):
+                continue
+            if self.get(p_name, encoding) is not None:
+                encodings.append(encoding)
+
+        return encodings
+
+    def remove(self, p_name: str) -> None:
+        """
+        Remove the encodings of a deleted image.
+
+        :param p_name: The image file name
+        :type p_name: str
+        """
+        with self._lock:
+            self.variants.pop(p_name, None)
+            for encoding in self.ENCODINGS:
+                self._invalid.pop((p_name, encoding), None)
+        for encoding in self.ENCODINGS:
+            path = self.variantPath(p_name, encoding)
+            for file in (path, f"{path}.json"):
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def start(self, p_workers: int) -> None:
+        """
+        Start the worker pool, and schedule the images not encoded yet.
+
+        :param p_workers: The number of images encoded at once
+        :type p_workers: int
+        """
+        if not self.encodings:
+            return
+        for encoding in self.encodings:
+            command = self.ENCODINGS[encoding]["encode"]
+            if command is not None and shutil.which(command[0]) is None:
+                logging.error(f"{command[0]} not found, images are not encoded")
+                return
+        self._stopEvent.clear()
+        self._executor = ThreadPoolExecutor(
+            max_workers=p_workers, thread_name_prefix="imageEncoder"
+        )
+        for name in self.catalog.list():
+            self.schedule(name)
+
+    def stop(self) -> None:
+        """
+        Stop the worker pool, interrupting the encodings being built.
+        """
+        if self._executor is not None:
+            self._stopEvent.set()
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
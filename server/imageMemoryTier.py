@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ImageMemoryTier:
+    """
+    Copies in RAM of the images of the active project, and of their
+    encodings, so the downloads of the CMs do not compete with the uploads
+    and the result writes for the disk.
+
+    The files are copied by a background thread into a tmpfs directory,
+    under a memory budget. When the budget is reached, the least recently
+    downloaded files are evicted. A copy is only served for the SHA256
+    checksum of the file it was made from, a replaced file is copied again.
+
+    With several HTTP worker processes, only the owner, the primary worker,
+    copies and evicts the files. The other workers serve the copies found in
+    the directory, named after the checksum of their file.
+    """
+
+    directory: str
+    budget: int
+    owner: bool
+    used: int
+    wanted: set[str]
+    entries: "OrderedDict[str, dict[str, Any]]"
+    COPY_PATTERN = re.compile(r"^(\.)?[0-9a-f]{64}-")
+
+    def __init__(self, p_directory: str, p_budget: int = 0) -> None:
+        """
+        Constructor
+
+        :param p_directory: The tmpfs directory of the copies
+        :type p_directory: str
+        :param p_budget: The memory budget in bytes, 0 to disable the tier
+        :type p_budget: int
+        """
+        self.directory = p_directory
+        self.budget = p_budget
+        self.owner = True
+        self.used = 0
+        self.wanted = set()
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[Optional[dict[str, Any]]] = queue.Queue()
+        self._pending: set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def _copyPath(self, p_entry: dict[str, Any]) -> str:
+        """
+        Get the path of the copy of a file.
+
+        :param p_entry: The catalog entry or the encoding of the file
+        :type p_entry: dict
+
+        :return: The copy in the tmpfs directory
+        :rtype: str
+        """
+        return os.path.join(
+            self.directory,
+            f"{p_entry['sha256sum']}-{os.path.basename(p_entry['path'])}",
+        )
+
+    def _evict(self, p_path: str) -> None:
+        """
+        Remove the copy of a file. The lock must be held.
+
+        :param p_path: The path of the original file
+        :type p_path: str
+        """
+        copy = self.entries.pop(p_path, None)
+        if copy is None:
+            return
+        self.used -= copy["size"]
+        try:
+            os.remove(copy["copyPath"])
+        except FileNotFoundError:
+            pass
+        logging.info(f"Evicted {os.path.basename(p_path)} from the memory tier")
+
+    def _load(self, p_entry: dict[str, Any]) -> None:
+        """
+        Copy a file into the tmpfs directory, evicting the least recently
+        used copies to stay under the budget.
+
+        :param p_entry: The catalog entry or the encoding of the file
+        :type p_entry: dict
+        """
+        path = p_entry["path"]
+        size = os.path.getsize(path)
+        with self._lock:
+            copy = self.entries.get(path)
+            if copy is not None and copy["sha256sum"] == p_entry["sha256sum"]:
+                return
+            self._evict(path)
+            if size > self.budget:
+                logging.warning(
+                    f"{os.path.basename(path)} does not fit in the memory tier"
+                )
+                return
+            while self.entries and self.used + size > self.budget:
+                self._evict(next(iter(self.entries)))
+            # Keep the space while copying
+            self.used += size
+
+        copyPath = self._copyPath(p_entry)
+        tmpPath = os.path.join(self.directory, f".{os.path.basename(copyPath)}.tmp")
+        try:
+            if shutil.disk_usage(self.directory).free < size:
+                raise OSError(f"Not enough space in {self.directory}")
+            shutil.copyfile(path, tmpPath)
+            os.replace(tmpPath, copyPath)
+        except Exception:
+            with self._lock:
+                self.used -= size
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        with self._lock:
+            self.entries[path] = {
+                "copyPath": copyPath,
+                "size": size,
+                "sha256sum": p_entry["sha256sum"],
+                "hits": 0,
+            }
+        logging.info(
+            f"Loaded {os.path.basename(path)} in the memory tier: {self.used} of "
+            f"{self.budget} bytes used"
+        )
+
+    def _run(self) -> None:
+        """
+        Thread target copying the scheduled files.
+        """
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            try:
+                self._load(entry)
+            except Exception as e:
+                logging.error(f"Error loading {entry['path']} in the memory tier: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(entry["path"])
+
+    def _schedule(self, p_entry: dict[str, Any]) -> None:
+        """
+        Schedule the copy of a file.
+
+        :param p_entry: The catalog entry or the encoding of the file
+        :type p_entry: dict
+        """
+        if self._thread is None or p_entry["sha256sum"] is None:
+            return
+        with self._lock:
+            if p_entry["path"] in self._pending:
+                return
+            self._pending.add(p_entry["path"])
+        self._queue.put(p_entry)
+
+    def preload(self, p_names: list[str], p_entries: list[dict[str, Any]]) -> None:
+        """
+        Set the images kept in the tier, and schedule the copy of their files.
+
+        :param p_names: The image file names
+        :type p_names: list[str]
+        :param p_entries: The catalog entries and the encodings of the images
+        :type p_entries: list[dict]
+        """
+        if self.budget <= 0:
+            return
+        self.wanted = set(p_names)
+        for entry in p_entries:
+            self._schedule(entry)
+
+    def resolve(self, p_name: str, p_entry: dict[str, Any]) -> Optional[str]:
+        """
+        Get the copy of a file to serve. A missing or outdated copy of a file
+        of a preloaded image is scheduled.
+
+        :param p_name: The image file name
+        :type p_name: str
+        :param p_entry: The catalog entry or the encoding of the file
+        :type p_entry: dict
+
+        :return: The path of the copy, None to serve the original file
+        :rtype: str
+        """
+        if self.budget <= 0:
+            return None
+        if not self.owner:
+            copyPath = self._copyPath(p_entry)
+            return copyPath if os.path.exists(copyPath) else None
+        with self._lock:
+            copy = self.entries.get(p_entry["path"])
+            if copy is not None and copy["sha256sum"] == p_entry["sha256sum"]:
+                self.entries.move_to_end(p_entry["path"])
+                copy["hits"] += 1
+                return copy["copyPath"]
+        if p_name in self.wanted:
+            self._schedule(p_entry)
+
+        return None
+
+    def remove(self, p_name: str) -> None:
+        """
+        Remove the copies of a deleted image and of its encodings.
+
+        :param p_name: The image file name
+        :type p_name: str
+        """
+        self.wanted.discard(p_name)
+        with self._lock:
+            for path in list(self.entries):
+                basename = os.path.basename(path)
+                if basename == p_name or basename.startswith(f"{p_name}."):
+                    self._evict(path)
+
+    def getStatus(self) -> dict[str, Any]:
+        """
+        Get the content of the tier.
+
+        :return: The budget, the used memory and the copies, least recently
+            used first
+        :rtype: dict
+        """
+        if not self.owner:
+            return self._getSharedStatus()
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "used": self.used,
+                "images": sorted(self.wanted),
+                "files": [
+                    {
+                        "file": os.path.basename(path),
+                        "size": copy["size"],
+                        "sha256sum": copy["sha256sum"],
+                        "hits": copy["hits"],
+                    }
+                    for path, copy in self.entries.items()
+                ],
+            }
+
+    def _getSharedStatus(self) -> dict[str, Any]:
+        """
+        Get the copies made by the owner, found in the directory.
+
+        :return: The budget, the used memory and the copies
+        :rtype: dict
+        """
+        files = []
+        if self.budget > 0 and os.path.isdir(self.directory):
+            for file in sorted(os.listdir(self.directory)):
+                if self.COPY_PATTERN.match(file) and not file.startswith("."):
+                    sha256sum, name = file.split("-", 1)
+                    try:
+                        size = os.path.getsize(os.path.join(self.directory, file))
+                    except FileNotFoundError:
+                        continue
+                    files.append({"file": name, "size": size, "sha256sum": sha256sum})
+
+        return {
+            "budget": self.budget,
+            "used": sum(file["size"] for file in files),
+            "images": sorted(self.wanted),
+            "files": files,
+        }
+
+    def _clear(self) -> None:
+        """
+        Remove all the copies, also the ones left by a previous run.
+        """
+        with self._lock:
+            self.entries.clear()
+            self.used = 0
+        for file in os.listdir(self.directory):
+            if self.COPY_PATTERN.match(file):
+                os.remove(os.path.join(self.directory, file))
+
+    def start(self) -> None:
+        """
+        Start the copy thread, in the owner.
+        """
+        if self.budget <= 0 or not self.owner:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._clear()
+        total = shutil.disk_usage(self.directory).total
+        if total < self.budget:
+            logging.warning(
+                f"{self.directory} is {total} bytes, less than the memory tier budget"
+            )
+            self.budget = total
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the copy thread and free the memory of the copies.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._clear()
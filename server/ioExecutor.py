@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar, Union
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+T = TypeVar("T")
+
+
+class IoExecutor:
+    """
+    Threads running the blocking disk work of the request handlers, so the
+    event loop keeps streaming the image downloads meanwhile.
+
+    The file system work, and the hashing of the uploads, runs on a pool of
+    a bounded number of threads, the requests beyond wait in its queue. The
+    calls to the result store run one at a time, in order, on a dedicated
+    thread: the store is not shared between threads writing at once.
+    """
+
+    workers: int
+
+    def __init__(self, p_workers: int = 4) -> None:
+        """
+        Constructor
+
+        :param p_workers: The number of threads of the file system work
+        :type p_workers: int
+        """
+        self.workers = p_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._resultExecutor: Optional[ThreadPoolExecutor] = None
+
+    async def _submit(
+        self,
+        p_executor: Optional[ThreadPoolExecutor],
+        p_function: Callable[..., T],
+        *p_args: Any,
+        **p_kwargs: Any,
+    ) -> T:
+        """
+        Run a function on an executor.
+
+        :param p_executor: The executor
+        :type p_executor: ThreadPoolExecutor
+        :param p_function: The blocking function
+        :type p_function: Callable
+
+        :return: The result of the function
+        :rtype: Any
+
+        :raises RuntimeError: If the executor is not started
+        """
+        if p_executor is None:
+            raise RuntimeError("The I/O executor is not started")
+
+        return await asyncio.get_running_loop().run_in_executor(
+            p_executor, functools.partial(p_function, *p_args, **p_kwargs)
+        )
+
+    async def run(
+        self, p_function: Callable[..., T], *p_args: Any, **p_kwargs: Any
+    ) -> T:
+        """
+        Run a blocking file system function on the pool.
+
+        :param p_function: The blocking function
+        :type p_function: Callable
+
+        :return: The result of the function
+        :rtype: Any
+        """
+        return await self._submit(self._executor, p_function, *p_args, **p_kwargs)
+
+    async def runResults(
+        self, p_function: Callable[..., T], *p_args: Any, **p_kwargs: Any
+    ) -> T:
+        """
+        Run a call to the result store on its thread, after the previous ones.
+
+        :param p_function: The result store method
+        :type p_function: Callable
+
+        :return: The result of the method
+        :rtype: Any
+        """
+        return await self._submit(self._resultExecutor, p_function, *p_args, **p_kwargs)
+
+    async def makedirs(self, p_path: str) -> None:
+        """
+        Create a directory and its parents, if missing.
+
+        :param p_path: The directory
+        :type p_path: str
+        """
+        await self.run(os.makedirs, p_path, exist_ok=True)
+
+    @staticmethod
+    def _writeFile(p_path: str, p_content: Union[str, bytes]) -> None:
+        """
+        Write a file.
+
+        :param p_path: The file
+        :type p_path: str
+        :param p_content: The text or the bytes to write
+        :type p_content: str or bytes
+        """
+        with open(p_path, "wb" if isinstance(p_content, bytes) else "w") as file:
+            file.write(p_content)
+
+    async def writeFile(self, p_path: str, p_content: Union[str, bytes]) -> None:
+        """
+        Write a file.
+
+        :param p_path: The file
+        :type p_path: str
+        :param p_content: The text or the bytes to write
+        :type p_content: str or bytes
+        """
+        await self.run(self._writeFile, p_path, p_content)
+
+    @staticmethod
+    def _remove(p_path: str, p_missingOk: bool) -> None:
+        """
+        Remove a file.
+
+        :param p_path: The file
+        :type p_path: str
+        :param p_missingOk: Do not raise if the file does not exist
+        :type p_missingOk: bool
+        """
+        try:
+            os.remove(p_path)
+        except FileNotFoundError:
+            if not p_missingOk:
+                raise
+
+    async def remove(self, p_path: str, p_missingOk: bool = False) -> None:
+        """
+        Remove a file.
+
+        :param p_path: The file
+        :type p_path: str
+        :param p_missingOk: Do not raise if the file does not exist
+        :type p_missingOk: bool
+
+        :raises FileNotFoundError: If the file does not exist and not p_missingOk
+        """
+        await self.run(self._remove, p_path, p_missingOk)
+
+    def start(self) -> None:
+        """
+        Start the threads.
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, self.workers), thread_name_prefix="io"
+        )
+        self._resultExecutor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="results"
+        )
+
+    def stop(self) -> None:
+        """
+        Stop the threads, after the queued work.
+        """
+        for executor in (self._executor, self._resultExecutor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._executor = None
+        self._resultExecutor = None
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from serverMetrics import ServerMetrics
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class LoopWatchdog:
+    """
+    Detection of the callbacks blocking the event loop.
+
+    A task of the event loop beats regularly. A thread checks the beats, and
+    when the loop did not beat for longer than the threshold, it logs the
+    stack of the event loop thread, which shows the blocking callback, then
+    the total blocking time once the loop beats again.
+    """
+
+    threshold: float
+
+    def __init__(self, p_threshold: float = 0.1) -> None:
+        """
+        Constructor
+
+        :param p_threshold: The blocking time logged, in seconds, 0 to disable
+        :type p_threshold: float
+        """
+        self.threshold = p_threshold
+        self._lastBeat = 0.0
+        self._loopThreadId: Optional[int] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopEvent = threading.Event()
+
+    async def _beat(self) -> None:
+        """
+        Task beating until cancelled.
+        """
+        while True:
+            self._lastBeat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self) -> None:
+        """
+        Thread target checking the beats of the event loop.
+        """
+        # The last beat before the blocking being reported
+        blockedBeat: Optional[float] = None
+        while not self._stopEvent.wait(self.threshold / 2):
+            lastBeat = self._lastBeat
+            if blockedBeat is not None and lastBeat != blockedBeat:
+                logging.warning(
+                    f"Event loop was blocked for {lastBeat - blockedBeat:.3f} s"
+                )
+                blockedBeat = None
+            blocked = time.monotonic() - lastBeat
+            if blockedBeat is None and blocked > self.threshold:
+                blockedBeat = lastBeat
+                frame = sys._current_frames().get(self._loopThreadId or 0)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                ServerMetrics.eventLoopBlocked.inc()
+                logging.warning(
+                    f"Event loop blocked for more than {blocked:.3f} s in:\n{stack}"
+                )
+
+    def start(self) -> None:
+        """
+        Start the watchdog, from the event loop.
+        """
+        if self.threshold <= 0:
+            return
+        self._loopThreadId = threading.get_ident()
+        self._lastBeat = time.monotonic()
+        self._stopEvent.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        """
+        Stop the watchdog.
+        """
+        if self._task is None:
+            return
+        self._stopEvent.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+# Packet header: magic, session identifier, kind and index. The index is the
+# packet index of a data packet, the FEC group index of a parity packet.
+HEADER = struct.Struct("!4sIBI")
+MAGIC = b"CMMC"
+KIND_DATA = 0
+KIND_PARITY = 1
+KIND_END = 2
+
+
+def xorPayloads(p_payloads: list[bytes], p_size: int) -> bytes:
+    """
+    XOR payloads, padded with zeros to the same size.
+
+    :param p_payloads: The payloads
+    :type p_payloads: list[bytes]
+    :param p_size: The size of the result
+    :type p_size: int
+
+    :return: The XOR of the payloads
+    :rtype: bytes
+    """
+    value = 0
+    for payload in p_payloads:
+        value ^= int.from_bytes(payload.ljust(p_size, b"\x00"), "big")
+
+    return value.to_bytes(p_size, "big")
+
+
+class MulticastSender:
+    """
+    Multicast distribution of the images, in the spirit of udpcast.
+
+    A CM joins the session of its image with /multicast/join. The session
+    starts waitTime seconds after its first receiver joined, and the image
+    is sent once to the multicast group by a thread, paced at the configured
+    rate, in packets of packetSize bytes. Each group of fecGroup packets is
+    followed by a XOR parity packet, so a receiver recovers one lost packet
+    per group, and fetches the others with HTTP range requests.
+
+    A CM joining a session being sent waits for the next session of the
+    image. All the sessions share the multicast group, the packets carry
+    their session identifier.
+    """
+
+    group: str
+    port: int
+    interface: str
+    rate: float
+    waitTime: float
+    packetSize: int
+    fecGroup: int
+    ttl: int
+    sessions: dict[str, dict[str, Any]]
+
+    def __init__(
+        self,
+        p_group: str = "239.255.42.1",
+        p_port: int = 5400,
+        p_interface: str = "0.0.0.0",
+        p_rateMbps: float = 200,
+        p_waitTime: float = 10,
+        p_packetSize: int = 1400,
+        p_fecGroup: int = 16,
+        p_ttl: int = 1,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_group: The multicast group address
+        :type p_group: str
+        :param p_port: The UDP port
+        :type p_port: int
+        :param p_interface: The address of the sending interface
+        :type p_interface: str
+        :param p_rateMbps: The sending rate in Mbit/s
+        :type p_rateMbps: float
+        :param p_waitTime: The time waited for receivers before sending, in seconds
+        :type p_waitTime: float
+        :param p_packetSize: The payload size of the packets
+        :type p_packetSize: int
+        :param p_fecGroup: The number of data packets protected by a parity packet
+        :type p_fecGroup: int
+        :param p_ttl: The multicast TTL
+        :type p_ttl: int
+        """
+        self.group = p_group
+        self.port = p_port
+        self.interface = p_interface
+        self.rate = p_rateMbps * 1000 * 1000 / 8
+        self.waitTime = p_waitTime
+        self.packetSize = p_packetSize
+        self.fecGroup = p_fecGroup
+        self.ttl = p_ttl
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+
+    def join(
+        self, p_key: str, p_path: str, p_size: int, p_sha256sum: str
+    ) -> dict[str, Any]:
+        """
+        Join the next session of a file, created and scheduled if needed.
+
+        :param p_key: The key of the file, e.g. image name and encoding
+        :type p_key: str
+        :param p_path: The file
+        :type p_path: str
+        :param p_size: The file size
+        :type p_size: int
+        :param p_sha256sum: The SHA256 checksum of the file
+        :type p_sha256sum: str
+
+        :return: The session parameters for the receiver
+        :rtype: dict
+        """
+        with self._lock:
+            session = None
+            for candidate in self.sessions.values():
+                if (
+                    candidate["key"] == p_key
+                    and candidate["state"] == "waiting"
+                    and candidate["sha256sum"] == p_sha256sum
+                ):
+                    session = candidate
+                    break
+            if session is None:
+                session = {
+                    "sessionId": uuid.uuid4().int & 0xFFFFFFFF,
+                    "key": p_key,
+                    "path": p_path,
+                    "size": p_size,
+                    "sha256sum": p_sha256sum,
+                    "state": "waiting",
+                    "startTime": time.monotonic() + self.waitTime,
+                    "receivers": 0,
+                }
+                self.sessions[str(session["sessionId"])] = session
+                threading.Thread(
+                    target=self._runSession, args=(session,), daemon=True
+                ).start()
+            session["receivers"] += 1
+
+            return {
+                "sessionId": session["sessionId"],
+                "group": self.group,
+                "port": self.port,
+                "size": session["size"],
+                "packetSize": self.packetSize,
+                "fecGroup": self.fecGroup,
+                "sha256sum": session["sha256sum"],
+                "startsIn": max(0.0, session["startTime"] - time.monotonic()),
+            }
+
+    def _runSession(self, p_session: dict[str, Any]) -> None:
+        """
+        Thread target sending a session once its wait time is over.
+
+        :param p_session: The session
+        :type p_session: dict
+        """
+        try:
+            if self._stopEvent.wait(
+                max(0.0, p_session["startTime"] - time.monotonic())
+            ):
+                return
+            with self._lock:
+                p_session["state"] = "sending"
+            logging.info(
+                f"Multicast session {p_session['sessionId']} of {p_session['key']}: "
+                f"sending to {p_session['receivers']} receivers"
+            )
+            elapsed = self._send(p_session)
+            if elapsed is not None:
+                logging.info(
+                    f"Multicast session {p_session['sessionId']} sent in "
+                    f"{elapsed:.1f} s"
+                )
+        except Exception as e:
+            logging.error(f"Error sending multicast session: {e}")
+        finally:
+            with self._lock:
+                self.sessions.pop(str(p_session["sessionId"]), None)
+
+    def _send(self, p_session: dict[str, Any]) -> Optional[float]:
+        """
+        Send the file of a session, paced at the configured rate.
+
+        :param p_session: The session
+        :type p_session: dict
+
+        :return: The sending duration in seconds, None if interrupted
+        :rtype: float
+        """
+        sessionId = p_session["sessionId"]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_MULTICAST_IF,
+                socket.inet_aton(self.interface),
+            )
+            destination = (self.group, self.port)
+            start = time.monotonic()
+            sent = 0
+            index = 0
+            groupPayloads: list[bytes] = []
+            with open(p_session["path"], "rb") as file:
+                while payload := file.read(self.packetSize):
+                    if self._stopEvent.is_set():
+                        return None
+                    packets = [
+                        HEADER.pack(MAGIC, sessionId, KIND_DATA, index) + payload
+                    ]
+                    groupPayloads.append(payload)
+                    index += 1
+                    if len(groupPayloads) == self.fecGroup:
+                        parity = xorPayloads(groupPayloads, self.packetSize)
+                        packets.append(
+                            HEADER.pack(
+                                MAGIC,
+                                sessionId,
+                                KIND_PARITY,
+                                (index - 1) // self.fecGroup,
+                            )
+                            + parity
+                        )
+                        groupPayloads = []
+                    for packet in packets:
+                        sock.sendto(packet, destination)
+                        sent += len(packet)
+                    # Pace the sending
+                    delay = start + sent / self.rate - time.monotonic()
+                    if delay > 0.001:
+                        time.sleep(delay)
+            if groupPayloads:
+                parity = xorPayloads(groupPayloads, self.packetSize)
+                sock.sendto(
+                    HEADER.pack(
+                        MAGIC, sessionId, KIND_PARITY, (index - 1) // self.fecGroup
+                    )
+                    + parity,
+                    destination,
+                )
+            for _ in range(3):
+                sock.sendto(HEADER.pack(MAGIC, sessionId, KIND_END, index), destination)
+                time.sleep(0.01)
+
+        return time.monotonic() - start
+
+    def getStatus(self) -> list[dict[str, Any]]:
+        """
+        Get the sessions being prepared or sent.
+
+        :return: The key, state and receiver count of the sessions
+        :rtype: list[dict]
+        """
+        with self._lock:
+            return [
+                {
+                    "sessionId": session["sessionId"],
+                    "key": session["key"],
+                    "state": session["state"],
+                    "receivers": session["receivers"],
+                }
+                for session in self.sessions.values()
+            ]
+
+    def stop(self) -> None:
+        """
+        Stop the sessions.
+        """
+        self._stopEvent.set()
+
+
+class MulticastReceiver:
+    """
+    Receiver of a multicast session, writing the file in order to an output
+    while it is received. It runs on the CM, with the Python standard
+    library only.
+
+    The received packets are buffered up to maxBuffer bytes. A packet
+    missing once the stream is past its FEC group is recovered from the
+    parity packet if possible, fetched with a HTTP range request otherwise.
+    """
+
+    def __init__(
+        self,
+        p_server: str,
+        p_image: str,
+        p_encoding: str,
+        p_output: Any,
+        p_interface: str = "0.0.0.0",
+        p_maxBuffer: int = 64 * 1024 * 1024,
+        p_dropRate: float = 0.0,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_server: The server address, "<host>:<port>"
+        :type p_server: str
+        :param p_image: The image name
+        :type p_image: str
+        :param p_encoding: The image encoding
+        :type p_encoding: str
+        :param p_output: The binary output
+        :type p_output: BinaryIO
+        :param p_interface: The address of the receiving interface
+        :type p_interface: str
+        :param p_maxBuffer: The maximal size of the buffered packets
+        :type p_maxBuffer: int
+        :param p_dropRate: The ratio of packets dropped, to simulate losses
+        :type p_dropRate: float
+        """
+        self.server = p_server
+        self.image = p_image
+        self.encoding = p_encoding
+        self.output = p_output
+        self.interface = p_interface
+        self.maxBuffer = p_maxBuffer
+        self.dropRate = p_dropRate
+        self.session: dict[str, Any] = {}
+        self.count = 0
+        self.packets: dict[int, bytes] = {}
+        self.parities: dict[int, bytes] = {}
+        self.buffered = 0
+        self.released = 0
+        self.highest = -1
+        self.ended = False
+        self.lastPacket = time.monotonic()
+        self.stats = {"received": 0, "recovered": 0, "repaired": 0, "dropped": 0}
+        self._condition = threading.Condition()
+
+    def _url(self, p_path: str) -> str:
+        """
+        Build a server URL.
+
+        :param p_path: The path and query
+        :type p_path: str
+
+        :return: The URL
+        :rtype: str
+        """
+        return f"http://{self.server}{p_path}"
+
+    def join(self) -> socket.socket:
+        """
+        Join the multicast session of the image.
+
+        :return: The socket receiving the session
+        :rtype: socket.socket
+        """
+        query = urllib.parse.urlencode({"image": self.image, "encoding": self.encoding})
+        with urllib.request.urlopen(
+            self._url(f"/multicast/join?{query}"), timeout=30
+        ) as response:
+            self.session = json.load(response)
+        self.count = -(-self.session["size"] // self.session["packetSize"])
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("", self.session["port"]))
+        sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton(self.session["group"]) + socket.inet_aton(self.interface),
+        )
+        sock.settimeout(1.0)
+
+        return sock
+
+    def _receive(self, p_sock: socket.socket) -> None:
+        """
+        Thread target storing the packets of the session.
+
+        :param p_sock: The socket receiving the session
+        :type p_sock: socket.socket
+        """
+        bufferSize = HEADER.size + self.session["packetSize"]
+        while not self.ended:
+            try:
+                packet = p_sock.recv(bufferSize)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if len(packet) < HEADER.size:
+                continue
+            magic, sessionId, kind, index = HEADER.unpack_from(packet)
+            if magic != MAGIC or sessionId != self.session["sessionId"]:
+                continue
+            if self.dropRate and random.random() < self.dropRate:
+                continue
+            payload = packet[HEADER.size :]
+            with self._condition:
+                self.lastPacket = time.monotonic()
+                if kind == KIND_DATA:
+                    self.highest = max(self.highest, index)
+                if kind == KIND_END:
+                    self.ended = True
+                elif self.buffered + len(payload) > self.maxBuffer:
+                    self.stats["dropped"] += 1
+                elif kind == KIND_DATA and index not in self.packets:
+                    self.packets[index] = payload
+                    self.buffered += len(payload)
+                    self.stats["received"] += 1
+                elif kind == KIND_PARITY and index not in self.parities:
+                    self.parities[index] = payload
+                    self.buffered += len(payload)
+                self._condition.notify()
+
+    def _packetSize(self, p_index: int) -> int:
+        """
+        Get the payload size of a packet, the last one may be shorter.
+
+        :param p_index: The packet index
+        :type p_index: int
+
+        :return: The payload size
+        :rtype: int
+        """
+        packetSize = self.session["packetSize"]
+        return min(packetSize, self.session["size"] - p_index * packetSize)
+
+    def _recover(self, p_index: int) -> Optional[bytes]:
+        """
+        Recover a missing packet from the parity of its FEC group.
+
+        :param p_index: The packet index
+        :type p_index: int
+
+        :return: The payload, None if more than one packet of the group is missing
+        :rtype: bytes
+        """
+        fecGroup = self.session["fecGroup"]
+        group = p_index // fecGroup
+        parity = self.parities.get(group)
+        if parity is None:
+            return None
+        others = []
+        for index in range(group * fecGroup, min((group + 1) * fecGroup, self.count)):
+            if index == p_index:
+                continue
+            if index not in self.packets:
+                return None
+            others.append(self.packets[index])
+        payload = xorPayloads([parity] + others, self.session["packetSize"])
+
+        return payload[: self._packetSize(p_index)]
+
+    def _repair(self, p_first: int, p_last: int) -> bytes:
+        """
+        Fetch missing packets with a HTTP range request.
+
+        :param p_first: The first missing packet index
+        :type p_first: int
+        :param p_last: The last missing packet index
+        :type p_last: int
+
+        :return: The payloads of the packets
+        :rtype: bytes
+        """
+        packetSize = self.session["packetSize"]
+        start = p_first * packetSize
+        end = min((p_last + 1) * packetSize, self.session["size"]) - 1
+        query = urllib.parse.urlencode({"encoding": self.encoding})
+        request = urllib.request.Request(
+            self._url(f"/downloadimage/{urllib.parse.quote(self.image)}?{query}"),
+            headers={
+                "Range": f"bytes={start}-{end}",
+                "If-Match": f'"{self.session["sha256sum"]}"',
+            },
+        )
+        for attempt in range(10):
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    data = response.read()
+                if len(data) == end - start + 1:
+                    return data
+            except OSError as e:
+                if attempt == 9:
+                    raise
+                logging.warning(f"Repair of {start}-{end} failed: {e}")
+            time.sleep(1)
+        raise RuntimeError(f"Repair of {start}-{end} failed")
+
+    def _isPast(self, p_index: int) -> bool:
+        """
+        Check if the stream is past the FEC group of a packet, or over.
+
+        :param p_index: The packet index
+        :type p_index: int
+
+        :return: True if the packet can not be received anymore
+        :rtype: bool
+        """
+        fecGroup = self.session["fecGroup"]
+        groupEnd = (p_index // fecGroup + 1) * fecGroup
+        return (
+            self.ended
+            or self.highest >= groupEnd + fecGroup
+            or time.monotonic() - self.lastPacket > 5
+        )
+
+    def _release(self, p_end: int) -> None:
+        """
+        Release the buffered packets and parities of the FEC groups written
+        before a packet.
+
+        :param p_end: The first packet index not released, the first of a
+            group or the packet count
+        :type p_end: int
+        """
+        fecGroup = self.session["fecGroup"]
+        for index in range(self.released, p_end):
+            payload = self.packets.pop(index, None)
+            if payload is not None:
+                self.buffered -= len(payload)
+        for group in range(self.released // fecGroup, -(-p_end // fecGroup)):
+            parity = self.parities.pop(group, None)
+            if parity is not None:
+                self.buffered -= len(parity)
+        self.released = p_end
+
+    def run(self) -> dict[str, int]:
+        """
+        Receive the session and write the file in order.
+
+        :return: The number of packets received, recovered with FEC,
+            repaired with HTTP and dropped for lack of buffer
+        :rtype: dict
+        """
+        sock = self.join()
+        # The session may never start sending if it is stopped
+        self.lastPacket = time.monotonic() + self.session["startsIn"] + 10
+        receiver = threading.Thread(target=self._receive, args=(sock,), daemon=True)
+        receiver.start()
+        fecGroup = self.session["fecGroup"]
+        index = 0
+        try:
+            while index < self.count:
+                with self._condition:
+                    while index not in self.packets and not self._isPast(index):
+                        self._condition.wait(0.5)
+                    # The packets are kept until their group is written, to
+                    # recover a missing one from the parity
+                    payload = self.packets.get(index)
+                    if payload is None:
+                        payload = self._recover(index)
+                        if payload is not None:
+                            self.stats["recovered"] += 1
+                if payload is None:
+                    last = index
+                    while (
+                        last + 1 < self.count
+                        and last + 1 not in self.packets
+                        and last - index < 1024
+                    ):
+                        last += 1
+                    payload = self._repair(index, last)
+                    self.stats["repaired"] += last - index + 1
+                    index = last + 1
+                else:
+                    index += 1
+                self.output.write(payload)
+                with self._condition:
+                    if index == self.count:
+                        self._release(index)
+                    else:
+                        self._release(index // fecGroup * fecGroup)
+            self.output.flush()
+        finally:
+            self.ended = True
+            sock.close()
+
+        return self.stats
+
+
+def main() -> int:
+    """
+    Receive an image by multicast and write it to stdout, or to a file.
+
+    :return: The exit code
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(description="Multicast image receiver")
+    parser.add_argument("--server", required=True, help="<host>:<port>")
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--encoding", default="xz")
+    parser.add_argument("--interface", default="0.0.0.0")
+    parser.add_argument("--output", default="-")
+    parser.add_argument("--max-buffer", type=int, default=64 * 1024 * 1024)
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.0, help="Simulated packet loss ratio"
+    )
+    args = parser.parse_args()
+
+    if args.output == "-":
+        output = sys.stdout.buffer
+    else:
+        output = open(args.output, "wb")
+    try:
+        receiver = MulticastReceiver(
+            args.server,
+            args.image,
+            args.encoding,
+            output,
+            args.interface,
+            args.max_buffer,
+            args.drop_rate,
+        )
+        stats = receiver.run()
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    logging.info(f"Multicast reception: {stats}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+from typing import Any, Iterable, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class PhaseTelemetry:
+    """
+    Timings of the phases of the provisioning script, and their aggregation
+    over the results.
+
+    The script reports one line per phase:
+    "<phase> <state> <start> <end> <received> <written> <cpu busy> <cpu total>",
+    the start and the end are the uptime of the CM in seconds, the received
+    and written bytes are the counters of the network interfaces and of the
+    storage over the phase, and the CPU times are jiffies of all the cores.
+    The state is "running" for the phase in progress of a periodic report,
+    "done" otherwise.
+
+    The download, the decompression and the write of the image run at once
+    in a pipeline, they are reported as the single "image" phase. Its
+    received and written throughput, and the average number of busy cores,
+    tell which of the network, the decompressor or the storage limits it.
+    """
+
+    FIELDS = ("duration", "receivedMBps", "writtenMBps", "busyCores")
+
+    @staticmethod
+    def _rate(p_bytes: int, p_duration: float) -> Optional[float]:
+        """
+        Compute a throughput.
+
+        :param p_bytes: The number of bytes
+        :type p_bytes: int
+        :param p_duration: The duration in seconds
+        :type p_duration: float
+
+        :return: The throughput in MB/s, None without duration
+        :rtype: float
+        """
+        if p_duration <= 0:
+            return None
+
+        return round(p_bytes / p_duration / 1000 / 1000, 2)
+
+    @classmethod
+    def parse(cls, p_report: str, p_cpus: int) -> dict[str, dict[str, Any]]:
+        """
+        Parse a report of the provisioning script. Malformed lines are ignored.
+
+        :param p_report: The report
+        :type p_report: str
+        :param p_cpus: The number of cores of the CM
+        :type p_cpus: int
+
+        :return: The phases, in order, with their state, duration, bytes,
+            throughput and average number of busy cores
+        :rtype: dict
+        """
+        phases: dict[str, dict[str, Any]] = {}
+        for line in p_report.splitlines():
+            fields = line.split()
+            if len(fields) != 8:
+                continue
+            try:
+                start, end = float(fields[2]), float(fields[3])
+                received, written, busy, total = (int(field) for field in fields[4:])
+            except ValueError:
+                logging.warning(f"Malformed telemetry line '{line}'")
+                continue
+            duration = max(end - start, 0.0)
+            phases[fields[0]] = {
+                "state": fields[1],
+                "duration": round(duration, 2),
+                "bytesReceived": received,
+                "bytesWritten": written,
+                "receivedMBps": cls._rate(received, duration),
+                "writtenMBps": cls._rate(written, duration),
+                "busyCores": round(busy / total * p_cpus, 2) if total > 0 else None,
+            }
+
+        return phases
+
+    @staticmethod
+    def _statistics(p_values: list[float]) -> dict[str, float]:
+        """
+        Summarize a list of values.
+
+        :param p_values: The values, not empty
+        :type p_values: list[float]
+
+        :return: The mean, the median and the 95th percentile
+        :rtype: dict
+        """
+        values = sorted(p_values)
+        return {
+            "mean": round(sum(values) / len(values), 2),
+            "p50": values[(len(values) - 1) // 2],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+
+    @classmethod
+    def aggregate(
+        cls,
+        p_results: Iterable[tuple[dict[str, Any], dict[Any, Any]]],
+        p_model: Optional[str] = None,
+    ) -> list[dict[str, Any]]:
+        """
+        Aggregate the phase timings of results per project and CM model.
+
+        :param p_results: The (indexed fields, result) pairs
+        :type p_results: Iterable[tuple[dict, dict]]
+        :param p_model: Only aggregate the results of this model
+        :type p_model: str
+
+        :return: Per project and model, the number of results, the statistics
+            of every phase, and the bottleneck phase with the longest mean
+            duration
+        :rtype: list[dict]
+        """
+        groups: dict[tuple[str, str], dict[str, Any]] = {}
+        for _, record in p_results:
+            provisionInfo = record.get("cmProvisionInfo", {})
+            telemetry = provisionInfo.get("telemetry")
+            if not telemetry:
+                continue
+            model = record.get("cmInfo", {}).get("model", "")
+            if p_model is not None and model != p_model:
+                continue
+            group = groups.setdefault(
+                (provisionInfo.get("projectName", ""), model),
+                {"results": 0, "phases": {}},
+            )
+            group["results"] += 1
+            for name, phase in telemetry["phases"].items():
+                if phase["state"] != "done":
+                    continue
+                samples = group["phases"].setdefault(
+                    name, {field: [] for field in cls.FIELDS}
+                )
+                for field in cls.FIELDS:
+                    if phase.get(field) is not None:
+                        samples[field].append(phase[field])
+
+        aggregates = []
+        for (project, model), group in groups.items():
+            phases = {
+                name: {
+                    "count": len(samples["duration"]),
+                    **{
+                        field: cls._statistics(values)
+                        for field, values in samples.items()
+                        if values
+                    },
+                }
+                for name, samples in group["phases"].items()
+            }
+            bottleneck = max(
+                (name for name in phases if "duration" in phases[name]),
+                key=lambda name: phases[name]["duration"]["mean"],
+                default=None,
+            )
+            aggregates.append(
+                {
+                    "project": project,
+                    "model": model,
+                    "results": group["results"],
+                    "phases": phases,
+                    "bottleneck": bottleneck,
+                }
+            )
+
+        return aggregates
@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import copy
 import json
-from typing import Any, Optional
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+from fileLock import FileLock
+from fileWatcher import FileWatcher
+from serverMetrics import ServerMetrics
 import logging
 
 logging.basicConfig(
@@ -11,9 +19,33 @@ logging.basicConfig(
 )
 
 
+@dataclass(frozen=True)
+class ProjectSnapshot:
+    """
+    A version of the project configuration, sent to the subscribers of the
+    ProjectManager.
+    """
+
+    version: int
+    projects: dict[str, dict[str, Any]]
+    activeProjectName: str
+
+
 class ProjectManager:
+    """
+    The projects, stored in a JSON file shared by the HTTP worker processes.
+    The file is read again when it changed on disk, and rewritten under a
+    lock, so the projects stay the same in all the workers.
+
+    The subscribers are called with a snapshot of every new version of the
+    configuration, changed by this process or, while subscribers are
+    registered, by any other one: the file is then watched with inotify, and
+    not checked by every read anymore.
+    """
+
     configPath: str = "/app/conf/projectConfig.json"
     config: dict[str, dict[str, Any]]
+    version: int
     _instance = None
     __initialized = False
 
@@ -27,30 +59,210 @@ class ProjectManager:
     def __init__(self):
         if not self.__initialized:
             self.__initialized = True
-            self.configPath = "/app/conf/projectConfig.json"
             self.config = {}
+            self.version = 0
+            self._fileSignature: Optional[tuple[int, int, int]] = None
+            self._lock = threading.RLock()
+            self._subscribers: list[Callable[[ProjectSnapshot], None]] = []
+            self._watched = False
+            self._watchStop = threading.Event()
+            self._watchThread: Optional[threading.Thread] = None
+            self._watcher: Optional[FileWatcher] = None
+            os.register_at_fork(after_in_child=self._afterFork)
             self._loadConfig()
 
-    def _loadConfig(self):
+    def _afterFork(self) -> None:
+        """
+        Forget the subscribers and the watcher thread of the parent process
+        in a forked process.
         """
-        Load the configuration from the JSON file.
+        self._lock = threading.RLock()
+        self._subscribers = []
+        self._watched = False
+        self._watchStop = threading.Event()
+        self._watchThread = None
+        self._watcher = None
+
+    def _statConfig(self) -> Optional[tuple[int, int, int]]:
+        """
+        Get the signature of the configuration file.
+
+        :return: The inode, size and mtime of the file, None if not found
+        :rtype: tuple[int, int, int]
         """
         try:
-            with open(self.configPath, "r") as file:
-                self.config = json.load(file)
-        except FileNotFoundError as e:
-            logging.warning(
-                f"Configuration file {self.configPath} not found. Creating a new one."
+            stat = os.stat(self.configPath)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _refresh(self) -> None:
+        """
+        Load the configuration again if the file changed, written by another
+        process.
+        """
+        with self._lock:
+            if self._statConfig() != self._fileSignature:
+                self._loadConfig()
+
+    def _sync(self) -> None:
+        """
+        Make sure the latest configuration is loaded before reading it. When
+        the file is watched, the changes are already loaded.
+        """
+        if not self._watched:
+            self._refresh()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        Hold the lock of the configuration file, with the latest content
+        loaded, while it is modified and saved.
+        """
+        with (
+            self._lock,
+            FileLock(f"{os.path.dirname(self.configPath)}/.projectConfig.lock"),
+        ):
+            self._refresh()
+            yield
+
+    def _loadConfig(self):
+        """
+        Load the configuration from the JSON file, and notify the subscribers.
+        """
+        with self._lock:
+            try:
+                signature = self._statConfig()
+                with open(self.configPath, "r") as file:
+                    self.config = json.load(file)
+                self._fileSignature = signature
+                self.version += 1
+            except FileNotFoundError as e:
+                logging.warning(
+                    f"Configuration file {self.configPath} not found. Creating a new one."
+                )
+                self.config = {}
+                self._saveConfig()
+                return
+            self._notify()
+
+    def _snapshot(self) -> ProjectSnapshot:
+        """
+        Copy the loaded configuration.
+
+        :return: The snapshot
+        :rtype: ProjectSnapshot
+        """
+        with self._lock:
+            activeProjectName = ""
+            for projectName, project in self.config.items():
+                if project.get("active"):
+                    activeProjectName = projectName
+                    break
+
+            return ProjectSnapshot(
+                self.version, copy.deepcopy(self.config), activeProjectName
             )
-            self.config = {}
-            self._saveConfig()
 
+    def _notify(self) -> None:
+        """
+        Send the new version of the configuration to the subscribers.
+        """
+        if not self._subscribers:
+            return
+        snapshot = self._snapshot()
+        for callback in list(self._subscribers):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logging.error(f"Error notifying a project configuration change: {e}")
+
+    def _watch(self, p_watcher: FileWatcher) -> None:
+        """
+        Thread target loading the configuration when the file changes.
+
+        :param p_watcher: The watcher of the file
+        :type p_watcher: FileWatcher
+        """
+        p_watcher.open()
+        # The changes made before the watch started
+        self._refresh()
+        self._watched = p_watcher.inotify
+        try:
+            while not self._watchStop.is_set():
+                if p_watcher.wait(1.0):
+                    try:
+                        self._refresh()
+                    except ValueError as e:
+                        logging.error(f"Invalid configuration {self.configPath}: {e}")
+        finally:
+            self._watched = False
+            p_watcher.close()
+
+    def subscribe(self, p_callback: Callable[[ProjectSnapshot], None]) -> None:
+        """
+        Call a function with every new version of the configuration, from
+        the thread loading it. The file is watched while there are
+        subscribers.
+
+        :param p_callback: The function
+        :type p_callback: Callable[[ProjectSnapshot], None]
+        """
+        with self._lock:
+            self._subscribers.append(p_callback)
+            if self._watchThread is None:
+                self._watchStop.clear()
+                self._watcher = FileWatcher(self.configPath, self._watchStop)
+                self._watchThread = threading.Thread(
+                    target=self._watch, args=(self._watcher,), daemon=True
+                )
+                self._watchThread.start()
+
+    def unsubscribe(self, p_callback: Callable[[ProjectSnapshot], None]) -> None:
+        """
+        Stop calling a function subscribed with subscribe.
+
+        :param p_callback: The function
+        :type p_callback: Callable[[ProjectSnapshot], None]
+        """
+        with self._lock:
+            if p_callback in self._subscribers:
+                self._subscribers.remove(p_callback)
+            thread = self._watchThread
+            watcher = self._watcher
+            if self._subscribers or thread is None or watcher is None:
+                return
+            self._watchStop.set()
+            watcher.wake()
+            self._watchThread = None
+            self._watcher = None
+        thread.join()
+
+    def getSnapshot(self) -> ProjectSnapshot:
+        """
+        Get the latest version of the configuration.
+
+        :return: The snapshot
+        :rtype: ProjectSnapshot
+        """
+        self._sync()
+
+        return self._snapshot()
+
+    @ServerMetrics.persistenceLatency.labels("project", "save").time()
     def _saveConfig(self) -> None:
         """
-        Save the configuration to the JSON file.
+        Save the configuration to the JSON file, replaced at once so the
+        other processes never read it partially written.
         """
-        with open(self.configPath, "w") as file:
+        tmpPath = os.path.join(
+            os.path.dirname(self.configPath),
+            f".{os.path.basename(self.configPath)}.tmp",
+        )
+        with open(tmpPath, "w") as file:
             json.dump(self.config, file, indent=4)
+        os.replace(tmpPath, self.configPath)
 
         self._loadConfig()
 
@@ -112,21 +324,22 @@ class ProjectManager:
             eeprom = ""
 
         try:
-            # if p_active == "True", all other project statuses are set to False
-            if p_active == True:
-                for project in self.config:
-                    self.config[project]["active"] = False
-
-            self.config[p_projectName] = {
-                "active": p_active,
-                "image8Gb": p_image8Gb,
-                "image16Gb": image16Gb,
-                "image32Gb": image32Gb,
-                "cmStatusLed": statusLed,
-                "cmStatusLedOnOnsuccess": statusLedOnOnsuccess,
-                "eeprom": eeprom,
-            }
-            self._saveConfig()
+            with self._locked():
+                # if p_active == "True", all other project statuses are set to False
+                if p_active == True:
+                    for project in self.config:
+                        self.config[project]["active"] = False
+
+                self.config[p_projectName] = {
+                    "active": p_active,
+                    "image8Gb": p_image8Gb,
+                    "image16Gb": image16Gb,
+                    "image32Gb": image32Gb,
+                    "cmStatusLed": statusLed,
+                    "cmStatusLedOnOnsuccess": statusLedOnOnsuccess,
+                    "eeprom": eeprom,
+                }
+                self._saveConfig()
             status = True
         except Exception as e:
             e = e
@@ -146,8 +359,9 @@ class ProjectManager:
         """
         status = False
         try:
-            self.config.pop(p_projectName)
-            self._saveConfig()
+            with self._locked():
+                self.config.pop(p_projectName)
+                self._saveConfig()
             status = True
         except Exception as e:
             e = e
@@ -165,6 +379,7 @@ class ProjectManager:
         :return: The project
         :rtype: dict
         """
+        self._sync()
         status = False
         try:
             status = True
@@ -182,6 +397,7 @@ class ProjectManager:
         :return: The projects
         :rtype: tuple[bool, dict]
         """
+        self._sync()
         status = False
         try:
             status = True
@@ -204,11 +420,12 @@ class ProjectManager:
         """
         status = False
         try:
-            for project in self.config:
-                self.config[project]["active"] = False
+            with self._locked():
+                for project in self.config:
+                    self.config[project]["active"] = False
 
-            self.config[p_projectName]["active"] = True
-            self._saveConfig()
+                self.config[p_projectName]["active"] = True
+                self._saveConfig()
             status = True
         except Exception as e:
             e = e
@@ -223,6 +440,7 @@ class ProjectManager:
         :return: The active project
         :rtype: tuple[bool, dict]
         """
+        self._sync()
         status = False
         try:
             for project in self.config:
@@ -242,7 +460,7 @@ class ProjectManager:
         :return: The active project name
         :rtype: tuple[bool, str]
         """
-        self._loadConfig()
+        self._sync()
         status = False
         try:
             for projectName in self.config:
@@ -265,6 +483,7 @@ class ProjectManager:
         :return: The image
         :rtype: tuple[bool, str]
         """
+        self._sync()
         status = False
         try:
             status = True
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+import asyncio
+import copy
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Any, Callable, Optional
+from ioExecutor import IoExecutor
+from resultManager import ResultManager
+from serverMetrics import ServerMetrics
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ProvisioningEvent:
+    """
+    An event of the provisioning of a CM, reported by the provisioning script.
+    """
+
+    STARTED = "started"
+    EEPROM = "eeprom"
+    TELEMETRY = "telemetry"
+    FAILED = "failed"
+    COMPLETED = "completed"
+
+    kind: str
+    serial: str
+    timestamp: str
+    time: datetime
+    data: dict[str, Any]
+
+    def __init__(
+        self,
+        p_kind: str,
+        p_serial: str,
+        p_timestamp: str,
+        p_data: Optional[dict[str, Any]] = None,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_kind: The kind of event, STARTED, EEPROM, TELEMETRY, FAILED or COMPLETED
+        :type p_kind: str
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The timestamp of the provisioning
+        :type p_timestamp: str
+        :param p_data: The data of the event:
+            STARTED: "result", the new result
+            EEPROM: "eeprom", the EEPROM configuration, and "eepromsha"
+            TELEMETRY: "telemetry", the parsed report
+            FAILED: "phase" and "errorLog"
+        :type p_data: dict
+        """
+        self.kind = p_kind
+        self.serial = p_serial
+        self.timestamp = p_timestamp
+        self.time = datetime.now()
+        self.data = p_data if p_data is not None else {}
+
+    def toDict(self) -> dict[str, Any]:
+        """
+        Serialize the event, to send it to another process.
+
+        :return: The event
+        :rtype: dict
+        """
+        return {
+            "kind": self.kind,
+            "serial": self.serial,
+            "timestamp": self.timestamp,
+            "time": self.time.isoformat(),
+            "data": self.data,
+        }
+
+    @classmethod
+    def fromDict(cls, p_event: dict[str, Any]) -> "ProvisioningEvent":
+        """
+        Deserialize an event received from another process.
+
+        :param p_event: The event, see toDict
+        :type p_event: dict
+
+        :return: The event
+        :rtype: ProvisioningEvent
+        """
+        event = cls(p_event["kind"], p_event["serial"], p_event["timestamp"])
+        event.time = datetime.fromisoformat(p_event["time"])
+        event.data = p_event["data"]
+
+        return event
+
+
+class ProvisioningEventBus:
+    """
+    Queue of the provisioning events, applied to the results off the request
+    path.
+
+    The request handlers only emit events. A single consumer task applies
+    them in order to the results, sends the updated results to the WebSocket
+    clients and the metrics, and stores the results updated by the events
+    received within the batch window in one write, on the result store
+    thread. The results of the provisionings in progress are kept in memory,
+    so the events do not read the result store.
+
+    With several HTTP worker processes, the events are forwarded to the bus
+    of the primary worker, the only one applying them.
+    """
+
+    resultManager: ResultManager
+    io: IoExecutor
+    publish: Callable[[dict[str, Any]], None]
+    batchWindow: float
+    maxBatch: int
+    forward: Optional[Callable[[ProvisioningEvent], None]]
+    MAX_SESSIONS = 10000
+
+    def __init__(
+        self,
+        p_resultManager: ResultManager,
+        p_io: IoExecutor,
+        p_publish: Callable[[dict[str, Any]], None],
+        p_batchWindow: float = 0.05,
+        p_maxBatch: int = 256,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_resultManager: The result store
+        :type p_resultManager: ResultManager
+        :param p_io: The executor of the result store calls
+        :type p_io: IoExecutor
+        :param p_publish: Send a message to the WebSocket clients
+        :type p_publish: Callable[[dict], None]
+        :param p_batchWindow: The time in seconds the events are gathered for
+            before being stored
+        :type p_batchWindow: float
+        :param p_maxBatch: The maximal number of events stored at once
+        :type p_maxBatch: int
+        """
+        self.resultManager = p_resultManager
+        self.io = p_io
+        self.publish = p_publish
+        self.batchWindow = p_batchWindow
+        self.maxBatch = p_maxBatch
+        self.forward = None
+        self.sessions: "OrderedDict[tuple[str, str], dict[str, Any]]" = OrderedDict()
+        self._queue: asyncio.Queue[Optional[ProvisioningEvent]] = asyncio.Queue()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def emit(self, p_event: ProvisioningEvent) -> None:
+        """
+        Queue an event, without waiting for it to be applied.
+
+        :param p_event: The event
+        :type p_event: ProvisioningEvent
+        """
+        if self.forward is not None:
+            self.forward(p_event)
+        else:
+            self._queue.put_nowait(p_event)
+
+    def deliver(self, p_event: ProvisioningEvent) -> None:
+        """
+        Queue an event forwarded by another worker process.
+
+        :param p_event: The event
+        :type p_event: ProvisioningEvent
+        """
+        self._queue.put_nowait(p_event)
+
+    async def _loadSession(self, p_serial: str, p_timestamp: str) -> None:
+        """
+        Load the result of a provisioning started before the server from the
+        result store, if not in memory.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The timestamp of the provisioning
+        :type p_timestamp: str
+        """
+        if (p_serial, p_timestamp) in self.sessions:
+            return
+        # Copied on the result store thread, the stored result is not shared
+        result = await self.io.runResults(
+            lambda: copy.deepcopy(self.resultManager.getResult(p_serial, p_timestamp))
+        )
+        if "cmProvisionInfo" in result:
+            self._keepSession(p_serial, p_timestamp, result)
+
+    def _keepSession(
+        self, p_serial: str, p_timestamp: str, p_result: dict[str, Any]
+    ) -> None:
+        """
+        Keep the result of a provisioning in progress in memory. The oldest
+        ones are forgotten beyond MAX_SESSIONS, for the CMs never finishing.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The timestamp of the provisioning
+        :type p_timestamp: str
+        :param p_result: The result
+        :type p_result: dict
+        """
+        self.sessions[(p_serial, p_timestamp)] = p_result
+        while len(self.sessions) > self.MAX_SESSIONS:
+            self.sessions.popitem(last=False)
+
+    @staticmethod
+    def _finish(p_result: dict[str, Any], p_time: datetime) -> float:
+        """
+        Set the end time and the duration of a provisioning.
+
+        :param p_result: The result
+        :type p_result: dict
+        :param p_time: The end time
+        :type p_time: datetime
+
+        :return: The duration in seconds
+        :rtype: float
+        """
+        provisionInfo = p_result["cmProvisionInfo"]
+        startTime = datetime.fromisoformat(provisionInfo["starTime"])
+        provisionInfo["endTime"] = p_time.isoformat()
+        provisionInfo["duration"] = str(p_time - startTime)
+        provisionInfo["state"] = "completed"
+
+        return (p_time - startTime).total_seconds()
+
+    def _apply(self, p_event: ProvisioningEvent) -> Optional[dict[str, Any]]:
+        """
+        Apply an event to the result of its provisioning.
+
+        :param p_event: The event
+        :type p_event: ProvisioningEvent
+
+        :return: The result to store, None if the event is not stored
+        :rtype: dict
+        """
+        if p_event.kind == ProvisioningEvent.STARTED:
+            result = p_event.data["result"]
+            self._keepSession(p_event.serial, p_event.timestamp, result)
+            ServerMetrics.provisioningStarted.labels(
+                result["cmProvisionInfo"]["projectName"]
+            ).inc()
+            return result
+
+        result = self.sessions.get((p_event.serial, p_event.timestamp))
+        if result is None:
+            logging.warning(
+                f"No provisioning of {p_event.serial} started at {p_event.timestamp}"
+            )
+            return None
+        provisionInfo = result["cmProvisionInfo"]
+        storage = ServerMetrics.storageLabel(int(result["cmInfo"]["storagesize"]))
+
+        if p_event.kind == ProvisioningEvent.EEPROM:
+            result["cmInfo"]["eeprom"] = p_event.data["eeprom"]
+            result["cmInfo"]["eeepromsha"] = p_event.data["eepromsha"]
+        elif p_event.kind == ProvisioningEvent.TELEMETRY:
+            telemetry = p_event.data["telemetry"]
+            if not telemetry["final"]:
+                # The periodic reports are only sent to the WebSocket clients
+                self.publish(
+                    {
+                        "telemetry": {
+                            "serial": p_event.serial,
+                            "start": p_event.timestamp,
+                            "project": provisionInfo.get("projectName", ""),
+                            **telemetry,
+                        }
+                    }
+                )
+                return None
+            provisionInfo["telemetry"] = telemetry
+        elif p_event.kind == ProvisioningEvent.FAILED:
+            duration = self._finish(result, p_event.time)
+            provisionInfo["errorLog"] = p_event.data["errorLog"]
+            ServerMetrics.provisioningFailed.labels(
+                provisionInfo["projectName"], p_event.data["phase"]
+            ).inc()
+            ServerMetrics.provisioningDuration.labels(storage, "failure").observe(
+                duration
+            )
+        elif p_event.kind == ProvisioningEvent.COMPLETED:
+            duration = self._finish(result, p_event.time)
+            provisionInfo["result"] = True
+            ServerMetrics.provisioningCompleted.labels(
+                provisionInfo["projectName"]
+            ).inc()
+            ServerMetrics.provisioningDuration.labels(storage, "success").observe(
+                duration
+            )
+
+        return result
+
+    async def _process(self, p_events: list[ProvisioningEvent]) -> None:
+        """
+        Apply a batch of events, send the updated results to the WebSocket
+        clients, then store them in one write.
+
+        :param p_events: The events, in order
+        :type p_events: list[ProvisioningEvent]
+        """
+        changes: dict[str, dict[str, Any]] = defaultdict(dict)
+        finished = []
+        for event in p_events:
+            try:
+                if event.kind != ProvisioningEvent.STARTED:
+                    await self._loadSession(event.serial, event.timestamp)
+                result = self._apply(event)
+            except Exception as e:
+                logging.error(
+                    f"Error applying the {event.kind} event of {event.serial}: {e}"
+                )
+                continue
+            if result is None:
+                continue
+            # The stored copy is not modified by the next events while written
+            changes[event.serial][event.timestamp] = copy.deepcopy(result)
+            self.publish({event.serial: {event.timestamp: result}})
+            if event.kind in (ProvisioningEvent.FAILED, ProvisioningEvent.COMPLETED):
+                finished.append((event.serial, event.timestamp))
+
+        try:
+            await self.io.runResults(self.resultManager.putResults, changes)
+        except Exception as e:
+            logging.error(f"Error storing {len(p_events)} provisioning events: {e}")
+        ServerMetrics.eventBatchSize.observe(len(p_events))
+        for key in finished:
+            self.sessions.pop(key, None)
+
+    async def _run(self) -> None:
+        """
+        Task consuming the events, until the None sentinel.
+        """
+        stopping = False
+        while not stopping:
+            event = await self._queue.get()
+            if event is None:
+                return
+            # Gather the events of the CMs finishing at the same time
+            if self.batchWindow > 0:
+                await asyncio.sleep(self.batchWindow)
+            events = [event]
+            while len(events) < self.maxBatch and not self._queue.empty():
+                event = self._queue.get_nowait()
+                if event is None:
+                    stopping = True
+                    break
+                events.append(event)
+            # The events forwarded by different workers may arrive out of order
+            events.sort(key=lambda event: event.time)
+            await self._process(events)
+
+    def start(self) -> None:
+        """
+        Start the consumer task.
+        """
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Apply the queued events, then stop the consumer task.
+        """
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import threading
+from dataclasses import dataclass
+from typing import Callable, Optional
+from projectManager import ProjectManager, ProjectSnapshot
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+@dataclass(frozen=True)
+class ProvisioningPlan:
+    """
+    How the CMs of a storage tier of a project are provisioned: the image,
+    the EEPROM configuration, the status LED, and the provisioning script
+    with the values of each CM left as fields.
+
+    Never modified once built, so the requests share it without locking.
+    """
+
+    projectName: str
+    imageName: str
+    eeprom: str
+    cmStatusLed: str
+    cmStatusLedOnOnsuccess: str
+    # The literal parts of the script, the odd ones being field names
+    template: tuple[str, ...] = ()
+
+    MARKER = "\x00"
+
+    @classmethod
+    def field(cls, p_name: str) -> str:
+        """
+        Get the placeholder of a field in a script.
+
+        :param p_name: The field name
+        :type p_name: str
+
+        :return: The placeholder
+        :rtype: str
+        """
+        return f"{cls.MARKER}{p_name}{cls.MARKER}"
+
+    def render(self, p_fields: dict[str, str]) -> str:
+        """
+        Render the script of a CM.
+
+        :param p_fields: The values of the fields
+        :type p_fields: dict[str, str]
+
+        :return: The script
+        :rtype: str
+
+        :raises KeyError: If a field has no value
+        """
+        parts = list(self.template)
+        for index in range(1, len(parts), 2):
+            parts[index] = p_fields[parts[index]]
+
+        return "".join(parts)
+
+
+@dataclass(frozen=True)
+class ProvisioningPlans:
+    """
+    The provisioning plans of all the projects, for a version of the
+    project configuration.
+    """
+
+    version: int
+    activeProjectName: str
+    # By project name and storage tier
+    plans: dict[tuple[str, str], ProvisioningPlan]
+    # Used without active project
+    default: ProvisioningPlan
+
+
+class ProvisioningPlanCache:
+    """
+    The provisioning plans, built once for every version of the project
+    configuration and replaced at once, so a request only looks its plan up.
+
+    Once started, the plans are built when the ProjectManager notifies a
+    change, the requests do not read the configuration.
+    """
+
+    TIERS = ("8Gb", "16Gb", "32Gb")
+
+    projectManager: ProjectManager
+    renderScript: Callable[[ProvisioningPlan], str]
+    current: Optional[ProvisioningPlans]
+
+    def __init__(
+        self,
+        p_projectManager: ProjectManager,
+        p_renderScript: Callable[[ProvisioningPlan], str],
+    ) -> None:
+        """
+        Constructor
+
+        :param p_projectManager: The projects
+        :type p_projectManager: ProjectManager
+        :param p_renderScript: Render the script of a plan, with the
+            placeholders of the fields of each CM
+        :type p_renderScript: Callable[[ProvisioningPlan], str]
+        """
+        self.projectManager = p_projectManager
+        self.renderScript = p_renderScript
+        self.current = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def tier(cls, p_storageSize: Optional[int]) -> str:
+        """
+        Get the storage tier of a CM.
+
+        :param p_storageSize: The storage size in 512 bytes sectors
+        :type p_storageSize: int
+
+        :return: The tier, one of TIERS
+        :rtype: str
+        """
+        if p_storageSize is None:
+            return cls.TIERS[0]
+        sizeGb = (float(p_storageSize) * 512) / (1024 * 1024 * 1024)
+        if sizeGb <= 8:
+            return cls.TIERS[0]
+        if sizeGb <= 16:
+            return cls.TIERS[1]
+        return cls.TIERS[2]
+
+    def _plan(
+        self,
+        p_projectName: str,
+        p_imageName: str,
+        p_eeprom: str,
+        p_cmStatusLed: str,
+        p_cmStatusLedOnOnsuccess: str,
+    ) -> ProvisioningPlan:
+        """
+        Build a plan and its script template.
+
+        :return: The plan
+        :rtype: ProvisioningPlan
+        """
+        plan = ProvisioningPlan(
+            p_projectName,
+            p_imageName,
+            p_eeprom,
+            p_cmStatusLed,
+            p_cmStatusLedOnOnsuccess,
+        )
+        template = tuple(self.renderScript(plan).split(ProvisioningPlan.MARKER))
+
+        return ProvisioningPlan(
+            p_projectName,
+            p_imageName,
+            p_eeprom,
+            p_cmStatusLed,
+            p_cmStatusLedOnOnsuccess,
+            template,
+        )
+
+    def _build(self, p_snapshot: ProjectSnapshot) -> ProvisioningPlans:
+        """
+        Build the plans of all the projects.
+
+        :param p_snapshot: The project configuration
+        :type p_snapshot: ProjectSnapshot
+
+        :return: The plans
+        :rtype: ProvisioningPlans
+        """
+        projects = p_snapshot.projects
+        activeProjectName = p_snapshot.activeProjectName
+        plans: dict[tuple[str, str], ProvisioningPlan] = {}
+        for name, project in projects.items():
+            try:
+                statusLed = int(project.get("cmStatusLed", -1))
+                images = {
+                    tier: project.get(f"image{tier}") or project["image8Gb"]
+                    for tier in self.TIERS
+                }
+                for tier, imageName in images.items():
+                    plans[(name, tier)] = self._plan(
+                        name,
+                        imageName,
+                        project.get("eeprom", ""),
+                        "NONE" if statusLed == -1 else str(statusLed),
+                        "1" if project.get("cmStatusLedOnOnsuccess") else "0",
+                    )
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error(f"Invalid project {name}, no provisioning plan: {e}")
+
+        logging.info(
+            f"Provisioning plans of {len(projects)} projects built, active project: {activeProjectName or 'none'}"
+        )
+
+        return ProvisioningPlans(
+            p_snapshot.version,
+            activeProjectName,
+            plans,
+            self._plan(activeProjectName, "", "", "NONE", "0"),
+        )
+
+    def _swap(self, p_plans: ProvisioningPlans) -> None:
+        """
+        Replace the plans, unless they were already replaced by newer ones.
+
+        :param p_plans: The plans
+        :type p_plans: ProvisioningPlans
+        """
+        with self._lock:
+            if self.current is None or p_plans.version >= self.current.version:
+                self.current = p_plans
+
+    def _onProjectsChanged(self, p_snapshot: ProjectSnapshot) -> None:
+        """
+        Build the plans of a new version of the project configuration.
+
+        :param p_snapshot: The project configuration
+        :type p_snapshot: ProjectSnapshot
+        """
+        self._swap(self._build(p_snapshot))
+
+    def get(self, p_storageSize: Optional[int]) -> ProvisioningPlan:
+        """
+        Get the plan of a CM in the active project.
+
+        :param p_storageSize: The storage size of the CM in 512 bytes sectors
+        :type p_storageSize: int
+
+        :return: The plan, without image if there is no active project
+        :rtype: ProvisioningPlan
+        """
+        plans = self.current
+        if plans is None:
+            plans = self._build(self.projectManager.getSnapshot())
+            self._swap(plans)
+
+        return plans.plans.get(
+            (plans.activeProjectName, self.tier(p_storageSize)), plans.default
+        )
+
+    def start(self) -> None:
+        """
+        Build the plans now, and again on every change of the projects.
+        """
+        self.projectManager.subscribe(self._onProjectsChanged)
+        self._swap(self._build(self.projectManager.getSnapshot()))
+
+    def stop(self) -> None:
+        """
+        Stop following the changes of the projects.
+        """
+        self.projectManager.unsubscribe(self._onProjectsChanged)
+        self.current = None
+
+    def invalidate(self) -> None:
+        """
+        Build the plans again on the next request, after a setting used in
+        the scripts changed.
+        """
+        self.current = None
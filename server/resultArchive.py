@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Iterator, Optional
+from resultQuery import ResultQuery
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ResultArchive:
+    """
+    Immutable archive of the expired provisioning results.
+
+    The results are written in gzip compressed NDJSON segments, partitioned
+    by start date: "<YYYY-MM-DD>.<sequence>.ndjson.gz". A segment is never
+    modified once written, archiving more results of the same day adds a new
+    segment. The segments are only opened by the queries whose time range
+    includes their day.
+
+    Several worker processes share the directory: the segments are listed
+    again whenever the directory changes, and a new segment never replaces
+    another one.
+    """
+
+    archiveDir: str
+    segments: dict[str, list[str]]
+    SEGMENT_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})\.(\d+)\.ndjson\.gz$")
+
+    def __init__(self, p_archiveDir: str) -> None:
+        """
+        Constructor
+
+        :param p_archiveDir: The directory of the segments
+        :type p_archiveDir: str
+        """
+        self.archiveDir = p_archiveDir
+        self.segments = {}
+        self._mtime: Optional[int] = None
+        os.makedirs(self.archiveDir, exist_ok=True)
+        self._refresh()
+
+    def _refresh(self) -> dict[str, list[str]]:
+        """
+        List the segments of the archive directory again if it changed, the
+        segments may be written by another process.
+
+        :return: The segment file names by day
+        :rtype: dict[str, list[str]]
+        """
+        try:
+            mtime = os.stat(self.archiveDir).st_mtime_ns
+        except OSError as e:
+            logging.error(f"Error reading the archive directory: {e}")
+            return self.segments
+        if mtime == self._mtime:
+            return self.segments
+
+        segments: dict[str, list[str]] = {}
+        for file in os.listdir(self.archiveDir):
+            match = self.SEGMENT_PATTERN.match(file)
+            if match:
+                segments.setdefault(match.group(1), []).append(file)
+        for files in segments.values():
+            files.sort(key=lambda file: int(file.split(".")[1]))
+        # Replaced at once, the queries keep reading the previous list
+        self.segments = segments
+        # A change in the same tick of the directory clock would not change
+        # its mtime, so a recent mtime is listed again next time
+        self._mtime = mtime if time.time_ns() - mtime > 1_000_000_000 else None
+
+        return segments
+
+    def _reserveSegment(self, p_day: str) -> str:
+        """
+        Create the next free segment file of a day, empty. The name is only
+        taken once, even by several processes archiving at the same time.
+
+        :param p_day: The day, "YYYY-MM-DD"
+        :type p_day: str
+
+        :return: The segment file name
+        :rtype: str
+        """
+        sequence = len(self._refresh().get(p_day, []))
+        while True:
+            file = f"{p_day}.{sequence}.ndjson.gz"
+            try:
+                fd = os.open(
+                    os.path.join(self.archiveDir, file),
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                    0o644,
+                )
+            except FileExistsError:
+                sequence += 1
+                continue
+            os.close(fd)
+
+            return file
+
+    def archive(self, p_results: list[tuple[dict[str, Any], dict[Any, Any]]]) -> int:
+        """
+        Write results to new segments, one per start date.
+
+        :param p_results: The (indexed fields, result) pairs to archive
+        :type p_results: list
+
+        :return: The number of archived results
+        :rtype: int
+        """
+        byDay: dict[str, list[tuple[dict[str, Any], dict[Any, Any]]]] = {}
+        for fields, record in p_results:
+            day = fields["startTime"][:10] or "0000-00-00"
+            byDay.setdefault(day, []).append((fields, record))
+
+        for day, results in byDay.items():
+            results.sort(key=lambda item: ResultQuery.sortKey(item[0]))
+            tmpPath = os.path.join(self.archiveDir, f".{day}.{os.getpid()}.tmp")
+            with gzip.open(tmpPath, "wt") as segment:
+                for fields, record in results:
+                    segment.write(
+                        json.dumps(
+                            {
+                                "serial": fields["serial"],
+                                "timestamp": fields["timestamp"],
+                                "result": record,
+                            }
+                        )
+                        + "\n"
+                    )
+            with open(tmpPath, "rb") as segment:
+                os.fsync(segment.fileno())
+            file = self._reserveSegment(day)
+            os.replace(tmpPath, os.path.join(self.archiveDir, file))
+            logging.info(f"{len(results)} results archived in {file}")
+
+        return len(p_results)
+
+    def _readSegment(
+        self, p_file: str
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Read the results of a segment.
+
+        :param p_file: The segment file name
+        :type p_file: str
+
+        :return: The (indexed fields, result) pairs
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        with gzip.open(os.path.join(self.archiveDir, p_file), "rt") as segment:
+            for line in segment:
+                item = json.loads(line)
+                yield ResultQuery.indexFields(
+                    item["serial"], item["timestamp"], item["result"]
+                ), item["result"]
+
+    def _days(self, p_query: ResultQuery) -> list[str]:
+        """
+        Get the archived days touched by the time range of a query.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The days, in chronological order
+        :rtype: list[str]
+        """
+        days = []
+        for day in sorted(self._refresh()):
+            if p_query.since is not None and day < p_query.since[:10]:
+                continue
+            if p_query.until is not None and day > p_query.until[:10]:
+                continue
+            if p_query.after is not None and day < p_query.after[0][:10]:
+                continue
+            days.append(day)
+
+        return days
+
+    def query(
+        self, p_query: ResultQuery
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Query the archived results, ordered as the live results. The segments
+        are read lazily, day by day. The limit of the query is not applied.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The matching (indexed fields, result) pairs
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        for day in self._days(p_query):
+            matching = []
+            for file in self.segments.get(day, []):
+                for fields, record in self._readSegment(file):
+                    if not p_query.matches(fields):
+                        continue
+                    if (
+                        p_query.after is not None
+                        and ResultQuery.sortKey(fields) <= p_query.after
+                    ):
+                        continue
+                    matching.append((fields, record))
+            matching.sort(key=lambda item: ResultQuery.sortKey(item[0]))
+            yield from matching
+
+    def count(self, p_query: ResultQuery) -> int:
+        """
+        Count the archived results matching a query, the cursor is ignored.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The number of matching results
+        :rtype: int
+        """
+        count = 0
+        for day in self._days(p_query):
+            for file in self.segments.get(day, []):
+                for fields, _ in self._readSegment(file):
+                    if p_query.matches(fields):
+                        count += 1
+
+        return count
+
+    def getResult(self, p_serial: str, p_timestamp: str) -> Optional[dict[Any, Any]]:
+        """
+        Find an archived result, only the segments of its day are read.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The result timestamp, "%Y%m%d_%H:%M:%S"
+        :type p_timestamp: str
+
+        :return: The result, None if not archived
+        :rtype: dict
+        """
+        try:
+            day = datetime.strptime(p_timestamp, "%Y%m%d_%H:%M:%S").date().isoformat()
+        except ValueError:
+            return None
+
+        for file in self._refresh().get(day, []):
+            for fields, record in self._readSegment(file):
+                if fields["serial"] == p_serial and fields["timestamp"] == p_timestamp:
+                    return record
+
+        return None
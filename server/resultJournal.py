@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ResultJournal:
+    """
+    Append-only journal for the provisioning results.
+
+    Every result event is appended as one JSON line to the journal file. The
+    fsyncs are grouped over a short window by a background thread, and the
+    journal is periodically folded into the JSON snapshot by a background
+    compaction, so the cost of one event is proportional to the record size
+    and not to the whole history.
+    """
+
+    snapshotPath: str
+    journalPath: str
+    compactingPath: str
+    fsyncInterval: float
+    compactThreshold: int
+
+    def __init__(
+        self,
+        p_snapshotPath: str,
+        p_fsyncInterval: float = 0.05,
+        p_compactThreshold: int = 10000,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_snapshotPath: The JSON snapshot file (the legacy result file)
+        :type p_snapshotPath: str
+        :param p_fsyncInterval: The group commit window in seconds
+        :type p_fsyncInterval: float
+        :param p_compactThreshold: The number of journal records triggering a compaction
+        :type p_compactThreshold: int
+        """
+        self.snapshotPath = p_snapshotPath
+        basePath = os.path.splitext(p_snapshotPath)[0]
+        self.journalPath = f"{basePath}.journal"
+        self.compactingPath = f"{basePath}.journal.compacting"
+        self.fsyncInterval = p_fsyncInterval
+        self.compactThreshold = p_compactThreshold
+
+        self._lock = threading.Lock()
+        self._dirtyEvent = threading.Event()
+        self._stopEvent = threading.Event()
+        self._file = None
+        self._records = 0
+        self._compactThread: Optional[threading.Thread] = None
+        self._flushThread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def applyRecord(p_results: dict[Any, Any], p_record: dict[Any, Any]) -> None:
+        """
+        Apply a journal record to a results dictionary.
+
+        :param p_results: The results dictionary to update
+        :type p_results: dict
+        :param p_record: The journal record
+        :type p_record: dict
+        """
+        serial = p_record["serial"]
+        if p_record["op"] == "add":
+            if serial in p_results:
+                p_results[serial].update(p_record["info"])
+            else:
+                p_results[serial] = p_record["info"]
+        elif p_record["op"] == "modify":
+            p_results.setdefault(serial, {})[p_record["timestamp"]] = p_record["info"]
+        elif p_record["op"] == "delete":
+            if serial in p_results:
+                p_results[serial].pop(p_record["timestamp"], None)
+                if not p_results[serial]:
+                    del p_results[serial]
+
+    def _replay(self, p_path: str, p_results: dict[Any, Any]) -> int:
+        """
+        Replay a journal file into a results dictionary.
+
+        :param p_path: The journal file
+        :type p_path: str
+        :param p_results: The results dictionary to update
+        :type p_results: dict
+
+        :return: The number of replayed records
+        :rtype: int
+        """
+        count = 0
+        try:
+            with open(p_path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line after a crash, the record was never committed
+                        logging.warning(f"Skipping corrupted record in {p_path}")
+                        continue
+                    self.applyRecord(p_results, record)
+                    count += 1
+        except FileNotFoundError:
+            pass
+
+        return count
+
+    def _readSnapshot(self) -> dict[Any, Any]:
+        """
+        Read the JSON snapshot.
+
+        :return: The results of the snapshot
+        :rtype: dict
+        """
+        try:
+            with open(self.snapshotPath, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def load(self) -> dict[Any, Any]:
+        """
+        Rebuild the results from the snapshot and the journal, then open the
+        journal for appending and start the background threads.
+
+        :return: The results
+        :rtype: dict
+        """
+        results = self._readSnapshot()
+        self._replay(self.compactingPath, results)
+        self._records = self._replay(self.journalPath, results)
+        logging.info(
+            f"Result journal loaded, {self._records} records pending compaction"
+        )
+
+        self._file = open(self.journalPath, "a")
+        self._stopEvent.clear()
+        self._flushThread = threading.Thread(target=self._runFlush, daemon=True)
+        self._flushThread.start()
+
+        # Finish a compaction interrupted by a restart
+        if os.path.exists(self.compactingPath):
+            self._startCompaction(p_rotate=False)
+        elif self._records >= self.compactThreshold:
+            self._startCompaction()
+
+        return results
+
+    def append(self, p_record: dict[Any, Any]) -> None:
+        """
+        Append a record to the journal. The record is written immediately and
+        fsynced by the next group commit.
+
+        :param p_record: The journal record
+        :type p_record: dict
+        """
+        line = json.dumps(p_record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("Result journal is not opened")
+            self._file.write(line)
+            self._records += 1
+            needCompaction = self._records >= self.compactThreshold
+        self._dirtyEvent.set()
+
+        if needCompaction:
+            self._startCompaction()
+
+    def _commit(self) -> None:
+        """
+        Flush and fsync the journal file.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _runFlush(self) -> None:
+        """
+        Thread target grouping the fsyncs of the journal.
+        """
+        while not self._stopEvent.is_set():
+            self._dirtyEvent.wait()
+            # Let the concurrent events join the same commit
+            self._stopEvent.wait(self.fsyncInterval)
+            self._dirtyEvent.clear()
+            try:
+                self._commit()
+            except Exception as e:
+                logging.error(f"Error committing result journal: {e}")
+
+    def _startCompaction(self, p_rotate: bool = True) -> None:
+        """
+        Start a background compaction if none is running.
+
+        :param p_rotate: Rotate the current journal before compacting
+        :type p_rotate: bool
+        """
+        with self._lock:
+            if self._compactThread is not None and self._compactThread.is_alive():
+                return
+            if p_rotate:
+                if os.path.exists(self.compactingPath):
+                    # The previous rotated journal was not folded yet
+                    return
+                assert self._file is not None
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                os.rename(self.journalPath, self.compactingPath)
+                self._file = open(self.journalPath, "a")
+                self._records = 0
+            self._compactThread = threading.Thread(target=self._compact, daemon=True)
+            self._compactThread.start()
+
+    def _compact(self) -> None:
+        """
+        Thread target folding the rotated journal into the snapshot. Only the
+        files are read, the live results are never touched.
+        """
+        try:
+            results = self._readSnapshot()
+            count = self._replay(self.compactingPath, results)
+            tmpPath = f"{self.snapshotPath}.tmp"
+            with open(tmpPath, "w") as file:
+                json.dump(results, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmpPath, self.snapshotPath)
+            os.remove(self.compactingPath)
+            logging.info(f"Result journal compacted, {count} records folded")
+        except Exception as e:
+            logging.error(f"Error compacting result journal: {e}")
+
+    def fold(self) -> dict[Any, Any]:
+        """
+        Fold every journal left on disk into the snapshot and remove them.
+        Used when going back to the plain JSON storage.
+
+        :return: The results
+        :rtype: dict
+        """
+        results = self._readSnapshot()
+        count = self._replay(self.compactingPath, results)
+        count += self._replay(self.journalPath, results)
+        if count:
+            tmpPath = f"{self.snapshotPath}.tmp"
+            with open(tmpPath, "w") as file:
+                json.dump(results, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmpPath, self.snapshotPath)
+            logging.info(f"Result journal folded, {count} records")
+        for path in (self.compactingPath, self.journalPath):
+            if os.path.exists(path):
+                os.remove(path)
+
+        return results
+
+    def close(self) -> None:
+        """
+        Commit the pending records and stop the background threads.
+        """
+        self._stopEvent.set()
+        self._dirtyEvent.set()
+        if self._flushThread is not None:
+            self._flushThread.join()
+        if self._compactThread is not None:
+            self._compactThread.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
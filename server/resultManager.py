@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import copy
 import json
-from typing import Any
+import os
+from datetime import datetime, timedelta
+from typing import Any, Iterator, Optional
+from resultArchive import ResultArchive
+from resultJournal import ResultJournal
+from resultQuery import ResultQuery
+from resultSqliteStore import ResultSqliteStore
+from serverMetrics import ServerMetrics
 import logging
 
 logging.basicConfig(
@@ -14,20 +22,244 @@ logging.basicConfig(
 class ResultManager:
     resultPath: str = "/app/results/downloadResult.json"
     results: dict[Any, Any]
+    storageMode: str
+    journal: Optional[ResultJournal]
+    store: Optional[ResultSqliteStore]
+    archive: Optional[ResultArchive]
+    retentionMaxAgeDays: float
+    retentionMaxRecords: int
+    version: int
 
     def __init__(self) -> None:
         """
         Constructor
         """
+        self.storageMode = "json"
+        self.journal = None
+        self.store = None
+        self.archive = None
+        self.retentionMaxAgeDays = 0
+        self.retentionMaxRecords = 0
+        self.version = 0
+        self._fileSignature: Optional[tuple[int, int, int]] = None
         self._loadResult()
 
+    @property
+    def dbPath(self) -> str:
+        """
+        The SQLite database file, next to the result file.
+        """
+        return f"{os.path.splitext(self.resultPath)[0]}.sqlite"
+
+    def setStorageMode(
+        self,
+        p_mode: str,
+        p_fsyncInterval: float = 0.05,
+        p_compactThreshold: int = 10000,
+    ) -> None:
+        """
+        Set the storage mode of the results.
+
+        - "json": the whole result file is rewritten on every event
+        - "journal": every event is appended to a journal, see ResultJournal
+        - "sqlite": the results are stored in an indexed SQLite database, see
+          ResultSqliteStore. The JSON results are imported into an empty database.
+
+        :param p_mode: The storage mode, "json", "journal" or "sqlite"
+        :type p_mode: str
+        :param p_fsyncInterval: The journal group commit window in seconds
+        :type p_fsyncInterval: float
+        :param p_compactThreshold: The number of journal records triggering a compaction
+        :type p_compactThreshold: int
+        """
+        if p_mode not in ("json", "journal", "sqlite"):
+            raise ValueError(f"Unknown result storage mode '{p_mode}'")
+
+        self.close()
+
+        self.storageMode = p_mode
+        if p_mode == "sqlite":
+            self.store = ResultSqliteStore(self.dbPath)
+            if self.store.isEmpty():
+                # Import the results of a previous json or journal mode run
+                results = ResultJournal(self.resultPath).fold()
+                if results:
+                    self.store.putResults(results)
+                    logging.info(f"Results imported into {self.dbPath}")
+            self.results = {}
+        else:
+            # Do not lose the results of a previous sqlite mode run
+            self._exportDatabase()
+            if p_mode == "journal":
+                self.journal = ResultJournal(
+                    self.resultPath, p_fsyncInterval, p_compactThreshold
+                )
+                self.results = self.journal.load()
+            else:
+                # Do not lose the records of a previous journal mode run
+                ResultJournal(self.resultPath).fold()
+                self._fileSignature = None
+                self._loadResult()
+        self.version += 1
+        logging.info(f"Result storage mode: {p_mode}")
+
+    def setRetention(self, p_maxAgeDays: float, p_maxRecords: int) -> None:
+        """
+        Set the retention policy of the results. The expired results are moved
+        to the archive, see ResultArchive, and stay available to the queries.
+
+        :param p_maxAgeDays: The maximal age of the results in days, 0 to disable
+        :type p_maxAgeDays: float
+        :param p_maxRecords: The maximal number of results, 0 to disable
+        :type p_maxRecords: int
+        """
+        self.retentionMaxAgeDays = p_maxAgeDays
+        self.retentionMaxRecords = p_maxRecords
+        self.archive = ResultArchive(
+            os.path.join(os.path.dirname(self.resultPath), "archive")
+        )
+
+    def collectExpiredResults(self) -> list[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Get the results expired by the retention policy.
+
+        :return: The expired (indexed fields, result) pairs
+        :rtype: list
+        """
+        expired: dict[tuple[str, str, str], tuple[dict[str, Any], dict[Any, Any]]]
+        expired = {}
+        if self.retentionMaxAgeDays > 0:
+            cutoff = datetime.now() - timedelta(days=self.retentionMaxAgeDays)
+            for fields, record in self._queryLive(
+                ResultQuery(p_until=cutoff.isoformat())
+            ):
+                expired[ResultQuery.sortKey(fields)] = fields, record
+        if self.retentionMaxRecords > 0:
+            excess = self._countLive(ResultQuery()) - self.retentionMaxRecords
+            if excess > 0:
+                for fields, record in self._queryLive(ResultQuery(p_limit=excess)):
+                    expired[ResultQuery.sortKey(fields)] = fields, record
+
+        return list(expired.values())
+
+    def deleteResults(self, p_keys: list[tuple[str, str]]) -> None:
+        """
+        Delete results.
+
+        :param p_keys: The (serial, timestamp) keys of the results
+        :type p_keys: list
+        """
+        if not p_keys:
+            return
+        if self.store is not None:
+            self.store.deleteResults(p_keys)
+        else:
+            self._loadResult()
+            for serial, timestamp in p_keys:
+                record = {"op": "delete", "serial": serial, "timestamp": timestamp}
+                ResultJournal.applyRecord(self.results, record)
+                if self.journal is not None:
+                    self.journal.append(record)
+            if self.journal is None:
+                self._saveResult()
+        self.version += 1
+
+    def applyRetention(self) -> int:
+        """
+        Move the results expired by the retention policy to the archive.
+
+        :return: The number of archived results
+        :rtype: int
+        """
+        if self.archive is None:
+            return 0
+        expired = self.collectExpiredResults()
+        if not expired:
+            return 0
+        # The results are only deleted once safely archived
+        self.archive.archive(expired)
+        self.deleteResults(
+            [(fields["serial"], fields["timestamp"]) for fields, _ in expired]
+        )
+
+        return len(expired)
+
+    def _exportDatabase(self) -> None:
+        """
+        Export the results of the SQLite database to the result file, then
+        keep the database aside so it is imported again on the next sqlite run.
+        """
+        if not os.path.exists(self.dbPath):
+            return
+        store = ResultSqliteStore(self.dbPath)
+        results = store.getResults()
+        store.close()
+
+        snapshot = ResultJournal(self.resultPath).fold()
+        for serial, records in results.items():
+            snapshot.setdefault(serial, {}).update(records)
+        tmpPath = f"{self.resultPath}.tmp"
+        with open(tmpPath, "w") as file:
+            json.dump(snapshot, file, indent=4)
+        os.replace(tmpPath, self.resultPath)
+        os.replace(self.dbPath, f"{self.dbPath}.bak")
+        logging.info(f"Results exported from {self.dbPath}")
+
+    def close(self) -> None:
+        """
+        Commit the pending results.
+        """
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def getVersion(self) -> int:
+        """
+        Get the version of the results, increased on every change, also by
+        another process.
+
+        :return: The version
+        :rtype: int
+        """
+        if self.store is not None:
+            return self.version + self.store.getDataVersion()
+        self._loadResult()
+
+        return self.version
+
+    def _statResult(self) -> Optional[tuple[int, int, int]]:
+        """
+        Get the signature of the result file.
+
+        :return: The inode, size and mtime of the file, None if not found
+        :rtype: tuple[int, int, int]
+        """
+        try:
+            stat = os.stat(self.resultPath)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
     def _loadResult(self):
         """
-        Load the result from the JSON file.
+        Load the result from the JSON file, if it changed since the last load.
+        In journal mode, the results in memory are authoritative.
+        In sqlite mode, the results are not kept in memory.
         """
+        if self.journal is not None or self.store is not None:
+            return
+        signature = self._statResult()
+        if signature is not None and signature == self._fileSignature:
+            return
         try:
             with open(self.resultPath, "r") as file:
                 self.results = json.load(file)
+            self._fileSignature = signature
+            self.version += 1
         except FileNotFoundError as e:
             logging.warning(
                 f"Result file {self.resultPath} not found. Creating a new one."
@@ -37,13 +269,21 @@ class ResultManager:
 
     def _saveResult(self) -> None:
         """
-        Save the result to the JSON file.
+        Save the result to the JSON file, replaced at once so the other
+        processes never read it partially written.
         """
-        with open(self.resultPath, "w") as file:
+        tmpPath = os.path.join(
+            os.path.dirname(self.resultPath),
+            f".{os.path.basename(self.resultPath)}.tmp",
+        )
+        with open(tmpPath, "w") as file:
             json.dump(self.results, file, indent=4)
+        os.replace(tmpPath, self.resultPath)
 
-        self._loadResult()
+        # The results in memory are what was just written
+        self._fileSignature = self._statResult()
 
+    @ServerMetrics.persistenceLatency.labels("result", "add").time()
     def addResult(self, p_serial: str, p_info: dict[Any, Any]) -> None:
         """
         Add a result to the results dictionary.
@@ -53,16 +293,20 @@ class ResultManager:
         :param p_info: The information to add
         :type p_info: dict
         """
+        if self.store is not None:
+            self.store.putResults({p_serial: p_info})
+            self.version += 1
+            return
         self._loadResult()
-        # check if the serial number is already in the results
-        if p_serial in self.results:
-            # add the new information to the existing information
-            self.results[p_serial].update(p_info)
+        record = {"op": "add", "serial": p_serial, "info": p_info}
+        ResultJournal.applyRecord(self.results, record)
+        if self.journal is not None:
+            self.journal.append(record)
         else:
-            # add the new information to the results
-            self.results[p_serial] = p_info
-        self._saveResult()
+            self._saveResult()
+        self.version += 1
 
+    @ServerMetrics.persistenceLatency.labels("result", "modify").time()
     def modifyResult(
         self, p_serial: str, p_timestamp: str, p_info: dict[Any, Any]
     ) -> None:
@@ -76,13 +320,31 @@ class ResultManager:
         :param p_info: The information to modify
         :type p_info: dict
         """
+        if self.store is not None:
+            if self.store.getResult(p_serial, p_timestamp) is None:
+                logging.error(
+                    f"Error in modifyResult: Timestamp '{p_timestamp}' not found for serial '{p_serial}'"
+                )
+            else:
+                self.store.putResults({p_serial: {p_timestamp: p_info}})
+                self.version += 1
+            return
         self._loadResult()
         try:
             if p_serial in self.results and p_timestamp in self.results[p_serial]:
                 # Merge the updated values into the existing structure
-
-                self.results[p_serial][p_timestamp] = p_info
-                self._saveResult()
+                record = {
+                    "op": "modify",
+                    "serial": p_serial,
+                    "timestamp": p_timestamp,
+                    "info": p_info,
+                }
+                ResultJournal.applyRecord(self.results, record)
+                if self.journal is not None:
+                    self.journal.append(record)
+                else:
+                    self._saveResult()
+                self.version += 1
 
             else:
                 raise KeyError(
@@ -91,6 +353,37 @@ class ResultManager:
         except Exception as e:
             logging.error(f"Error in modifyResult: {e}")
 
+    @ServerMetrics.persistenceLatency.labels("result", "batch").time()
+    def putResults(self, p_results: dict[Any, Any]) -> None:
+        """
+        Insert or replace results in one write: one transaction in sqlite
+        mode, one rewrite of the result file in json mode.
+
+        :param p_results: The results, keyed by serial then by timestamp
+        :type p_results: dict
+        """
+        if not p_results:
+            return
+        if self.store is not None:
+            self.store.putResults(p_results)
+            self.version += 1
+            return
+        self._loadResult()
+        for serial, records in p_results.items():
+            for timestamp, info in records.items():
+                record = {
+                    "op": "modify",
+                    "serial": serial,
+                    "timestamp": timestamp,
+                    "info": info,
+                }
+                ResultJournal.applyRecord(self.results, record)
+                if self.journal is not None:
+                    self.journal.append(record)
+        if self.journal is None:
+            self._saveResult()
+        self.version += 1
+
     def getResult(self, p_serial: str, p_timestamp: str) -> dict[Any, Any]:
         """
         Get the result for the serial number.
@@ -101,33 +394,86 @@ class ResultManager:
         :return: The result
         :rtype: dict
         """
+        if self.store is not None:
+            result = self.store.getResult(p_serial, p_timestamp)
+            if result is not None:
+                return result
+            elif self.store.hasSerial(p_serial):
+                return self._getArchivedResult(
+                    p_serial, p_timestamp, "Timestamp not found"
+                )
+            else:
+                return self._getArchivedResult(p_serial, p_timestamp)
         self._loadResult()
         try:
             if p_serial in self.results:
                 if p_timestamp in self.results[p_serial]:
                     return self.results[p_serial][p_timestamp]
                 else:
-                    return {"error": "Timestamp not found"}
+                    return self._getArchivedResult(
+                        p_serial, p_timestamp, "Timestamp not found"
+                    )
             else:
-                return {"error": "Serial number not found"}
+                return self._getArchivedResult(p_serial, p_timestamp)
         except Exception as e:
             logging.error(f"Error in getResult: {e}")
             return {"error": "Error in getResult"}
 
-    def getResultsBySerial(self, p_serial: str) -> dict[Any, Any]:
+    def _getArchivedResult(
+        self,
+        p_serial: str,
+        p_timestamp: str,
+        p_error: str = "Serial number not found",
+    ) -> dict[Any, Any]:
+        """
+        Get a result from the archive.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The timestamp
+        :type p_timestamp: str
+        :param p_error: The error returned if the result is not archived
+        :type p_error: str
+
+        :return: The result
+        :rtype: dict
+        """
+        if self.archive is not None:
+            result = self.archive.getResult(p_serial, p_timestamp)
+            if result is not None:
+                return result
+
+        return {"error": p_error}
+
+    def getResultsBySerial(
+        self, p_serial: str, p_limit: Optional[int] = None
+    ) -> dict[Any, Any]:
         """
         Get all the results for the serial number.
 
         :param p_serial: The serial number
         :type p_serial: str
+        :param p_limit: The maximal number of results, the most recent ones are kept
+        :type p_limit: int
 
         :return: The results
         :rtype: dict
         """
+        if self.store is not None:
+            results = self.store.getResultsBySerial(p_serial, p_limit)
+            return results if results else {"error": "Serial number not found"}
         self._loadResult()
         try:
             if p_serial in self.results:
-                return self.results[p_serial]
+                if p_limit is None:
+                    return self.results[p_serial]
+                records = sorted(
+                    self.results[p_serial].items(),
+                    key=lambda item: ResultQuery.sortKey(
+                        ResultQuery.indexFields(p_serial, item[0], item[1])
+                    ),
+                )
+                return dict(records[-p_limit:])
             else:
                 return {"error": "Serial number not found"}
         except Exception as e:
@@ -141,6 +487,109 @@ class ResultManager:
         :return: The results
         :rtype: dict
         """
+        if self.store is not None:
+            return self.store.getResults()
         self._loadResult()
 
         return self.results
+
+    def queryResults(
+        self, p_query: ResultQuery
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Query the results, the archived ones first. The indexes are used in
+        sqlite mode, the results are scanned in memory otherwise.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The (indexed fields, result) pairs of the page
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        if self.archive is None:
+            return self._queryLive(p_query)
+
+        return self._queryArchiveThenLive(p_query)
+
+    def _queryArchiveThenLive(
+        self, p_query: ResultQuery
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Query the archived results, then the live ones. The retention always
+        archives the oldest results, so the order is kept.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The (indexed fields, result) pairs of the page
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        assert self.archive is not None
+        count = 0
+        for item in self.archive.query(p_query):
+            if p_query.limit is not None and count >= p_query.limit:
+                return
+            count += 1
+            yield item
+
+        liveQuery = copy.copy(p_query)
+        if p_query.limit is not None:
+            liveQuery.limit = p_query.limit - count
+            if liveQuery.limit <= 0:
+                return
+        yield from self._queryLive(liveQuery)
+
+    def _queryLive(
+        self, p_query: ResultQuery
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Query the live results.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The (indexed fields, result) pairs of the page
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        if self.store is not None:
+            return self.store.query(p_query)
+        self._loadResult()
+
+        return p_query.iterate(self.results)
+
+    def countResults(self, p_query: ResultQuery) -> int:
+        """
+        Count the results matching a query, the cursor and the limit are ignored.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The number of matching results
+        :rtype: int
+        """
+        count = self._countLive(p_query)
+        if self.archive is not None:
+            count += self.archive.count(p_query)
+
+        return count
+
+    def _countLive(self, p_query: ResultQuery) -> int:
+        """
+        Count the live results matching a query, the cursor and the limit are ignored.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The number of matching results
+        :rtype: int
+        """
+        if self.store is not None:
+            return self.store.count(p_query)
+        self._loadResult()
+
+        return sum(
+            1
+            for serial, records in self.results.items()
+            for timestamp, record in records.items()
+            if p_query.matches(ResultQuery.indexFields(serial, timestamp, record))
+        )
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import base64
+import heapq
+import json
+from datetime import datetime
+from typing import Any, Iterable, Iterator, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ResultQuery:
+    """
+    Filters and keyset pagination over the provisioning results.
+
+    The results are ordered by (startTime, serial, timestamp), the cursor is
+    the key of the last returned result.
+    """
+
+    serial: Optional[str]
+    mac: Optional[str]
+    cid: Optional[str]
+    projectName: Optional[str]
+    state: Optional[str]
+    result: Optional[bool]
+    since: Optional[str]
+    until: Optional[str]
+    limit: Optional[int]
+    after: Optional[tuple[str, str, str]]
+
+    def __init__(
+        self,
+        p_serial: Optional[str] = None,
+        p_mac: Optional[str] = None,
+        p_cid: Optional[str] = None,
+        p_projectName: Optional[str] = None,
+        p_state: Optional[str] = None,
+        p_result: Optional[bool] = None,
+        p_since: Optional[str] = None,
+        p_until: Optional[str] = None,
+        p_limit: Optional[int] = None,
+        p_cursor: Optional[str] = None,
+    ) -> None:
+        """
+        Constructor
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_mac: The MAC address
+        :type p_mac: str
+        :param p_cid: The storage CID
+        :type p_cid: str
+        :param p_projectName: The project name
+        :type p_projectName: str
+        :param p_state: The provisioning state ("started", "completed")
+        :type p_state: str
+        :param p_result: The provisioning result
+        :type p_result: bool
+        :param p_since: The minimal start time, ISO 8601 (included)
+        :type p_since: str
+        :param p_until: The maximal start time, ISO 8601 (excluded)
+        :type p_until: str
+        :param p_limit: The maximal number of results, None for no limit
+        :type p_limit: int
+        :param p_cursor: The cursor returned by the previous page
+        :type p_cursor: str
+
+        :raises ValueError: If a time or the cursor is malformed
+        """
+        self.serial = p_serial
+        self.mac = p_mac
+        self.cid = p_cid
+        self.projectName = p_projectName
+        self.state = p_state
+        self.result = p_result
+        self.since = self.normalizeTime(p_since) if p_since else None
+        self.until = self.normalizeTime(p_until) if p_until else None
+        self.limit = p_limit
+        self.after = self.decodeCursor(p_cursor) if p_cursor else None
+
+    @staticmethod
+    def normalizeTime(p_time: str) -> str:
+        """
+        Normalize a time to the sortable ISO 8601 format.
+
+        :param p_time: The time, ISO 8601 or the "%Y%m%d_%H:%M:%S" result key
+        :type p_time: str
+
+        :return: The normalized time
+        :rtype: str
+
+        :raises ValueError: If the time is malformed
+        """
+        try:
+            return datetime.fromisoformat(p_time).isoformat()
+        except ValueError:
+            return datetime.strptime(p_time, "%Y%m%d_%H:%M:%S").isoformat()
+
+    @staticmethod
+    def encodeCursor(p_key: tuple[str, str, str]) -> str:
+        """
+        Encode a result key as an opaque cursor.
+
+        :param p_key: The (startTime, serial, timestamp) key
+        :type p_key: tuple
+
+        :return: The cursor
+        :rtype: str
+        """
+        return base64.urlsafe_b64encode(json.dumps(list(p_key)).encode()).decode()
+
+    @staticmethod
+    def decodeCursor(p_cursor: str) -> tuple[str, str, str]:
+        """
+        Decode an opaque cursor.
+
+        :param p_cursor: The cursor
+        :type p_cursor: str
+
+        :return: The (startTime, serial, timestamp) key
+        :rtype: tuple
+
+        :raises ValueError: If the cursor is malformed
+        """
+        try:
+            startTime, serial, timestamp = json.loads(
+                base64.urlsafe_b64decode(p_cursor.encode())
+            )
+            return str(startTime), str(serial), str(timestamp)
+        except Exception as e:
+            raise ValueError(f"Invalid cursor '{p_cursor}'") from e
+
+    @staticmethod
+    def indexFields(
+        p_serial: str, p_timestamp: str, p_record: dict[Any, Any]
+    ) -> dict[str, Any]:
+        """
+        Extract the indexed fields of a result.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The result timestamp
+        :type p_timestamp: str
+        :param p_record: The result
+        :type p_record: dict
+
+        :return: The indexed fields
+        :rtype: dict
+        """
+        cmInfo = p_record.get("cmInfo", {}) if isinstance(p_record, dict) else {}
+        provisionInfo = (
+            p_record.get("cmProvisionInfo", {}) if isinstance(p_record, dict) else {}
+        )
+        try:
+            startTime = ResultQuery.normalizeTime(
+                str(provisionInfo.get("starTime", "")) or p_timestamp
+            )
+        except ValueError:
+            startTime = ""
+
+        return {
+            "serial": p_serial,
+            "timestamp": p_timestamp,
+            "mac": str(cmInfo.get("mac", "")),
+            "cid": str(cmInfo.get("cid", "")),
+            "projectName": str(provisionInfo.get("projectName", "")),
+            "state": str(provisionInfo.get("state", "")),
+            "result": bool(provisionInfo.get("result", False)),
+            "startTime": startTime,
+        }
+
+    def matches(self, p_fields: dict[str, Any]) -> bool:
+        """
+        Check if the indexed fields of a result match the filters.
+        The cursor and the limit are not taken into account.
+
+        :param p_fields: The indexed fields, see indexFields
+        :type p_fields: dict
+
+        :return: True if the result matches
+        :rtype: bool
+        """
+        for name in ("serial", "mac", "cid", "projectName", "state", "result"):
+            expected = getattr(self, name)
+            if expected is not None and p_fields[name] != expected:
+                return False
+        if self.since is not None and p_fields["startTime"] < self.since:
+            return False
+        if self.until is not None and p_fields["startTime"] >= self.until:
+            return False
+
+        return True
+
+    @staticmethod
+    def sortKey(p_fields: dict[str, Any]) -> tuple[str, str, str]:
+        """
+        Get the pagination key of a result.
+
+        :param p_fields: The indexed fields, see indexFields
+        :type p_fields: dict
+
+        :return: The (startTime, serial, timestamp) key
+        :rtype: tuple
+        """
+        return p_fields["startTime"], p_fields["serial"], p_fields["timestamp"]
+
+    def iterate(
+        self, p_results: dict[Any, Any]
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Filter, sort and paginate a results dictionary in memory.
+
+        :param p_results: The results, keyed by serial then by timestamp
+        :type p_results: dict
+
+        :return: The (indexed fields, result) pairs of the page
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        if self.serial is not None:
+            serials: Iterable[Any] = [self.serial] if self.serial in p_results else []
+        else:
+            serials = list(p_results.keys())
+
+        matching = []
+        for serial in serials:
+            for timestamp, record in list(p_results[serial].items()):
+                fields = self.indexFields(serial, timestamp, record)
+                if not self.matches(fields):
+                    continue
+                if self.after is not None and self.sortKey(fields) <= self.after:
+                    continue
+                matching.append((fields, record))
+
+        if self.limit is None:
+            matching.sort(key=lambda item: self.sortKey(item[0]))
+            return iter(matching)
+        return iter(
+            heapq.nsmallest(
+                self.limit, matching, key=lambda item: self.sortKey(item[0])
+            )
+        )
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional
+from resultQuery import ResultQuery
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ResultSqliteStore:
+    """
+    SQLite storage of the provisioning results, one row per provisioning,
+    indexed on the fields used by the result queries.
+    """
+
+    dbPath: str
+    QUERY_BATCH_SIZE = 500
+    INDEXED_COLUMNS = ("mac", "cid", "projectName", "state", "result", "startTime")
+
+    def __init__(self, p_dbPath: str) -> None:
+        """
+        Constructor
+
+        :param p_dbPath: The SQLite database file
+        :type p_dbPath: str
+        """
+        self.dbPath = p_dbPath
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(p_dbPath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._createSchema()
+
+    def _createSchema(self) -> None:
+        """
+        Create the table and the indexes.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    serial TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    mac TEXT,
+                    cid TEXT,
+                    projectName TEXT,
+                    state TEXT,
+                    result INTEGER,
+                    startTime TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (serial, timestamp)
+                )
+                """)
+            for column in self.INDEXED_COLUMNS:
+                self._connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_results_{column} "
+                    f"ON results ({column}, startTime, serial, timestamp)"
+                )
+
+    @staticmethod
+    def _row(p_serial: str, p_timestamp: str, p_record: Any) -> tuple[Any, ...]:
+        """
+        Build the row of a result.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The result timestamp
+        :type p_timestamp: str
+        :param p_record: The result
+        :type p_record: dict
+
+        :return: The row values
+        :rtype: tuple
+        """
+        fields = ResultQuery.indexFields(p_serial, p_timestamp, p_record)
+        return (
+            p_serial,
+            p_timestamp,
+            fields["mac"],
+            fields["cid"],
+            fields["projectName"],
+            fields["state"],
+            int(fields["result"]),
+            fields["startTime"],
+            json.dumps(p_record),
+        )
+
+    def isEmpty(self) -> bool:
+        """
+        Check if the store has no result.
+
+        :return: True if there is no result
+        :rtype: bool
+        """
+        with self._lock:
+            return (
+                self._connection.execute("SELECT 1 FROM results LIMIT 1").fetchone()
+                is None
+            )
+
+    def putResults(self, p_results: dict[Any, Any]) -> None:
+        """
+        Insert or replace results in one transaction.
+
+        :param p_results: The results, keyed by serial then by timestamp
+        :type p_results: dict
+        """
+        rows = [
+            self._row(serial, timestamp, record)
+            for serial, records in p_results.items()
+            for timestamp, record in records.items()
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def deleteResults(self, p_keys: list[tuple[str, str]]) -> None:
+        """
+        Delete results in one transaction.
+
+        :param p_keys: The (serial, timestamp) keys of the results
+        :type p_keys: list
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM results WHERE serial = ? AND timestamp = ?", p_keys
+            )
+
+    def getResult(self, p_serial: str, p_timestamp: str) -> Optional[dict[Any, Any]]:
+        """
+        Get a result.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_timestamp: The result timestamp
+        :type p_timestamp: str
+
+        :return: The result, None if not found
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM results WHERE serial = ? AND timestamp = ?",
+                (p_serial, p_timestamp),
+            ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def hasSerial(self, p_serial: str) -> bool:
+        """
+        Check if a serial number has results.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+
+        :return: True if the serial number has results
+        :rtype: bool
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM results WHERE serial = ? LIMIT 1", (p_serial,)
+            ).fetchone()
+
+        return row is not None
+
+    def getResultsBySerial(
+        self, p_serial: str, p_limit: Optional[int] = None
+    ) -> dict[Any, Any]:
+        """
+        Get the results of a serial number.
+
+        :param p_serial: The serial number
+        :type p_serial: str
+        :param p_limit: The maximal number of results, the most recent ones are kept
+        :type p_limit: int
+
+        :return: The results keyed by timestamp, ordered by start time
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT timestamp, data FROM results WHERE serial = ?"
+                " ORDER BY startTime DESC, timestamp DESC LIMIT ?",
+                (p_serial, -1 if p_limit is None else p_limit),
+            ).fetchall()
+
+        return {timestamp: json.loads(data) for timestamp, data in reversed(rows)}
+
+    def getResults(self) -> dict[Any, Any]:
+        """
+        Get all the results.
+
+        :return: The results, keyed by serial then by timestamp
+        :rtype: dict
+        """
+        results: dict[Any, Any] = {}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT serial, timestamp, data FROM results"
+            ).fetchall()
+        for serial, timestamp, data in rows:
+            results.setdefault(serial, {})[timestamp] = json.loads(data)
+
+        return results
+
+    def _where(
+        self, p_query: ResultQuery, p_withCursor: bool = True
+    ) -> tuple[str, list[Any]]:
+        """
+        Build the WHERE clause of a query.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+        :param p_withCursor: Take the cursor of the query into account
+        :type p_withCursor: bool
+
+        :return: The clause and its parameters
+        :rtype: tuple[str, list]
+        """
+        clauses: list[str] = []
+        params: list[Any] = []
+        for name in ("serial", "mac", "cid", "projectName", "state"):
+            value = getattr(p_query, name)
+            if value is not None:
+                clauses.append(f"{name} = ?")
+                params.append(value)
+        if p_query.result is not None:
+            clauses.append("result = ?")
+            params.append(int(p_query.result))
+        if p_query.since is not None:
+            clauses.append("startTime >= ?")
+            params.append(p_query.since)
+        if p_query.until is not None:
+            clauses.append("startTime < ?")
+            params.append(p_query.until)
+        if p_withCursor and p_query.after is not None:
+            clauses.append("(startTime, serial, timestamp) > (?, ?, ?)")
+            params.extend(p_query.after)
+
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(
+        self, p_query: ResultQuery
+    ) -> Iterator[tuple[dict[str, Any], dict[Any, Any]]]:
+        """
+        Run a query on the indexes. The rows are fetched by batches, so a
+        query without limit does not load all the matching results at once.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The (indexed fields, result) pairs of the page
+        :rtype: Iterator[tuple[dict, dict]]
+        """
+        after = p_query.after
+        remaining = p_query.limit
+        while remaining is None or remaining > 0:
+            batchSize = self.QUERY_BATCH_SIZE
+            if remaining is not None:
+                batchSize = min(batchSize, remaining)
+            where, params = self._where(p_query, p_withCursor=False)
+            if after is not None:
+                where += " AND " if where else " WHERE "
+                where += "(startTime, serial, timestamp) > (?, ?, ?)"
+                params.extend(after)
+            sql = (
+                "SELECT serial, timestamp, data FROM results"
+                f"{where} ORDER BY startTime, serial, timestamp LIMIT ?"
+            )
+            params.append(batchSize)
+            with self._lock:
+                rows = self._connection.execute(sql, params).fetchall()
+
+            for serial, timestamp, data in rows:
+                record = json.loads(data)
+                fields = ResultQuery.indexFields(serial, timestamp, record)
+                after = ResultQuery.sortKey(fields)
+                yield fields, record
+
+            if len(rows) < batchSize:
+                break
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def count(self, p_query: ResultQuery) -> int:
+        """
+        Count the results matching a query, the cursor and the limit are ignored.
+
+        :param p_query: The query
+        :type p_query: ResultQuery
+
+        :return: The number of matching results
+        :rtype: int
+        """
+        where, params = self._where(p_query, p_withCursor=False)
+        with self._lock:
+            return self._connection.execute(
+                f"SELECT COUNT(*) FROM results{where}", params
+            ).fetchone()[0]
+
+    def getDataVersion(self) -> int:
+        """
+        Get the data version of the database, changed by the commits of the
+        other connections, in this process or another one.
+
+        :return: The data version
+        :rtype: int
+        """
+        with self._lock:
+            return self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._connection.close()
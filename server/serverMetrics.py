@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import asyncio
+import math
+import os
+import time
+from typing import Any
+
+# In multi-process mode, prometheus_client opens its value files in this
+# directory when the metrics are created
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class ServerMetrics:
+    """
+    Prometheus metrics of the provisioning server, exposed on /metrics.
+
+    When the PROMETHEUS_MULTIPROC_DIR environment variable is set, every
+    worker process writes its values to memory mapped files in that
+    directory, and /metrics aggregates the files of all the workers. The
+    directory must be emptied before the workers start.
+    """
+
+    requestLatency = Histogram(
+        "cmprovision_http_request_duration_seconds",
+        "Duration of the HTTP requests, until the end of the response",
+        ["method", "route", "status"],
+        buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 900, math.inf),
+    )
+    bytesServed = Counter(
+        "cmprovision_image_bytes_served_total",
+        "Bytes of image sent to the clients",
+        ["route"],
+    )
+    activeTransfers = Gauge(
+        "cmprovision_image_active_transfers",
+        "Image downloads being sent",
+        multiprocess_mode="livesum",
+    )
+    provisioningStarted = Counter(
+        "cmprovision_provisioning_started_total",
+        "Provisionings started by a CM",
+        ["project"],
+    )
+    provisioningCompleted = Counter(
+        "cmprovision_provisioning_completed_total",
+        "Provisionings completed successfully",
+        ["project"],
+    )
+    provisioningFailed = Counter(
+        "cmprovision_provisioning_failed_total",
+        "Provisionings failed",
+        ["project", "phase"],
+    )
+    provisioningDuration = Histogram(
+        "cmprovision_provisioning_duration_seconds",
+        "Duration of the provisionings, per nominal storage size",
+        ["storage", "result"],
+        buckets=(30, 60, 120, 180, 300, 450, 600, 900, 1800, 3600, math.inf),
+    )
+    persistenceLatency = Histogram(
+        "cmprovision_persistence_duration_seconds",
+        "Duration of the writes of the results and of the projects",
+        ["store", "operation"],
+        buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, math.inf),
+    )
+    eventBatchSize = Histogram(
+        "cmprovision_provisioning_event_batch_size",
+        "Provisioning events applied and stored at once",
+        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, math.inf),
+    )
+    websocketClients = Gauge(
+        "cmprovision_websocket_clients",
+        "Connected WebSocket clients",
+        multiprocess_mode="livesum",
+    )
+    websocketBroadcast = Histogram(
+        "cmprovision_websocket_broadcast_duration_seconds",
+        "Duration of the serialization and the queuing of a message for all the WebSocket clients",
+        buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, math.inf),
+    )
+    websocketCoalesced = Counter(
+        "cmprovision_websocket_coalesced_messages_total",
+        "Messages replacing a pending message of the same result for a WebSocket client",
+    )
+    websocketDropped = Counter(
+        "cmprovision_websocket_dropped_clients_total",
+        "WebSocket clients disconnected for being too slow",
+    )
+    eventLoopLag = Histogram(
+        "cmprovision_event_loop_lag_seconds",
+        "Delay of the event loop in running a task ready to run",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, math.inf),
+    )
+    eventLoopBlocked = Counter(
+        "cmprovision_event_loop_blocked_total",
+        "Callbacks blocking the event loop longer than the watchdog threshold",
+    )
+
+    @staticmethod
+    def storageLabel(p_sectors: int) -> str:
+        """
+        Get the nominal size of a storage, as sold.
+
+        :param p_sectors: The size of the storage in 512 bytes sectors
+        :type p_sectors: int
+
+        :return: The size rounded up to a power of two, as "<size>GB"
+        :rtype: str
+        """
+        size = p_sectors * 512 / (1024 * 1024 * 1024)
+        if size <= 0:
+            return "unknown"
+
+        return f"{2 ** max(0, math.ceil(math.log2(size)))}GB"
+
+    @staticmethod
+    def render() -> tuple[bytes, str]:
+        """
+        Render the metrics in the Prometheus text format.
+
+        :return: The metrics and their content type
+        :rtype: tuple[bytes, str]
+        """
+        registry = REGISTRY
+        if MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+    @classmethod
+    async def monitorEventLoop(cls, p_interval: float = 0.5) -> None:
+        """
+        Measure the lag of the event loop, until cancelled.
+
+        :param p_interval: The period of the measures in seconds
+        :type p_interval: float
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(p_interval)
+            cls.eventLoopLag.observe(max(0.0, time.perf_counter() - start - p_interval))
+
+    @staticmethod
+    def markProcessDead() -> None:
+        """
+        Remove the live gauges of the current worker process.
+        """
+        if MULTIPROC_DIR:
+            multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware measuring the duration of the HTTP requests per route,
+    and the bytes and the number of the image downloads being sent.
+    """
+
+    TRANSFER_ROUTES = ("/downloadimage/{filename}", "/image/download-image")
+
+    def __init__(self, app: ASGIApp) -> None:
+        """
+        Constructor
+
+        :param app: The wrapped application
+        :type app: ASGIApp
+        """
+        self.app = app
+
+    @staticmethod
+    def _route(p_scope: Scope) -> str:
+        """
+        Get the path template of the route of a request, so the requests of
+        the same route share their metrics.
+
+        :param p_scope: The scope of the request, after the routing
+        :type p_scope: Scope
+
+        :return: The path template, "unmatched" without route
+        :rtype: str
+        """
+        route = p_scope.get("route")
+        return getattr(route, "path", "unmatched")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        state: dict[str, Any] = {"status": 500, "transfer": None}
+
+        async def metricsSend(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                route = self._route(scope)
+                if route in self.TRANSFER_ROUTES and message["status"] < 300:
+                    state["transfer"] = route
+                    ServerMetrics.activeTransfers.inc()
+            elif message["type"] == "http.response.body" and state["transfer"]:
+                ServerMetrics.bytesServed.labels(state["transfer"]).inc(
+                    len(message.get("body", b""))
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, metricsSend)
+        finally:
+            if state["transfer"]:
+                ServerMetrics.activeTransfers.dec()
+            ServerMetrics.requestLatency.labels(
+                scope["method"], self._route(scope), str(state["status"])
+            ).observe(time.perf_counter() - start)
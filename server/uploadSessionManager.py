@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class UploadSessionManager:
+    """
+    Resumable chunked uploads.
+
+    An upload session preallocates the file, then the numbered chunks are
+    written at their offset as they arrive, in any order and in parallel.
+    The received chunks are appended to a log file of the session, so the
+    upload can be resumed after a network failure or a server restart. The
+    log is read again on every request, so the chunks of a session may be
+    sent to different HTTP worker processes.
+
+    Each session is stored in "<directory>/.sessions/<uploadId>/":
+    "session.json" (the metadata), "data.part" (the file) and "received"
+    (the indexes of the received chunks, one per line).
+    """
+
+    directory: str
+    sessionsDir: str
+    MIN_CHUNK_SIZE = 1024 * 1024
+    MAX_CHUNK_SIZE = 64 * 1024 * 1024
+    SESSION_TTL = 24 * 3600
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, p_directory: str) -> None:
+        """
+        Constructor
+
+        :param p_directory: The destination directory of the uploaded files
+        :type p_directory: str
+        """
+        self.directory = p_directory
+        self.sessionsDir = os.path.join(p_directory, ".sessions")
+        self._lock = threading.Lock()
+        self._sessions: dict[str, dict[str, Any]] = {}
+
+    @staticmethod
+    def installFile(p_tmpPath: str, p_filePath: str, p_sha256sum: str) -> bool:
+        """
+        Move a verified file into place with its checksum file. An existing
+        file is never replaced.
+
+        :param p_tmpPath: The verified file, in the destination file system
+        :type p_tmpPath: str
+        :param p_filePath: The destination file
+        :type p_filePath: str
+        :param p_sha256sum: The SHA256 checksum of the file
+        :type p_sha256sum: str
+
+        :return: True if the file was installed, False if it already exists
+        :rtype: bool
+        """
+        try:
+            os.link(p_tmpPath, p_filePath)
+        except FileExistsError:
+            return False
+        except OSError:
+            # No hard link support, fall back to a plain rename
+            if os.path.exists(p_filePath):
+                return False
+            os.replace(p_tmpPath, p_filePath)
+
+        with open(f"{p_filePath}.sha256sum", "w") as file:
+            file.write(p_sha256sum)
+
+        return True
+
+    def _sessionDir(self, p_uploadId: str) -> str:
+        """
+        Get the directory of a session.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+
+        :return: The session directory
+        :rtype: str
+
+        :raises KeyError: If the identifier is malformed
+        """
+        if not p_uploadId.isalnum():
+            raise KeyError(f"Upload session '{p_uploadId}' not found")
+
+        return os.path.join(self.sessionsDir, p_uploadId)
+
+    def _getSession(self, p_uploadId: str) -> dict[str, Any]:
+        """
+        Get a session, with the chunks received so far. The metadata is
+        loaded from disk once, the received chunks on every call.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+
+        :return: The session
+        :rtype: dict
+
+        :raises KeyError: If the session does not exist
+        """
+        sessionDir = self._sessionDir(p_uploadId)
+        with self._lock:
+            session = self._sessions.get(p_uploadId)
+        if session is None:
+            try:
+                with open(os.path.join(sessionDir, "session.json"), "r") as file:
+                    session = json.load(file)
+            except FileNotFoundError:
+                raise KeyError(f"Upload session '{p_uploadId}' not found")
+            with self._lock:
+                self._sessions[p_uploadId] = session
+
+        received: set[int] = set()
+        try:
+            with open(os.path.join(sessionDir, "received"), "r") as file:
+                for line in file:
+                    if line.strip().isdigit():
+                        received.add(int(line))
+        except FileNotFoundError:
+            # Aborted or finalized by another process
+            if not os.path.isdir(sessionDir):
+                with self._lock:
+                    self._sessions.pop(p_uploadId, None)
+                raise KeyError(f"Upload session '{p_uploadId}' not found")
+
+        return {**session, "received": received}
+
+    def _removeExpiredSessions(self) -> None:
+        """
+        Remove the sessions not updated for SESSION_TTL seconds.
+        """
+        if not os.path.isdir(self.sessionsDir):
+            return
+        now = time.time()
+        for uploadId in os.listdir(self.sessionsDir):
+            sessionDir = os.path.join(self.sessionsDir, uploadId)
+            lastUpdate = os.path.getmtime(sessionDir)
+            receivedPath = os.path.join(sessionDir, "received")
+            if os.path.exists(receivedPath):
+                lastUpdate = max(lastUpdate, os.path.getmtime(receivedPath))
+            if now - lastUpdate > self.SESSION_TTL:
+                logging.info(f"Removing expired upload session {uploadId}")
+                with self._lock:
+                    self._sessions.pop(uploadId, None)
+                shutil.rmtree(sessionDir, ignore_errors=True)
+
+    def createSession(
+        self, p_filename: str, p_size: int, p_sha256sum: str, p_chunkSize: int
+    ) -> dict[str, Any]:
+        """
+        Create an upload session and preallocate its file.
+
+        :param p_filename: The name of the uploaded file
+        :type p_filename: str
+        :param p_size: The size of the file in bytes
+        :type p_size: int
+        :param p_sha256sum: The expected SHA256 checksum of the file
+        :type p_sha256sum: str
+        :param p_chunkSize: The size of the chunks, the last one may be shorter
+        :type p_chunkSize: int
+
+        :return: The session status, see getStatus
+        :rtype: dict
+
+        :raises ValueError: If a parameter is invalid or the file already exists
+        """
+        filename = os.path.basename(p_filename)
+        if not filename or filename.startswith("."):
+            raise ValueError(f"Invalid file name '{p_filename}'")
+        if os.path.exists(os.path.join(self.directory, filename)):
+            raise ValueError(f"File '{filename}' already exists")
+        if p_size <= 0:
+            raise ValueError("The file size must be positive")
+        if not self.MIN_CHUNK_SIZE <= p_chunkSize <= self.MAX_CHUNK_SIZE:
+            raise ValueError(
+                f"The chunk size must be between {self.MIN_CHUNK_SIZE} and {self.MAX_CHUNK_SIZE}"
+            )
+
+        self._removeExpiredSessions()
+
+        uploadId = uuid.uuid4().hex
+        sessionDir = self._sessionDir(uploadId)
+        os.makedirs(sessionDir)
+        with open(os.path.join(sessionDir, "data.part"), "wb") as file:
+            try:
+                os.posix_fallocate(file.fileno(), 0, p_size)
+            except OSError:
+                file.truncate(p_size)
+        session = {
+            "uploadId": uploadId,
+            "filename": filename,
+            "size": p_size,
+            "sha256sum": p_sha256sum,
+            "chunkSize": p_chunkSize,
+            "chunkCount": (p_size + p_chunkSize - 1) // p_chunkSize,
+        }
+        with open(os.path.join(sessionDir, "session.json"), "w") as file:
+            json.dump(session, file, indent=4)
+        with self._lock:
+            self._sessions[uploadId] = session
+        logging.info(
+            f"Upload session {uploadId} created for '{filename}', {session['chunkCount']} chunks"
+        )
+
+        return self.getStatus(uploadId)
+
+    def getStatus(self, p_uploadId: str) -> dict[str, Any]:
+        """
+        Get the status of a session.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+
+        :return: The session metadata with the missing chunk indexes
+        :rtype: dict
+
+        :raises KeyError: If the session does not exist
+        """
+        session = self._getSession(p_uploadId)
+        status = {key: value for key, value in session.items() if key != "received"}
+        status["missing"] = [
+            index
+            for index in range(session["chunkCount"])
+            if index not in session["received"]
+        ]
+
+        return status
+
+    def writeChunk(
+        self,
+        p_uploadId: str,
+        p_index: int,
+        p_data: bytes,
+        p_chunkSha256sum: Optional[str] = None,
+    ) -> None:
+        """
+        Write a chunk at its offset, after verifying it.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+        :param p_index: The chunk index, from 0
+        :type p_index: int
+        :param p_data: The chunk content
+        :type p_data: bytes
+        :param p_chunkSha256sum: The expected SHA256 checksum of the chunk
+        :type p_chunkSha256sum: str
+
+        :raises KeyError: If the session does not exist
+        :raises ValueError: If the chunk is invalid
+        """
+        session = self._getSession(p_uploadId)
+        if not 0 <= p_index < session["chunkCount"]:
+            raise ValueError(f"Invalid chunk index {p_index}")
+        offset = p_index * session["chunkSize"]
+        expectedSize = min(session["chunkSize"], session["size"] - offset)
+        if len(p_data) != expectedSize:
+            raise ValueError(
+                f"Chunk {p_index} size is {len(p_data)}, expected {expectedSize}"
+            )
+        if (
+            p_chunkSha256sum is not None
+            and hashlib.sha256(p_data).hexdigest() != p_chunkSha256sum
+        ):
+            raise ValueError(f"Chunk {p_index} SHA256 checksum mismatch")
+
+        sessionDir = self._sessionDir(p_uploadId)
+        fd = os.open(os.path.join(sessionDir, "data.part"), os.O_WRONLY)
+        try:
+            os.pwrite(fd, p_data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if p_index not in session["received"]:
+            # A single append, the log may be shared by several processes
+            with open(os.path.join(sessionDir, "received"), "a") as file:
+                file.write(f"{p_index}\n")
+
+    def finalize(self, p_uploadId: str) -> dict[str, Any]:
+        """
+        Verify the complete file and move it into place.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+
+        :return: The file name and its SHA256 checksum
+        :rtype: dict
+
+        :raises KeyError: If the session does not exist
+        :raises ValueError: If chunks are missing, the checksum does not match
+            or the file already exists
+        """
+        status = self.getStatus(p_uploadId)
+        if status["missing"]:
+            raise ValueError(f"{len(status['missing'])} chunks are missing")
+
+        sessionDir = self._sessionDir(p_uploadId)
+        dataPath = os.path.join(sessionDir, "data.part")
+        sha256 = hashlib.sha256()
+        with open(dataPath, "rb") as file:
+            while block := file.read(self.HASH_BLOCK_SIZE):
+                sha256.update(block)
+        computedSha256sum = sha256.hexdigest()
+        if computedSha256sum != status["sha256sum"]:
+            raise ValueError("SHA256 checksum mismatch")
+
+        if not self.installFile(
+            dataPath,
+            os.path.join(self.directory, status["filename"]),
+            computedSha256sum,
+        ):
+            raise ValueError(f"File '{status['filename']}' already exists")
+        self.abort(p_uploadId)
+        logging.info(f"Upload session {p_uploadId} finalized: '{status['filename']}'")
+
+        return {"filename": status["filename"], "sha256sum": computedSha256sum}
+
+    def abort(self, p_uploadId: str) -> None:
+        """
+        Remove a session and its data.
+
+        :param p_uploadId: The upload identifier
+        :type p_uploadId: str
+
+        :raises KeyError: If the session does not exist
+        """
+        sessionDir = self._sessionDir(p_uploadId)
+        if not os.path.isdir(sessionDir):
+            raise KeyError(f"Upload session '{p_uploadId}' not found")
+        with self._lock:
+            self._sessions.pop(p_uploadId, None)
+        shutil.rmtree(sessionDir, ignore_errors=True)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Optional
+from fastapi import WebSocket
+from serverMetrics import ServerMetrics
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class WebsocketClient:
+    """
+    A connected WebSocket client, with its queue of messages to send and its
+    subscription.
+
+    The queue is keyed by the coalescing key of the messages: a message
+    replaces the pending message with the same key, and moves to the end of
+    the queue so the messages stay in sequence order. A client behind only
+    receives the latest state of every result.
+    """
+
+    websocket: WebSocket
+    pending: "OrderedDict[Any, str]"
+    subscription: Optional[dict[str, Any]]
+
+    def __init__(self, p_websocket: WebSocket) -> None:
+        """
+        Constructor
+
+        :param p_websocket: The accepted WebSocket
+        :type p_websocket: WebSocket
+        """
+        self.websocket = p_websocket
+        self.pending = OrderedDict()
+        self.subscription = None
+        # Not sent the events while its snapshot is read
+        self.holding = False
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task[None]] = None
+
+
+class WebsocketBroadcaster:
+    """
+    Broadcast of the events to the WebSocket clients.
+
+    Every event is serialized once, and put on the bounded queue of every
+    client, sent by one task per client, so publishing never waits on a
+    socket. While a client is behind, the updates of a result are coalesced
+    into the latest one. A client whose queue is full, or which does not
+    accept a message within the send timeout, is disconnected.
+
+    A client sending {"subscribe": {...}} only receives the events matching
+    its filters, as {"seq": <sequence number>, "event": <event>}. The last
+    events are kept in a ring buffer, so a client reconnecting with the
+    stream identifier and the last sequence number it received gets the
+    events it missed, and a snapshot otherwise. The clients not subscribed
+    receive all the events as is.
+    """
+
+    maxQueue: int
+    sendTimeout: float
+    clients: dict[WebSocket, WebsocketClient]
+    stream: str
+    sequence: int
+    history: "deque[tuple[int, Optional[dict[str, str]], Any, str]]"
+    FILTERS = ("project", "serial", "state")
+
+    def __init__(
+        self, p_maxQueue: int = 256, p_sendTimeout: float = 10, p_history: int = 1000
+    ) -> None:
+        """
+        Constructor
+
+        :param p_maxQueue: The maximal number of messages waiting for a client
+        :type p_maxQueue: int
+        :param p_sendTimeout: The time in seconds a client has to accept a message
+        :type p_sendTimeout: float
+        :param p_history: The number of events kept for the reconnecting clients
+        :type p_history: int
+        """
+        self.maxQueue = p_maxQueue
+        self.sendTimeout = p_sendTimeout
+        self.clients = {}
+        # The sequence numbers restart with the server, with a new stream
+        self.stream = uuid.uuid4().hex
+        self.sequence = 0
+        self.history = deque(maxlen=p_history)
+        self._sequence = 0
+        self._closing: set[asyncio.Task[None]] = set()
+
+    @staticmethod
+    def coalesceKey(p_data: dict[str, Any]) -> Optional[str]:
+        """
+        Get the key of the messages replacing each other.
+
+        :param p_data: The message, {serial: {timestamp: result}},
+            {"telemetry": {...}} or {"downloadQueue": {...}}
+        :type p_data: dict
+
+        :return: The key, None for a message never coalesced
+        :rtype: str
+        """
+        if "downloadQueue" in p_data:
+            # One queue per worker process
+            return f"downloadQueue/{p_data['downloadQueue'].get('worker', '')}"
+        if "telemetry" in p_data:
+            telemetry = p_data["telemetry"]
+            return f"telemetry/{telemetry.get('serial')}/{telemetry.get('start')}"
+        if len(p_data) == 1:
+            serial, records = next(iter(p_data.items()))
+            if isinstance(records, dict) and len(records) == 1:
+                return f"{serial}/{next(iter(records))}"
+
+        return None
+
+    @staticmethod
+    def eventFields(p_data: dict[str, Any]) -> Optional[dict[str, str]]:
+        """
+        Get the fields of an event the subscriptions filter on.
+
+        :param p_data: The event
+        :type p_data: dict
+
+        :return: The project, serial and state of the provisioning of the
+            event, None for an event not about a provisioning
+        :rtype: dict
+        """
+        if "telemetry" in p_data:
+            telemetry = p_data["telemetry"]
+            return {
+                "project": str(telemetry.get("project", "")),
+                "serial": str(telemetry.get("serial", "")),
+                "state": "started",
+            }
+        if len(p_data) == 1:
+            serial, records = next(iter(p_data.items()))
+            if isinstance(records, dict) and len(records) == 1:
+                record = next(iter(records.values()))
+                provisionInfo = (
+                    record.get("cmProvisionInfo", {})
+                    if isinstance(record, dict)
+                    else {}
+                )
+                return {
+                    "project": str(provisionInfo.get("projectName", "")),
+                    "serial": str(serial),
+                    "state": str(provisionInfo.get("state", "")),
+                }
+
+        return None
+
+    @classmethod
+    def parseSubscription(cls, p_request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Parse the filters of a subscription request.
+
+        :param p_request: The request, with "project", "serial" and "state"
+            values or lists of values, and "downloadQueue" (default true)
+        :type p_request: dict
+
+        :return: The subscription, a set of accepted values per filtered field
+        :rtype: dict
+
+        :raises ValueError: If a filter is malformed
+        """
+        subscription: dict[str, Any] = {
+            "downloadQueue": bool(p_request.get("downloadQueue", True))
+        }
+        for field in cls.FILTERS:
+            values = p_request.get(field)
+            if values is None:
+                subscription[field] = None
+                continue
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list) or not all(
+                isinstance(value, str) for value in values
+            ):
+                raise ValueError(f"'{field}' must be a string or a list of strings")
+            subscription[field] = set(values)
+
+        return subscription
+
+    @classmethod
+    def matches(
+        cls, p_subscription: dict[str, Any], p_fields: Optional[dict[str, str]]
+    ) -> bool:
+        """
+        Check if an event matches a subscription.
+
+        :param p_subscription: The subscription
+        :type p_subscription: dict
+        :param p_fields: The fields of the event, see eventFields
+        :type p_fields: dict
+
+        :return: True if the event is sent to the subscriber
+        :rtype: bool
+        """
+        if p_fields is None:
+            return p_subscription["downloadQueue"]
+
+        return all(
+            p_subscription[field] is None or p_fields[field] in p_subscription[field]
+            for field in cls.FILTERS
+        )
+
+    def register(self, p_websocket: WebSocket) -> None:
+        """
+        Register an accepted WebSocket, and start its sender task.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        """
+        client = WebsocketClient(p_websocket)
+        client.task = asyncio.create_task(self._send(client))
+        self.clients[p_websocket] = client
+        ServerMetrics.websocketClients.set(len(self.clients))
+
+    def unregister(self, p_websocket: WebSocket) -> None:
+        """
+        Unregister a WebSocket, and stop its sender task.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        """
+        client = self.clients.pop(p_websocket, None)
+        if client is None:
+            return
+        if client.task is not None and client.task is not asyncio.current_task():
+            client.task.cancel()
+        ServerMetrics.websocketClients.set(len(self.clients))
+
+    def _drop(self, p_client: WebsocketClient, p_reason: str) -> None:
+        """
+        Disconnect a client.
+
+        :param p_client: The client
+        :type p_client: WebsocketClient
+        :param p_reason: The reason logged and sent in the close frame
+        :type p_reason: str
+        """
+        logging.warning(
+            f"Disconnecting WebSocket client {p_client.websocket.client}: {p_reason}"
+        )
+        ServerMetrics.websocketDropped.inc()
+        self.unregister(p_client.websocket)
+        task = asyncio.create_task(self._close(p_client.websocket, p_reason))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(p_websocket: WebSocket, p_reason: str) -> None:
+        """
+        Close a WebSocket, without waiting on a stalled client.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        :param p_reason: The reason sent in the close frame
+        :type p_reason: str
+        """
+        try:
+            # 1013: try again later
+            await asyncio.wait_for(p_websocket.close(code=1013, reason=p_reason), 1)
+        except Exception:
+            pass
+
+    async def _send(self, p_client: WebsocketClient) -> None:
+        """
+        Task sending the queued messages of a client, until cancelled.
+
+        :param p_client: The client
+        :type p_client: WebsocketClient
+        """
+        while True:
+            await p_client.ready.wait()
+            p_client.ready.clear()
+            while p_client.pending:
+                _, message = p_client.pending.popitem(last=False)
+                try:
+                    await asyncio.wait_for(
+                        p_client.websocket.send_text(message), self.sendTimeout
+                    )
+                except asyncio.TimeoutError:
+                    self._drop(p_client, "send timeout")
+                    return
+                except Exception as e:
+                    logging.error(f"Error sending data to WebSocket client: {e}")
+                    self.unregister(p_client.websocket)
+                    return
+
+    @staticmethod
+    def _serialize(p_data: dict[str, Any]) -> str:
+        """
+        Serialize a message, like WebSocket.send_json does.
+
+        :param p_data: The message
+        :type p_data: dict
+
+        :return: The JSON text
+        :rtype: str
+        """
+        return json.dumps(p_data, separators=(",", ":"), ensure_ascii=False)
+
+    def _queue(self, p_client: WebsocketClient, p_key: Any, p_message: str) -> bool:
+        """
+        Queue a message for a client, replacing its pending message with the
+        same key. A client with a full queue is disconnected.
+
+        :param p_client: The client
+        :type p_client: WebsocketClient
+        :param p_key: The coalescing key of the message
+        :type p_key: Any
+        :param p_message: The JSON text
+        :type p_message: str
+
+        :return: False if the client was disconnected
+        :rtype: bool
+        """
+        if p_key in p_client.pending:
+            p_client.pending[p_key] = p_message
+            p_client.pending.move_to_end(p_key)
+            ServerMetrics.websocketCoalesced.inc()
+        elif len(p_client.pending) >= self.maxQueue:
+            self._drop(p_client, "too slow")
+            return False
+        else:
+            p_client.pending[p_key] = p_message
+        p_client.ready.set()
+
+        return True
+
+    def _uniqueKey(self) -> int:
+        """
+        Get a coalescing key for a message never coalesced.
+
+        :return: The key
+        :rtype: int
+        """
+        self._sequence += 1
+        return self._sequence
+
+    def send(self, p_websocket: WebSocket, p_data: dict[str, Any]) -> None:
+        """
+        Queue a message for one client.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        :param p_data: The message
+        :type p_data: dict
+        """
+        client = self.clients.get(p_websocket)
+        if client is not None:
+            self._queue(client, self._uniqueKey(), self._serialize(p_data))
+
+    async def subscribe(
+        self,
+        p_websocket: WebSocket,
+        p_subscription: dict[str, Any],
+        p_stream: Optional[str],
+        p_since: Optional[int],
+        p_snapshot: Callable[[dict[str, Any]], Awaitable[dict[Any, Any]]],
+    ) -> None:
+        """
+        Subscribe a client to the events matching its filters, from the
+        ring buffer if it resumes a stream, from a snapshot otherwise.
+
+        :param p_websocket: The WebSocket
+        :type p_websocket: WebSocket
+        :param p_subscription: The subscription, see parseSubscription
+        :type p_subscription: dict
+        :param p_stream: The stream of the last event received by the client
+        :type p_stream: str
+        :param p_since: The sequence number of the last event received by the client
+        :type p_since: int
+        :param p_snapshot: Get the in-progress provisionings matching a
+            subscription, as {serial: {timestamp: result}}
+        :type p_snapshot: Callable[[dict], Awaitable[dict]]
+        """
+        client = self.clients.get(p_websocket)
+        if client is None:
+            return
+        client.subscription = p_subscription
+        client.pending.clear()
+        missed: "OrderedDict[Any, str]" = OrderedDict()
+        resumed = (
+            p_since is not None
+            and p_stream == self.stream
+            and self.sequence - len(self.history) <= p_since <= self.sequence
+        )
+        if resumed:
+            for sequence, fields, key, envelope in self.history:
+                if sequence > p_since and self.matches(p_subscription, fields):
+                    missed[key] = envelope
+                    missed.move_to_end(key)
+            # Too many missed events to queue, a snapshot is smaller
+            resumed = len(missed) < self.maxQueue
+        acknowledgment = {
+            "subscribed": {
+                field: sorted(values) if isinstance(values, set) else values
+                for field, values in p_subscription.items()
+            },
+            "stream": self.stream,
+            "seq": self.sequence,
+            "resumed": resumed,
+        }
+        self._queue(client, self._uniqueKey(), self._serialize(acknowledgment))
+        if resumed:
+            client.pending.update(missed)
+            return
+
+        # The events published while the snapshot is read are sent after it
+        sequence = self.sequence
+        client.holding = True
+        try:
+            snapshot = {"seq": sequence, "snapshot": await p_snapshot(p_subscription)}
+        finally:
+            client.holding = False
+        if self.clients.get(p_websocket) is not client:
+            return
+        if not self._queue(client, self._uniqueKey(), self._serialize(snapshot)):
+            return
+        for eventSequence, fields, key, envelope in self.history:
+            if eventSequence > sequence and self.matches(p_subscription, fields):
+                if not self._queue(client, key, envelope):
+                    return
+
+    def publish(self, p_data: dict[str, Any], p_sequence: Optional[int] = None) -> None:
+        """
+        Number an event and queue it for all the clients.
+
+        :param p_data: The event
+        :type p_data: dict
+        :param p_sequence: The sequence number of the event, numbered by the
+            WorkerHub for all the worker processes, the next one if not set
+        :type p_sequence: int
+        """
+        start = time.perf_counter()
+        # Serialized once for all the clients
+        message = self._serialize(p_data)
+        self.sequence = self.sequence + 1 if p_sequence is None else p_sequence
+        envelope = f'{{"seq":{self.sequence},"event":{message}}}'
+        fields = self.eventFields(p_data)
+        key = self.coalesceKey(p_data)
+        if key is None:
+            key = self._uniqueKey()
+        self.history.append((self.sequence, fields, key, envelope))
+        for client in list(self.clients.values()):
+            if client.holding:
+                continue
+            if client.subscription is None:
+                self._queue(client, key, message)
+            elif self.matches(client.subscription, fields):
+                self._queue(client, key, envelope)
+        ServerMetrics.websocketBroadcast.observe(time.perf_counter() - start)
+
+    async def stop(self) -> None:
+        """
+        Stop the sender tasks and the closing of the dropped clients.
+        """
+        tasks = [client.task for client in self.clients.values() if client.task]
+        tasks.extend(self._closing)
+        self.clients.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        ServerMetrics.websocketClients.set(0)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import threading
+import uuid
+from typing import Any, Awaitable, Callable, Optional
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s:     %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+
+class WorkerHub:
+    """
+    Local Unix socket relay of the messages between the HTTP worker
+    processes, run by the process supervising them.
+
+    Every message is one line of JSON. A worker sends
+    {"publish": <topic>, "data": <data>}, the hub relays it as
+    {"topic": <topic>, "data": <data>} to all the workers, the sender
+    included, in the order it received the messages. The messages of the
+    PRIMARY_TOPICS are only relayed to the primary worker, the oldest
+    connected one, and the WebSocket events are numbered, so the sequence
+    numbers of a stream are the same in all the workers.
+
+    On connection, a worker receives
+    {"hello": {"stream": <stream>, "seq": <last number>, "primary": <bool>}},
+    and {"primary": true} when it becomes the primary worker.
+    """
+
+    socketPath: str
+    stream: str
+    sequence: int
+    PRIMARY_TOPICS = ("provisioning",)
+    SEQUENCED_TOPICS = ("websocket",)
+    # The results with their error logs may be larger than the default limit
+    LINE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, p_socketPath: str) -> None:
+        """
+        Constructor
+
+        :param p_socketPath: The Unix socket of the hub
+        :type p_socketPath: str
+        """
+        self.socketPath = p_socketPath
+        self.stream = uuid.uuid4().hex
+        self.sequence = 0
+        self.workers: list[asyncio.StreamWriter] = []
+        self._started = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _write(p_writer: asyncio.StreamWriter, p_message: dict[str, Any]) -> None:
+        """
+        Send a message to a worker.
+
+        :param p_writer: The connection of the worker
+        :type p_writer: asyncio.StreamWriter
+        :param p_message: The message
+        :type p_message: dict
+        """
+        p_writer.write(f"{json.dumps(p_message, separators=(',', ':'))}\n".encode())
+
+    def _route(self, p_frame: dict[str, Any]) -> None:
+        """
+        Relay a message published by a worker.
+
+        :param p_frame: The message, {"publish": <topic>, "data": <data>}
+        :type p_frame: dict
+        """
+        topic = p_frame.get("publish")
+        if not isinstance(topic, str) or not self.workers:
+            return
+        message: dict[str, Any] = {"topic": topic, "data": p_frame.get("data")}
+        if topic in self.SEQUENCED_TOPICS:
+            self.sequence += 1
+            message["seq"] = self.sequence
+        # Serialized once for all the workers
+        line = f"{json.dumps(message, separators=(',', ':'))}\n".encode()
+        targets = self.workers[:1] if topic in self.PRIMARY_TOPICS else self.workers
+        for writer in targets:
+            writer.write(line)
+
+    async def _handle(
+        self, p_reader: asyncio.StreamReader, p_writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Serve the connection of a worker, until it is closed.
+
+        :param p_reader: The incoming stream of the worker
+        :type p_reader: asyncio.StreamReader
+        :param p_writer: The outgoing stream of the worker
+        :type p_writer: asyncio.StreamWriter
+        """
+        self.workers.append(p_writer)
+        primary = len(self.workers) == 1
+        self._write(
+            p_writer,
+            {
+                "hello": {
+                    "stream": self.stream,
+                    "seq": self.sequence,
+                    "primary": primary,
+                }
+            },
+        )
+        try:
+            while line := await p_reader.readline():
+                try:
+                    frame = json.loads(line)
+                except ValueError:
+                    logging.error("Invalid message received from an HTTP worker")
+                    continue
+                if isinstance(frame, dict):
+                    self._route(frame)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.error(f"Error reading the messages of an HTTP worker: {e}")
+        finally:
+            wasPrimary = bool(self.workers) and self.workers[0] is p_writer
+            self.workers.remove(p_writer)
+            p_writer.close()
+            if wasPrimary and self.workers:
+                self._write(self.workers[0], {"primary": True})
+                logging.info("The primary HTTP worker left, another one takes over")
+
+    async def _serve(self) -> None:
+        """
+        Accept the connections of the workers, forever.
+        """
+        server = await asyncio.start_unix_server(
+            self._handle, self.socketPath, limit=self.LINE_LIMIT
+        )
+        self._started.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self) -> None:
+        """
+        Start the hub in a thread, listening once this method returns.
+        """
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        self._thread = threading.Thread(
+            target=asyncio.run, args=(self._serve(),), daemon=True
+        )
+        self._thread.start()
+        self._started.wait()
+
+
+class WorkerHubClient:
+    """
+    Connection of an HTTP worker to the WorkerHub.
+    """
+
+    socketPath: str
+    primary: bool
+    stream: str
+    sequence: int
+
+    def __init__(self, p_socketPath: str) -> None:
+        """
+        Constructor
+
+        :param p_socketPath: The Unix socket of the hub
+        :type p_socketPath: str
+        """
+        self.socketPath = p_socketPath
+        self.primary = False
+        self.stream = ""
+        self.sequence = 0
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loopThreadId = 0
+
+    async def connect(
+        self,
+        p_onMessage: Callable[[str, Any, Optional[int]], None],
+        p_onPrimary: Callable[[], Awaitable[None]],
+    ) -> None:
+        """
+        Connect to the hub, and start receiving its messages.
+
+        :param p_onMessage: Called with the topic, the data and the sequence
+            number of every message relayed by the hub
+        :type p_onMessage: Callable[[str, Any, Optional[int]], None]
+        :param p_onPrimary: Awaited when the worker becomes the primary one
+            after the connection
+        :type p_onPrimary: Callable[[], Awaitable[None]]
+        """
+        reader, self._writer = await asyncio.open_unix_connection(
+            self.socketPath, limit=WorkerHub.LINE_LIMIT
+        )
+        self._loop = asyncio.get_running_loop()
+        self._loopThreadId = threading.get_ident()
+        hello = json.loads(await reader.readline())["hello"]
+        self.stream = hello["stream"]
+        self.sequence = hello["seq"]
+        self.primary = hello["primary"]
+        self._task = asyncio.create_task(
+            self._receive(reader, p_onMessage, p_onPrimary)
+        )
+
+    async def _receive(
+        self,
+        p_reader: asyncio.StreamReader,
+        p_onMessage: Callable[[str, Any, Optional[int]], None],
+        p_onPrimary: Callable[[], Awaitable[None]],
+    ) -> None:
+        """
+        Task receiving the messages of the hub, until the connection is closed.
+
+        :param p_reader: The incoming stream of the hub
+        :type p_reader: asyncio.StreamReader
+        :param p_onMessage: Called with every relayed message
+        :type p_onMessage: Callable[[str, Any, Optional[int]], None]
+        :param p_onPrimary: Awaited when the worker becomes the primary one
+        :type p_onPrimary: Callable[[], Awaitable[None]]
+        """
+        try:
+            while line := await p_reader.readline():
+                message = json.loads(line)
+                if message.get("primary"):
+                    self.primary = True
+                    await p_onPrimary()
+                    continue
+                try:
+                    p_onMessage(message["topic"], message["data"], message.get("seq"))
+                except Exception as e:
+                    logging.error(
+                        f"Error handling the {message['topic']} message of the hub: {e}"
+                    )
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.error(f"Error reading the messages of the worker hub: {e}")
+        logging.error("Connection to the worker hub lost")
+
+    def _write(self, p_line: bytes) -> None:
+        """
+        Send a line to the hub, from the event loop.
+
+        :param p_line: The line
+        :type p_line: bytes
+        """
+        if self._writer is not None:
+            self._writer.write(p_line)
+
+    def publish(self, p_topic: str, p_data: Any) -> None:
+        """
+        Send a message to the workers, without waiting. May be called from
+        the threads of the synchronous routes.
+
+        :param p_topic: The topic
+        :type p_topic: str
+        :param p_data: The message, serializable to JSON
+        :type p_data: Any
+        """
+        if self._loop is None:
+            return
+        message = {"publish": p_topic, "data": p_data}
+        line = f"{json.dumps(message, separators=(',', ':'))}\n".encode()
+        if threading.get_ident() == self._loopThreadId:
+            self._write(line)
+        else:
+            self._loop.call_soon_threadsafe(self._write, line)
+
+    async def close(self) -> None:
+        """
+        Close the connection to the hub.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._loop = None